@@ -0,0 +1,151 @@
+import os
+from urllib.parse import urlparse
+
+from normalize import normalize_annotations, DEFAULT_COLOR
+
+# Operations accepted by /api/batch
+BATCH_OPERATIONS = ('append', 'remove', 'replace')
+# Largest number of operations accepted in one request
+BATCH_MAX_OPERATIONS = int(os.environ.get('BATCH_MAX_OPERATIONS', 1000))
+
+
+class BatchError(ValueError):
+    """
+    Raised when a /api/batch request as a whole is invalid
+    """
+
+
+class OperationError(Exception):
+    """
+    Raised when a single batch operation is invalid or can't be applied
+    """
+
+    def __init__(self, message, code=400):
+        super().__init__(message)
+        self.message = message
+        self.code = code
+
+
+def _filename(operation):
+    filename = operation.get("file") or operation.get("filename")
+    if not isinstance(filename, str):
+        raise OperationError("Invalid file name")
+    # Files can be given as a URL or path, like in /api/append
+    filename = os.path.basename(urlparse(filename).path)
+    if not filename.endswith(".json"):
+        raise OperationError("Invalid file name")
+    return filename
+
+
+def _prepare(operation):
+    """
+    Validates an operation before anything is changed. Returns (kind,
+    filename, payload).
+    """
+    if not isinstance(operation, dict) or operation.get("op") not in BATCH_OPERATIONS:
+        raise OperationError(f"op must be one of: {', '.join(BATCH_OPERATIONS)}")
+    kind = operation["op"]
+    filename = _filename(operation)
+
+    if kind == "append":
+        annotation_data = operation.get("data")
+        if not annotation_data or not isinstance(annotation_data, list):
+            raise OperationError("Invalid annotation data")
+        annotations = normalize_annotations([annotation for annotation in annotation_data
+                                             if isinstance(annotation, dict)], color=DEFAULT_COLOR)
+        return kind, filename, annotations
+
+    if kind == "remove":
+        selector = operation.get("selector")
+        label_to_remove = operation.get("label")
+        if not selector or not label_to_remove:
+            raise OperationError("Selector and label are required")
+        if not isinstance(selector, str):
+            raise OperationError("Selector must be a string")
+        return kind, filename, (selector, label_to_remove)
+
+    if "data" not in operation:
+        raise OperationError("data is required")
+    return kind, filename, operation["data"]
+
+
+def _error(kind, message, code):
+    return {"op": kind, "status": "error", "error": message, "code": code}
+
+
+def apply_batch(store, operations):
+    """
+    Applies the operations in a /api/batch request to the annotation store
+    and returns one result per operation, in request order.
+
+    Operations on the same file run in request order inside one store write,
+    so each touched file is persisted once. Files are independent of each
+    other and are written in the order they first appear.
+    """
+    if not isinstance(operations, list):
+        raise BatchError("operations must be a list")
+    if len(operations) > BATCH_MAX_OPERATIONS:
+        raise BatchError(f"At most {BATCH_MAX_OPERATIONS} operations are allowed per batch")
+
+    results = [None] * len(operations)
+    files = {}
+    for position, operation in enumerate(operations):
+        try:
+            kind, filename, payload = _prepare(operation)
+        except OperationError as e:
+            kind = operation.get("op") if isinstance(operation, dict) else None
+            results[position] = _error(kind, e.message, e.code)
+            continue
+        files.setdefault(filename, []).append((position, kind, payload))
+
+    for filename, group in files.items():
+        _apply_file(store, filename, group, results)
+    return results
+
+
+def _apply_file(store, filename, group, results):
+    creates = any(kind != "remove" for _, kind, _ in group)
+    # Position of the operation being applied, to blame it if it raises
+    current = [None]
+
+    def mutation(index, exists):
+        # Only removals, don't create an empty file for them
+        if not exists and not creates:
+            raise FileNotFoundError(filename)
+        for position, kind, payload in group:
+            current[0] = position
+            try:
+                if kind == "append":
+                    for annotation in payload:
+                        index.upsert(annotation)
+                    results[position] = {"op": kind, "status": "success", "count": len(payload)}
+                    exists = True
+                elif kind == "replace":
+                    index.reset(payload)
+                    results[position] = {"op": kind, "status": "success"}
+                    exists = True
+                elif not exists:
+                    raise OperationError("Annotation file not found", 404)
+                elif not index.remove_label(*payload):
+                    raise OperationError("Annotation not found", 404)
+                else:
+                    results[position] = {"op": kind, "status": "success"}
+            except OperationError as e:
+                results[position] = _error(kind, e.message, e.code)
+            except ValueError as e:
+                # e.g. the file doesn't contain a list of annotations
+                results[position] = _error(kind, str(e), 400)
+
+    try:
+        store.apply(os.path.join(filename), mutation)
+    except FileNotFoundError:
+        for position, kind, _ in group:
+            results[position] = _error(kind, "Annotation file not found", 404)
+    except Exception as e:
+        # The store discards a mutation that raises, so none of this file's
+        # operations were persisted, including those that had succeeded
+        for position, kind, _ in group:
+            if position == current[0]:
+                results[position] = _error(kind, str(e), 500)
+            else:
+                results[position] = _error(kind, f"Not applied, another operation on {filename} failed", 500)
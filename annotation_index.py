@@ -0,0 +1,251 @@
+class AnnotationIndex:
+    """
+    Insertion-ordered, selector-keyed view of a single annotation file.
+
+    Annotations are kept in a dict keyed by selector so upserts and removals
+    are O(1) per item while the list order seen by clients is preserved.
+    """
+
+    def __init__(self, data=None):
+        # Journal entries describing mutations since the last drain_changes()
+        self._changes = []
+        self._load(data)
+
+    def _load(self, data):
+        self._items = {}
+        self._anonymous = 0
+        # Documents that are not a list of annotations are kept verbatim
+        self._raw = None
+
+        if data is None:
+            return
+        if not isinstance(data, list):
+            self._raw = data
+            return
+        for annotation in data:
+            self._items[self._key_for(annotation)] = annotation
+
+    def _key_for(self, annotation):
+        selector = annotation.get("selector") if isinstance(annotation, dict) else None
+        if selector and isinstance(selector, str):
+            # A later duplicate replaces the earlier one and moves to the end,
+            # which matches what an append of that selector would produce
+            self._items.pop(selector, None)
+            return selector
+        # Entries without a selector can't be addressed, keep them in place
+        self._anonymous += 1
+        return ("anonymous", self._anonymous)
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, selector):
+        return selector in self._items
+
+    def get(self, selector):
+        return self._items.get(selector)
+
+    def to_json(self):
+        """
+        Returns the document in the same shape it is stored on disk
+        """
+        if self._raw is not None:
+            return self._raw
+        return list(self._items.values())
+
+    def drain_changes(self):
+        """
+        Returns and clears the journal entries recorded by mutations
+        """
+        changes, self._changes = self._changes, []
+        return changes
+
+    def apply(self, entry):
+        """
+        Replays a journal entry produced by drain_changes()
+        """
+        if entry["op"] == "put":
+            # Upserts move the annotation to the end
+            self._items.pop(entry["key"], None)
+            self._items[entry["key"]] = entry["value"]
+        elif entry["op"] == "set":
+            # In-place updates keep the annotation where it is
+            self._items[entry["key"]] = entry["value"]
+        elif entry["op"] == "del":
+            self._items.pop(entry["key"], None)
+        else:
+            raise ValueError(f"Unknown journal operation: {entry['op']}")
+
+    def reset(self, data):
+        """
+        Replaces the whole document with data. This can't be journaled, so
+        the next commit writes a full snapshot.
+        """
+        self._load(data)
+        self._changes.append({"op": "reset"})
+
+    def _require_list(self):
+        if self._raw is not None:
+            raise ValueError("Annotation file does not contain a list of annotations")
+
+    def upsert(self, annotation):
+        """
+        Adds or replaces the annotation for its selector, moving it to the end
+        """
+        self._require_list()
+        selector = annotation["selector"]
+        self._items.pop(selector, None)
+        self._items[selector] = annotation
+        self._changes.append({"op": "put", "key": selector, "value": annotation})
+
+    def remove_label(self, selector, label):
+        """
+        Removes a label from the annotation for selector, dropping the
+        annotation when it was the only label. Returns False if there is
+        no annotation for selector.
+        """
+        self._require_list()
+        annotation = self._items.get(selector)
+        if annotation is None:
+            return False
+
+        # If there's a labels array
+        if "labels" in annotation:
+            labels = annotation["labels"]
+            # If there's only one label and it matches, remove the entire entry
+            if len(labels) == 1 and labels[0] == label:
+                self._replace(selector, None, annotation)
+            # Otherwise, remove just the specific label
+            elif label in labels:
+                # Update a copy, the current one may still be read elsewhere
+                updated = dict(annotation, labels=list(labels))
+                updated["labels"].remove(label)
+                # Update the primary label if needed
+                if updated.get("label") == label and updated["labels"]:
+                    updated["label"] = updated["labels"][-1]
+                self._replace(selector, updated, annotation)
+        # If there's only a single label property
+        elif annotation.get("label") == label:
+            self._replace(selector, None, annotation)
+        return True
+
+    def _replace(self, selector, annotation, previous):
+        """
+        Updates the annotation for selector in place, or deletes it when
+        annotation is None. previous is the annotation it replaces.
+        """
+        if annotation is None:
+            del self._items[selector]
+            self._changes.append({"op": "del", "key": selector})
+        else:
+            self._items[selector] = annotation
+            self._changes.append({"op": "set", "key": selector, "value": annotation})
+
+
+class _StoredAnnotations:
+    """
+    Selector-keyed view of the annotations of one file in a database. Each
+    annotation is fetched the first time it is needed, so a mutation only
+    loads the annotations it touches.
+    """
+
+    def __init__(self, fetch):
+        self._fetch = fetch
+        self._items = {}
+
+    def get(self, selector):
+        if selector not in self._items:
+            self._items[selector] = self._fetch(selector)
+        return self._items[selector]
+
+    def __setitem__(self, selector, annotation):
+        self._items[selector] = annotation
+
+    def __delitem__(self, selector):
+        self._items[selector] = None
+
+
+class StoredAnnotationIndex(AnnotationIndex):
+    """
+    AnnotationIndex over a file kept in a database, one record per selector.
+    fetch(selector) returns the stored annotation or None. Mutations are
+    only recorded as changes for the store to write; reset() replaces the
+    whole file with a plain dict.
+    """
+
+    def __init__(self, fetch, raw=None):
+        self._changes = []
+        self._items = _StoredAnnotations(fetch)
+        self._anonymous = 0
+        self._raw = raw
+
+    def upsert(self, annotation):
+        self._require_list()
+        selector = annotation["selector"]
+        if isinstance(self._items, dict):
+            # After reset() the file is a plain dict, move the annotation to
+            # the end like the file store does
+            self._items.pop(selector, None)
+        self._items[selector] = annotation
+        self._changes.append({"op": "put", "key": selector, "value": annotation})
+
+    def _replace(self, selector, annotation, previous):
+        # The annotation that was read goes with the change, so a database
+        # can skip it if another writer changed the annotation meanwhile
+        if annotation is None:
+            del self._items[selector]
+            self._changes.append({"op": "del", "key": selector, "previous": previous})
+        else:
+            self._items[selector] = annotation
+            self._changes.append({"op": "set", "key": selector, "value": annotation, "previous": previous})
+
+    def entries(self):
+        """
+        Yields (position, selector, annotation) for the whole file after a
+        reset(), with None as the selector of annotations without one
+        """
+        for position, (key, annotation) in enumerate(self._items.items(), start=1):
+            yield position, (None if isinstance(key, tuple) else key), annotation
+
+
+class AnnotationStoreBase:
+    """
+    Operations shared by the annotation stores, built on their
+    apply(path, mutation)
+    """
+
+    def apply(self, path, mutation):
+        raise NotImplementedError
+
+    def read(self, path):
+        raise NotImplementedError
+
+    def replace(self, path, data):
+        """
+        Overwrites the document at path with data
+        """
+        def mutation(index, exists):
+            index.reset(data)
+        self.apply(path, mutation)
+
+    def upsert(self, path, annotations):
+        """
+        Adds or replaces each annotation by selector
+        """
+        def mutation(index, exists):
+            for annotation in annotations:
+                index.upsert(annotation)
+        self.apply(path, mutation)
+
+    def remove_label(self, path, selector, label):
+        """
+        Removes label from the annotation for selector.
+
+        Raises FileNotFoundError if the file doesn't exist and returns False
+        if no annotation matches selector.
+        """
+        def mutation(index, exists):
+            if not exists:
+                raise FileNotFoundError(path)
+            return index.remove_label(selector, label)
+        return self.apply(path, mutation)
@@ -0,0 +1,170 @@
+import os
+import sys
+
+from pymongo import ASCENDING, DeleteOne, ReplaceOne, ReturnDocument, UpdateOne
+
+from annotation_index import AnnotationStoreBase, StoredAnnotationIndex
+from db import get_db
+
+# One document per annotation, keyed by (file, selector)
+ANNOTATION_COLLECTION = os.environ.get('ANNOTATION_COLLECTION', 'annotations')
+# One document per annotation file, holding its ordering counter
+ANNOTATION_FILES_COLLECTION = os.environ.get('ANNOTATION_FILES_COLLECTION', 'annotation_files')
+
+
+def _unchanged(query, entry):
+    """
+    Narrows query to the annotation the change was based on. Writers aren't
+    serialized, so a removal loses to an upsert made since it was read
+    rather than deleting or overwriting it.
+    """
+    if "previous" not in entry:
+        return query
+    return dict(query, annotation=entry["previous"])
+
+
+class MongoAnnotationStore(AnnotationStoreBase):
+    """
+    Keeps annotations in MongoDB, one document per (file, selector), with the
+    same interface as AnnotationStore.
+
+    Appends are written as upserts in a single bulk_write and label removals
+    as updates of the annotation that was read, so a change costs O(changed
+    annotations) and every instance sharing the database sees the same
+    files. Each file also has a document in the files collection whose
+    counter orders its annotations the way the file backend does. Replacing
+    a whole file deletes and reinserts its annotations, which readers may
+    see half done.
+    """
+
+    def __init__(self, database=None):
+        self._database = database
+        self._indexes_ensured = False
+
+    def _collections(self):
+        database = self._database if self._database is not None else get_db()
+        annotations = database[ANNOTATION_COLLECTION]
+        files = database[ANNOTATION_FILES_COLLECTION]
+        if not self._indexes_ensured:
+            self.ensure_indexes(annotations)
+            self._indexes_ensured = True
+        return annotations, files
+
+    @staticmethod
+    def ensure_indexes(annotations):
+        annotations.create_index(
+            [('file', ASCENDING), ('selector', ASCENDING)],
+            name='file_1_selector_1',
+            unique=True,
+            partialFilterExpression={'selector': {'$exists': True}}
+        )
+        annotations.create_index([('file', ASCENDING), ('seq', ASCENDING)], name='file_1_seq_1')
+
+    @staticmethod
+    def _file(path):
+        # Annotation files all live in the working directory
+        return os.path.basename(path)
+
+    def _write_snapshot(self, annotations, files, file, index):
+        data = index.to_json()
+        documents = []
+        if isinstance(data, list):
+            for seq, selector, annotation in index.entries():
+                document = {'file': file, 'seq': seq, 'annotation': annotation}
+                # Annotations without a selector are stored without one, the
+                # unique index only covers documents that have it
+                if selector is not None:
+                    document['selector'] = selector
+                documents.append(document)
+        annotations.delete_many({'file': file})
+        if documents:
+            annotations.insert_many(documents, ordered=False)
+        record = {'_id': file, 'seq': len(documents)}
+        if not isinstance(data, list):
+            # Documents that are not a list of annotations are kept verbatim
+            record['raw'] = data
+        files.replace_one({'_id': file}, record, upsert=True)
+
+    def _write_changes(self, annotations, files, file, changes):
+        puts = sum(1 for entry in changes if entry["op"] == "put")
+        # Reserve one position per upsert, which also creates the file record
+        record = files.find_one_and_update(
+            {'_id': file},
+            {'$inc': {'seq': puts}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        seq = record['seq'] - puts
+
+        operations = []
+        for entry in changes:
+            query = {'file': file, 'selector': entry["key"]}
+            if entry["op"] == "put":
+                # Upserts move the annotation to the end
+                seq += 1
+                operations.append(ReplaceOne(
+                    query, dict(query, seq=seq, annotation=entry["value"]), upsert=True))
+            elif entry["op"] == "del":
+                operations.append(DeleteOne(_unchanged(query, entry)))
+            elif entry["op"] == "set":
+                # Updated in place, keeping its position
+                operations.append(UpdateOne(_unchanged(query, entry), {'$set': {'annotation': entry["value"]}}))
+            else:
+                raise ValueError(f"Unknown annotation change: {entry['op']}")
+        if operations:
+            # Ordered, so later changes to a selector win
+            annotations.bulk_write(operations, ordered=True)
+
+    def apply(self, path, mutation):
+        """
+        Runs mutation(index, exists) on the annotations at path and writes
+        the changes it makes, returning its result
+        """
+        file = self._file(path)
+        annotations, files = self._collections()
+        record = files.find_one({'_id': file}, {'raw': 1})
+
+        def fetch(selector):
+            document = annotations.find_one({'file': file, 'selector': selector}, {'annotation': 1})
+            return document['annotation'] if document is not None else None
+
+        index = StoredAnnotationIndex(fetch, raw=record.get('raw') if record is not None else None)
+        result = mutation(index, record is not None)
+
+        changes = index.drain_changes()
+        if any(entry["op"] == "reset" for entry in changes):
+            self._write_snapshot(annotations, files, file, index)
+        elif changes:
+            self._write_changes(annotations, files, file, changes)
+        return result
+
+    def read(self, path):
+        """
+        Returns the stored document for path, or None if it doesn't exist
+        """
+        file = self._file(path)
+        annotations, files = self._collections()
+        record = files.find_one({'_id': file})
+        if record is None:
+            return None
+        if 'raw' in record:
+            return record['raw']
+        cursor = annotations.find({'file': file}, {'annotation': 1, '_id': 0}).sort('seq', ASCENDING)
+        return [document['annotation'] for document in cursor]
+
+
+if __name__ == "__main__":
+    # Run `python annotation_mongo.py file.json ...` to copy annotation files
+    # into the STORAGE_BACKEND database before switching ANNOTATION_BACKEND
+    from annotation_store import AnnotationStore
+    from storage import storage
+
+    source = AnnotationStore()
+    target = storage.annotation_store()
+    for path in sys.argv[1:]:
+        data = source.read(path)
+        if data is None:
+            print(f"Skipping {path}, it doesn't exist")
+            continue
+        target.replace(path, data)
+        print(f"Imported {path}")
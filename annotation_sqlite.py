@@ -0,0 +1,121 @@
+import os
+
+import codec
+from annotation_index import AnnotationStoreBase, StoredAnnotationIndex
+
+SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS annotations '
+    '(file TEXT NOT NULL, selector, seq INTEGER NOT NULL, annotation BLOB NOT NULL)',
+    # Annotations without a selector are stored with a NULL one
+    'CREATE UNIQUE INDEX IF NOT EXISTS annotations_file_selector ON annotations (file, selector) '
+    'WHERE selector IS NOT NULL',
+    'CREATE INDEX IF NOT EXISTS annotations_file_seq ON annotations (file, seq)',
+    'CREATE TABLE IF NOT EXISTS annotation_files (file TEXT PRIMARY KEY, seq INTEGER NOT NULL, raw BLOB)',
+)
+
+
+class SQLiteAnnotationStore(AnnotationStoreBase):
+    """
+    Keeps annotations in SQLite with the same layout as the MongoDB backend,
+    one row per (file, selector) plus one per file. Each change runs in its
+    own transaction, so readers never see one half applied.
+
+    connection() returns the SQLite connection for the calling thread.
+    """
+
+    def __init__(self, connection):
+        self._connection = connection
+        conn = connection()
+        for statement in SCHEMA:
+            conn.execute(statement)
+
+    @staticmethod
+    def _file(path):
+        # Annotation files all live in the working directory
+        return os.path.basename(path)
+
+    @staticmethod
+    def _write_snapshot(conn, file, index):
+        data = index.to_json()
+        conn.execute('DELETE FROM annotations WHERE file = ?', (file,))
+        if isinstance(data, list):
+            rows = [(file, selector, seq, codec.dumps(annotation)) for seq, selector, annotation in index.entries()]
+            conn.executemany('INSERT INTO annotations (file, selector, seq, annotation) VALUES (?, ?, ?, ?)', rows)
+            record = (file, len(rows), None)
+        else:
+            # Documents that are not a list of annotations are kept verbatim
+            record = (file, 0, codec.dumps(data))
+        conn.execute('INSERT OR REPLACE INTO annotation_files (file, seq, raw) VALUES (?, ?, ?)', record)
+
+    @staticmethod
+    def _write_changes(conn, file, changes):
+        puts = sum(1 for entry in changes if entry["op"] == "put")
+        conn.execute('INSERT INTO annotation_files (file, seq) VALUES (?, 0) ON CONFLICT(file) DO NOTHING', (file,))
+        seq = conn.execute('SELECT seq FROM annotation_files WHERE file = ?', (file,)).fetchone()[0]
+        conn.execute('UPDATE annotation_files SET seq = ? WHERE file = ?', (seq + puts, file))
+
+        for entry in changes:
+            if entry["op"] == "put":
+                # Upserts move the annotation to the end
+                seq += 1
+                conn.execute(
+                    'INSERT INTO annotations (file, selector, seq, annotation) VALUES (?, ?, ?, ?) '
+                    'ON CONFLICT(file, selector) WHERE selector IS NOT NULL '
+                    'DO UPDATE SET seq = excluded.seq, annotation = excluded.annotation',
+                    (file, entry["key"], seq, codec.dumps(entry["value"]))
+                )
+            elif entry["op"] == "del":
+                conn.execute('DELETE FROM annotations WHERE file = ? AND selector = ?', (file, entry["key"]))
+            elif entry["op"] == "set":
+                # Writers are serialized by the transaction, so the annotation
+                # can't have changed since it was read
+                conn.execute('UPDATE annotations SET annotation = ? WHERE file = ? AND selector = ?',
+                             (codec.dumps(entry["value"]), file, entry["key"]))
+            else:
+                raise ValueError(f"Unknown annotation change: {entry['op']}")
+
+    def apply(self, path, mutation):
+        """
+        Runs mutation(index, exists) on the annotations at path and writes
+        the changes it makes, returning its result
+        """
+        file = self._file(path)
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            record = conn.execute('SELECT raw FROM annotation_files WHERE file = ?', (file,)).fetchone()
+
+            def fetch(selector):
+                row = conn.execute('SELECT annotation FROM annotations WHERE file = ? AND selector = ?',
+                                   (file, selector)).fetchone()
+                return codec.loads(row[0]) if row is not None else None
+
+            raw = codec.loads(record[0]) if record is not None and record[0] is not None else None
+            index = StoredAnnotationIndex(fetch, raw=raw)
+            result = mutation(index, record is not None)
+
+            changes = index.drain_changes()
+            if any(entry["op"] == "reset" for entry in changes):
+                self._write_snapshot(conn, file, index)
+            elif changes:
+                self._write_changes(conn, file, changes)
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        return result
+
+    def read(self, path):
+        """
+        Returns the stored document for path, or None if it doesn't exist
+        """
+        file = self._file(path)
+        conn = self._connection()
+        record = conn.execute('SELECT raw FROM annotation_files WHERE file = ?', (file,)).fetchone()
+        if record is None:
+            return None
+        if record[0] is not None:
+            return codec.loads(record[0])
+        rows = conn.execute('SELECT annotation FROM annotations WHERE file = ? ORDER BY seq', (file,)).fetchall()
+        # Decode the whole file as one JSON array
+        return codec.loads(b'[' + b','.join(row[0] for row in rows) + b']')
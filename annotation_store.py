@@ -0,0 +1,361 @@
+import logging
+import os
+import tempfile
+import threading
+import time
+
+import codec
+import file_lock
+import metrics
+from annotation_index import AnnotationIndex, AnnotationStoreBase
+
+logger = logging.getLogger(__name__)
+
+# "file" keeps each annotation file on disk, "database" (or "mongo") keeps
+# one record per annotation in the STORAGE_BACKEND database, see storage.py
+ANNOTATION_BACKEND = os.environ.get('ANNOTATION_BACKEND', 'file')
+# "rewrite" saves the whole file on every change, "journal" appends each
+# change to <file>.journal and periodically folds it into the file
+PERSISTENCE_MODE = os.environ.get('ANNOTATION_PERSISTENCE', 'rewrite')
+JOURNAL_SUFFIX = '.journal'
+# Seconds between background compactions of journaled files
+COMPACT_INTERVAL = float(os.environ.get('ANNOTATION_COMPACT_INTERVAL', 30))
+# Journal entries after which a file is compacted straight away
+COMPACT_MAX_ENTRIES = int(os.environ.get('ANNOTATION_COMPACT_MAX_ENTRIES', 1000))
+
+
+def atomic_write_json(path, data):
+    """
+    Writes data to path via a temp file and rename so readers never see a
+    partially written file
+    """
+    directory = os.path.dirname(path) or '.'
+    fd, tmp_path = tempfile.mkstemp(prefix=f'.{os.path.basename(path)}.', suffix='.tmp', dir=directory)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(codec.dumps(data, pretty=codec.JSON_PRETTY_FILES))
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
+
+
+class _CachedFile:
+    """
+    In-memory state of one annotation file: its index, the snapshot it was
+    loaded from and how much of the journal has been replayed into it
+    """
+    __slots__ = ('index', 'snapshot', 'offset', 'pending')
+
+    def __init__(self, index, snapshot=None):
+        self.index = index
+        self.snapshot = snapshot
+        # Byte offset of the first journal entry not yet applied to index
+        self.offset = 0
+        # Journal entries not yet folded into the snapshot
+        self.pending = 0
+
+
+class _PendingWrite:
+    """
+    A mutation queued for the next group commit of its file
+    """
+    __slots__ = ('mutation', 'done', 'result', 'error')
+
+    def __init__(self, mutation):
+        self.mutation = mutation
+        self.done = False
+        self.result = None
+        self.error = None
+
+
+class AnnotationStore(AnnotationStoreBase):
+    """
+    Keeps annotation files in memory as AnnotationIndex objects.
+
+    A file is stored as a JSON snapshot plus, in journal mode, a JSON-lines
+    journal of the changes made since. Each cached index remembers the
+    snapshot (mtime, size) and the journal offset it has replayed, so changes
+    written by another process are picked up on the next access.
+    """
+
+    def __init__(self, mode=None):
+        self.mode = mode or PERSISTENCE_MODE
+        if self.mode not in ('rewrite', 'journal'):
+            raise ValueError(f"Unknown annotation persistence mode: {self.mode}")
+        self._files = {}
+        self._compactor_pid = None
+        # Writes waiting for the file lock, keyed by path
+        self._queue_lock = threading.Lock()
+        self._queues = {}
+
+    @staticmethod
+    def _signature(path):
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
+
+    @staticmethod
+    def _journal_size(journal_path):
+        try:
+            return os.path.getsize(journal_path)
+        except FileNotFoundError:
+            return 0
+
+    def _replay(self, cached, journal_path):
+        """
+        Applies the complete journal lines after cached.offset to the index.
+        A trailing line without a newline is an interrupted write and is left
+        for the next writer to truncate.
+        """
+        with metrics.timed('file_read'):
+            with open(journal_path, 'rb') as f:
+                f.seek(cached.offset)
+                tail = f.read()
+
+            end = tail.rfind(b'\n')
+            if end < 0:
+                return
+            for line in tail[:end].splitlines():
+                if line.strip():
+                    cached.index.apply(codec.loads(line))
+                    cached.pending += 1
+            cached.offset += end + 1
+
+    def _load(self, path):
+        """
+        Returns the _CachedFile for path, or None if it doesn't exist. The
+        snapshot is only re-read if it changed since it was cached, otherwise
+        just the new journal entries are replayed.
+        """
+        snapshot = self._signature(path)
+        journal_path = path + JOURNAL_SUFFIX
+        journal_size = self._journal_size(journal_path)
+
+        cached = self._files.get(path)
+        if cached is not None and cached.snapshot == snapshot and journal_size >= cached.offset:
+            if journal_size > cached.offset:
+                self._replay(cached, journal_path)
+            return cached
+
+        if snapshot is None and journal_size == 0:
+            self._files.pop(path, None)
+            return None
+
+        if snapshot is not None:
+            cached = _CachedFile(AnnotationIndex(codec.load_file(path)), snapshot)
+        else:
+            cached = _CachedFile(AnnotationIndex())
+        if journal_size:
+            self._replay(cached, journal_path)
+        self._files[path] = cached
+        return cached
+
+    def _compact(self, path, cached):
+        """
+        Folds the journal into a new snapshot and truncates the journal.
+        Replaying the old journal over the new snapshot is harmless, so a
+        crash between the two steps loses nothing.
+        """
+        atomic_write_json(path, cached.index.to_json())
+        cached.snapshot = self._signature(path)
+        journal_path = path + JOURNAL_SUFFIX
+        if os.path.exists(journal_path):
+            with open(journal_path, 'r+b') as f:
+                f.truncate(0)
+        cached.offset = 0
+        cached.pending = 0
+
+    def _append_journal(self, path, cached, changes):
+        payload = b''.join(codec.dumps(entry) + b'\n' for entry in changes)
+        with open(path + JOURNAL_SUFFIX, 'ab') as f:
+            # Drop the remains of an interrupted write before appending
+            if f.tell() != cached.offset:
+                f.truncate(cached.offset)
+            f.write(payload)
+            f.flush()
+            cached.offset = f.tell()
+        cached.pending += len(changes)
+
+    def _commit(self, path, cached):
+        """
+        Persists the changes recorded on cached.index since the last commit
+        """
+        changes = cached.index.drain_changes()
+        if not changes and cached.snapshot is not None:
+            return
+        if self.mode == 'journal' and changes and all(entry["op"] != "reset" for entry in changes):
+            self._append_journal(path, cached, changes)
+            if cached.pending >= COMPACT_MAX_ENTRIES:
+                self._compact(path, cached)
+            self._ensure_compactor()
+        else:
+            self._compact(path, cached)
+
+    def _ensure_compactor(self):
+        # Threads don't survive a fork, so each worker starts its own
+        if self._compactor_pid == os.getpid():
+            return
+        self._compactor_pid = os.getpid()
+        thread = threading.Thread(target=self._compact_loop, name='annotation-compactor', daemon=True)
+        thread.start()
+
+    def _compact_loop(self):
+        while True:
+            time.sleep(COMPACT_INTERVAL)
+            self.compact()
+
+    def compact(self):
+        """
+        Folds the journal of every cached file into its snapshot
+        """
+        for path in list(self._files):
+            with file_lock.locked(path):
+                try:
+                    cached = self._load(path)
+                    if cached is not None and cached.pending:
+                        self._compact(path, cached)
+                except Exception as e:
+                    self._files.pop(path, None)
+                    logger.exception('Error compacting %s: %s', path, e)
+
+    def _run_batch(self, path, batch):
+        """
+        Applies a batch of queued writes and commits them with one flush.
+        Must be called with the file lock held.
+        """
+        try:
+            pending = batch
+            while True:
+                cached = self._load(path)
+                exists = cached is not None
+                if cached is None:
+                    cached = self._files[path] = _CachedFile(AnnotationIndex())
+                failed = False
+                for write in pending:
+                    try:
+                        write.result = write.mutation(cached.index, exists)
+                        exists = True
+                    except Exception as e:
+                        write.error = e
+                        failed = True
+                if not failed:
+                    break
+                # A failed mutation may have changed the index part way, so
+                # reload the files and apply the others again without it
+                self._files.pop(path, None)
+                pending = [write for write in pending if write.error is None]
+            if exists:
+                self._commit(path, cached)
+            else:
+                # Nothing created the file, don't leave an empty one behind
+                self._files.pop(path, None)
+        except Exception as e:
+            # The in-memory index no longer matches the files, reload next time
+            self._files.pop(path, None)
+            for write in batch:
+                if write.error is None:
+                    write.error = e
+        finally:
+            for write in batch:
+                write.done = True
+
+    def apply(self, path, mutation):
+        """
+        Runs mutation(index, exists) on the annotations at path and persists
+        the changes it makes, returning its result.
+
+        Writers to the same file queue up behind its lock; whichever of them
+        gets the lock first applies every queued mutation and commits them
+        together, so concurrent writers share one flush. A mutation that
+        raises is discarded with any changes it made, and the others are
+        applied again without it, so they must be safe to run more than once.
+        """
+        path = os.path.abspath(path)
+        write = _PendingWrite(mutation)
+        with self._queue_lock:
+            self._queues.setdefault(path, []).append(write)
+
+        with file_lock.locked(path):
+            if not write.done:
+                with self._queue_lock:
+                    batch = self._queues.pop(path, [])
+                self._run_batch(path, batch)
+
+        if write.error is not None:
+            raise write.error
+        return write.result
+
+    def read(self, path):
+        """
+        Returns the stored document for path, or None if it doesn't exist
+        """
+        path = os.path.abspath(path)
+        if not os.path.exists(path) and not os.path.exists(path + JOURNAL_SUFFIX):
+            # Don't create a lock file for every name clients ask for
+            return None
+        with file_lock.locked(path, shared=True):
+            cached = self._load(path)
+            return cached.index.to_json() if cached is not None else None
+
+
+class MemoryAnnotationStore(AnnotationStoreBase):
+    """
+    Annotation files kept in this process only, for tests and benchmarks
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._files = {}
+
+    def apply(self, path, mutation):
+        path = os.path.basename(path)
+        with self._lock:
+            index = self._files.get(path)
+            exists = index is not None
+            if index is None:
+                index = AnnotationIndex()
+            # Annotations are replaced rather than changed in place, so a
+            # copy of the list is enough to undo a failed mutation
+            before = index.to_json()
+            before = list(before) if isinstance(before, list) else before
+            try:
+                result = mutation(index, exists)
+            except Exception:
+                if exists:
+                    self._files[path] = AnnotationIndex(before)
+                raise
+            if index.drain_changes() or exists:
+                self._files[path] = index
+            return result
+
+    def read(self, path):
+        with self._lock:
+            index = self._files.get(os.path.basename(path))
+            return index.to_json() if index is not None else None
+
+
+def create_store(backend=None):
+    """
+    Returns the annotation store for backend, ANNOTATION_BACKEND by default
+    """
+    backend = backend or ANNOTATION_BACKEND
+    if backend == 'file':
+        return AnnotationStore()
+    if backend in ('database', 'mongo'):
+        # Imported here, storage.py builds on MemoryAnnotationStore above
+        from storage import storage
+        return storage.annotation_store()
+    raise ValueError(f"Unknown annotation backend: {backend}")
+
+
+# Shared store used by the Flask routes
+store = create_store()
@@ -0,0 +1,221 @@
+import atexit
+import logging
+import os
+import queue
+import sys
+import threading
+from contextvars import ContextVar
+from logging.handlers import QueueHandler, QueueListener
+
+import codec
+
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+# Comma-separated route=LEVEL pairs, e.g. "/api/user=WARNING,/api/proxy/*=DEBUG".
+# A trailing * matches every route starting with what comes before it
+LOG_ROUTE_LEVELS = os.environ.get('LOG_ROUTE_LEVELS', '')
+# "text", or "json" for one JSON object per line
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'text')
+# High-volume messages are only logged once every this many times
+LOG_SAMPLE_EVERY = int(os.environ.get('LOG_SAMPLE_EVERY', 100))
+# Records waiting to be written. When the queue is full new records are
+# dropped instead of making the request wait
+LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', 10000))
+
+TEXT_FORMAT = '%(asctime)s %(levelname)s %(name)s %(route)s %(message)s'
+
+# Pass as extra= for messages logged on every request, so only a sample of
+# them is written
+SAMPLED = {'sampled': True}
+
+_route = ContextVar('log_route', default=None)
+
+
+def set_route(route):
+    """
+    Sets the route that records logged by the current request belong to
+    """
+    _route.set(route)
+
+
+def _level(name):
+    level = logging.getLevelName(name.strip().upper())
+    if not isinstance(level, int):
+        raise ValueError(f'Unknown log level: {name}')
+    return level
+
+
+def parse_route_levels(value):
+    """
+    Parses LOG_ROUTE_LEVELS into ({route: level}, [(prefix, level)]), with
+    the longest prefixes first
+    """
+    exact, prefixes = {}, []
+    for item in value.split(','):
+        if not item.strip():
+            continue
+        route, _, level = item.partition('=')
+        route = route.strip()
+        if route.endswith('*'):
+            prefixes.append((route[:-1], _level(level)))
+        else:
+            exact[route] = _level(level)
+    prefixes.sort(key=lambda prefix: len(prefix[0]), reverse=True)
+    return exact, prefixes
+
+
+class RouteFilter(logging.Filter):
+    """
+    Tags records with the current route, drops the ones below that route's
+    level and keeps one in sample_every of those logged with extra=SAMPLED
+    """
+
+    def __init__(self, level, route_levels='', sample_every=LOG_SAMPLE_EVERY):
+        super().__init__()
+        self.level = level
+        self.exact, self.prefixes = parse_route_levels(route_levels)
+        self.sample_every = sample_every
+        self._levels = {}
+        # Per route and message template. Updates can race, which only makes
+        # the sampling slightly uneven
+        self._counts = {}
+
+    def min_level(self):
+        return min([self.level, *self.exact.values(), *(level for _, level in self.prefixes)])
+
+    def level_for(self, route):
+        if route is None:
+            return self.level
+        level = self._levels.get(route)
+        if level is None:
+            level = self.exact.get(route)
+            if level is None:
+                level = next((level for prefix, level in self.prefixes if route.startswith(prefix)), self.level)
+            self._levels[route] = level
+        return level
+
+    def filter(self, record):
+        route = _route.get()
+        record.route = route or '-'
+        if record.levelno < self.level_for(route):
+            return False
+        if getattr(record, 'sampled', False) and self.sample_every > 1:
+            key = (route, record.msg)
+            count = self._counts.get(key, 0)
+            self._counts[key] = count + 1
+            if count % self.sample_every:
+                return False
+            record.sample_every = self.sample_every
+        return True
+
+
+class JSONFormatter(logging.Formatter):
+    """
+    Formats records as one JSON object per line
+    """
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'route': getattr(record, 'route', '-'),
+            'message': record.getMessage(),
+        }
+        if getattr(record, 'sample_every', None):
+            entry['sample_every'] = record.sample_every
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return codec.dumps(entry).decode('utf-8')
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """
+    Hands records to a listener thread that formats and writes them to
+    target, so logging never blocks the request. Records that don't fit in
+    the queue are counted and dropped.
+    """
+
+    def __init__(self, target, maxsize=LOG_QUEUE_SIZE):
+        super().__init__(queue.Queue(maxsize))
+        self.target = target
+        self.maxsize = maxsize
+        self.dropped = 0
+        self._listener_pid = None
+        self._listener_lock = threading.Lock()
+
+    def _ensure_listener(self):
+        # Threads don't survive a fork, so each worker starts its own, with
+        # a new queue in case the parent's was locked when it forked
+        if self._listener_pid == os.getpid():
+            return
+        with self._listener_lock:
+            if self._listener_pid == os.getpid():
+                return
+            if self._listener_pid is not None:
+                self.queue = queue.Queue(self.maxsize)
+            listener = QueueListener(self.queue, self.target, respect_handler_level=True)
+            listener.start()
+            # Write what is still queued when the process exits
+            atexit.register(listener.stop)
+            self._listener_pid = os.getpid()
+
+    def prepare(self, record):
+        # The queue doesn't leave the process, so formatting can wait for
+        # the listener thread
+        return record
+
+    def enqueue(self, record):
+        self._ensure_listener()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def stats(self):
+        return {'queued': self.queue.qsize(), 'dropped': self.dropped}
+
+
+_handler = None
+
+
+def configure():
+    """
+    Sends every log record through the queue handler, once per process
+    """
+    global _handler
+    if _handler is not None:
+        return _handler
+
+    target = logging.StreamHandler(sys.stdout)
+    target.setFormatter(JSONFormatter() if LOG_FORMAT == 'json' else logging.Formatter(TEXT_FORMAT))
+    route_filter = RouteFilter(_level(LOG_LEVEL), LOG_ROUTE_LEVELS)
+    _handler = NonBlockingQueueHandler(target)
+    _handler.addFilter(route_filter)
+
+    root = logging.getLogger()
+    root.addHandler(_handler)
+    # Routes can be more verbose than the default level
+    root.setLevel(route_filter.min_level())
+    return _handler
+
+
+def stats():
+    return _handler.stats() if _handler is not None else {'queued': 0, 'dropped': 0}
+
+
+def init_app(app):
+    """
+    Configures logging and tags each request's records with its route
+    """
+    from flask import request
+
+    configure()
+
+    @app.before_request
+    def set_request_route():
+        set_route(request.url_rule.rule if request.url_rule is not None else request.path)
+
+    @app.teardown_request
+    def clear_request_route(exc):
+        # Worker threads are reused, don't tag later records with this route
+        set_route(None)
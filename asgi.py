@@ -0,0 +1,358 @@
+import datetime
+import logging
+import time
+
+import httpx
+from asgiref.wsgi import WsgiToAsgi
+from werkzeug.datastructures import Accept
+from werkzeug.http import http_date, is_resource_modified, parse_accept_header
+
+import codec
+import metrics
+from app_logging import set_route
+from compression import choose_encoding, encoded_body, representation_etag, COMPRESSION_MIN_SIZE
+from main import app as flask_app, API_URL
+from normalize import normalize_annotations, NormalizationError
+from proxy_requests import (append_filename, bounding_box_filename, encode_json, streamed_headers,
+                            streaming_requested, upstream_body, log_upstream_body, log_upstream_response,
+                            PROXY_STREAM_CHUNK_SIZE)
+from response_cache import bounding_box_cache, CachedResponse, CacheTee
+from single_flight import AsyncSingleFlight
+from upstream import AsyncUpstreamClient, UpstreamBusy
+
+# ASGI entry point that serves the /api/proxy/* routes on an asyncio event
+# loop, so waiting on the upstream API doesn't tie up a worker. Every other
+# route is handed to the Flask app unchanged. Run it with
+#   gunicorn asgi:app -k uvicorn.workers.UvicornWorker
+
+logger = logging.getLogger(__name__)
+
+CORS_HEADERS = [
+    (b'access-control-allow-origin', b'*'),
+    (b'access-control-allow-headers', b'Content-Type,Authorization,X-Requested-With,Accept,Origin,'
+                                      b'Access-Control-Request-Method,Access-Control-Request-Headers'),
+    (b'access-control-allow-methods', b'GET,POST,PUT,DELETE,OPTIONS,PATCH'),
+    (b'access-control-allow-credentials', b'true'),
+]
+
+upstream_client = AsyncUpstreamClient()
+proxy_flights = AsyncSingleFlight()
+wsgi_app = WsgiToAsgi(flask_app)
+
+
+class ProxyResponse:
+    def __init__(self, body=b'', status=200, content_type='application/json', headers=None):
+        self.body = body
+        self.status = status
+        self.content_type = content_type
+        self.headers = headers or []
+
+    @classmethod
+    def json(cls, data, status=200):
+        return cls(encode_json(data), status)
+
+    async def send(self, send):
+        headers = [(b'content-type', self.content_type.encode('latin-1'))] if self.body else []
+        headers.append((b'content-length', str(len(self.body)).encode('latin-1')))
+        headers.extend((name.encode('latin-1'), value.encode('latin-1')) for name, value in self.headers)
+        headers.extend(CORS_HEADERS)
+        await send({'type': 'http.response.start', 'status': self.status, 'headers': headers})
+        await send({'type': 'http.response.body', 'body': self.body})
+
+
+class StreamedProxyResponse:
+    """
+    Pipes the body of a streamed upstream response to the client chunk by
+    chunk, optionally copying it into tee
+    """
+
+    def __init__(self, response, tee=None):
+        self.response = response
+        self.status = response.status_code
+        self.tee = tee
+
+    async def send(self, send):
+        headers = [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                   for name, value in streamed_headers(self.response.headers)]
+        headers.extend(CORS_HEADERS)
+        try:
+            await send({'type': 'http.response.start', 'status': self.status, 'headers': headers})
+            async for chunk in self.response.aiter_bytes(PROXY_STREAM_CHUNK_SIZE):
+                if self.tee is not None:
+                    self.tee.add(chunk)
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            if self.tee is not None:
+                self.tee.finish()
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            await self.response.aclose()
+
+
+def query_args(scope):
+    return httpx.QueryParams(scope.get('query_string', b'').decode('latin-1'))
+
+
+def upstream_json(response):
+    """
+    Returns the upstream API's response for the client, see PROXY_PASSTHROUGH
+    """
+    return ProxyResponse(*upstream_body(response.status_code, response.content, response.headers.get('content-type')))
+
+
+async def read_json(receive):
+    body = b''
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            break
+    return codec.loads(body) if body else None
+
+
+async def proxy_get_user_tasks(scope, receive):
+    data = await read_json(receive)
+    contact_number = str(data.get('contact_number'))
+
+    if not contact_number:
+        return ProxyResponse.json({'error': 'Contact number is required'}, 400)
+
+    # Fetching tasks doesn't change anything upstream, so it's safe to retry
+    def fetch_tasks(stream=False):
+        return upstream_client.post(
+            f'{API_URL}/get-user-tasks',
+            idempotent=True,
+            stream=stream,
+            json={'contact_number': contact_number},
+            headers={'Content-Type': 'application/json'}
+        )
+
+    if streaming_requested(query_args(scope)):
+        # A stream can't be shared with other requests
+        response = await fetch_tasks(stream=True)
+        log_upstream_response(logger, 'Proxy API', response.status_code)
+        return StreamedProxyResponse(response)
+
+    # Identical concurrent requests share one call
+    response = await proxy_flights.do(('get-user-tasks', contact_number), fetch_tasks)
+
+    log_upstream_response(logger, 'Proxy API', response.status_code, response.content)
+    return upstream_json(response)
+
+
+async def proxy_create_annotation(scope, receive):
+    data = await read_json(receive)
+    filename = data.get('filename')
+
+    if not filename:
+        return ProxyResponse.json({'error': 'Filename is required'}, 400)
+
+    streaming = streaming_requested(query_args(scope))
+    response = await upstream_client.post(
+        f'{API_URL}/create',
+        stream=streaming,
+        json={'filename': filename},
+        headers={'Content-Type': 'application/json'}
+    )
+
+    log_upstream_response(logger, 'Create API', response.status_code)
+    if streaming:
+        return StreamedProxyResponse(response)
+    log_upstream_body(logger, 'Create API', response.content)
+    return upstream_json(response)
+
+
+async def proxy_append_annotation(scope, receive):
+    data = await read_json(receive)
+    filename = append_filename(data.get('filename'))
+    annotation_data = data.get('data')
+
+    if not filename or not annotation_data:
+        return ProxyResponse.json({'error': 'Filename and data are required'}, 400)
+
+    # Validate and fill in missing properties of each annotation
+    try:
+        normalize_annotations(annotation_data, strict=True)
+    except NormalizationError as e:
+        return ProxyResponse.json({'error': str(e)}, 400)
+
+    streaming = streaming_requested(query_args(scope))
+    response = await upstream_client.post(
+        f'{API_URL}/append',
+        stream=streaming,
+        json={'filename': filename, 'data': annotation_data},
+        headers={'Content-Type': 'application/json'}
+    )
+
+    # The page's bounding boxes changed, drop the cached copy
+    if response.is_success:
+        bounding_box_cache.invalidate(filename)
+
+    log_upstream_response(logger, 'Proxy append API', response.status_code)
+    if streaming:
+        return StreamedProxyResponse(response)
+    log_upstream_body(logger, 'Proxy append API', response.content)
+    return upstream_json(response)
+
+
+async def request_bounding_boxes(filename, stream=False):
+    logger.debug('Fetching bounding boxes for filename: %s', filename)
+    response = await upstream_client.get(
+        f'{API_URL}/get/{filename}',
+        stream=stream,
+        headers={'Accept': 'application/json'}
+    )
+    log_upstream_response(logger, 'Get bounding boxes API', response.status_code)
+    return response
+
+
+async def fetch_bounding_boxes(filename):
+    """
+    Fetches bounding boxes from the upstream API and caches a 200 response.
+    Returns (CachedResponse, None), or (None, ProxyResponse) for a response
+    that shouldn't be cached.
+    """
+    generation = bounding_box_cache.generation(filename)
+    response = await request_bounding_boxes(filename)
+    log_upstream_body(logger, 'Get bounding boxes API', response.content)
+
+    result = upstream_json(response)
+    if result.status != 200:
+        return None, result
+    cached = CachedResponse(result.body, content_type=result.content_type)
+    bounding_box_cache.set(filename, cached, generation)
+    return cached, None
+
+
+async def proxy_get_bounding_boxes(scope, receive):
+    args = query_args(scope)
+    json_name = args.get('json_name')
+
+    if not json_name:
+        return ProxyResponse.json({'error': 'json_name parameter is required'}, 400)
+
+    filename = bounding_box_filename(json_name)
+
+    # Serve from cache when possible, bounding boxes only change on append
+    cached = bounding_box_cache.get(filename)
+    if cached is None and streaming_requested(args):
+        # Streams can't be shared with other requests, the first one to
+        # complete fills the cache for the rest
+        generation = bounding_box_cache.generation(filename)
+        response = await request_bounding_boxes(filename, stream=True)
+        tee = None
+        if response.status_code == 200:
+            tee = CacheTee(bounding_box_cache, filename, generation,
+                           response.headers.get('content-type') or 'application/json')
+        return StreamedProxyResponse(response, tee)
+    if cached is None:
+        # Identical concurrent requests share one upstream fetch
+        cached, error = await proxy_flights.do(('get-bounding-boxes', filename),
+                                               lambda: fetch_bounding_boxes(filename))
+        if error is not None:
+            return error
+
+    environ = {'REQUEST_METHOD': 'GET'}
+    for name, value in scope['headers']:
+        if name in (b'if-none-match', b'if-modified-since', b'accept-encoding'):
+            environ['HTTP_' + name.decode('latin-1').upper().replace('-', '_')] = value.decode('latin-1')
+
+    # Compress large bodies for clients that accept it, like the Flask app
+    encoding = None
+    if len(cached.body) >= COMPRESSION_MIN_SIZE:
+        encoding = choose_encoding(parse_accept_header(environ.get('HTTP_ACCEPT_ENCODING'), Accept))
+    etag = representation_etag(cached.etag, encoding)
+
+    # Let clients revalidate with If-None-Match / If-Modified-Since, using
+    # the same rules as Response.make_conditional
+    last_modified = datetime.datetime.fromtimestamp(cached.last_modified, datetime.timezone.utc)
+    headers = [('ETag', f'"{etag}"'), ('Last-Modified', http_date(last_modified)),
+               ('Cache-Control', 'no-cache'), ('Vary', 'Accept-Encoding')]
+    if not is_resource_modified(environ, etag=etag, last_modified=last_modified):
+        return ProxyResponse(status=304, headers=headers)
+    if encoding is None:
+        return ProxyResponse(cached.body, cached.status, cached.content_type, headers)
+    headers.append(('Content-Encoding', encoding))
+    return ProxyResponse(encoded_body(cached.etag, cached.body, encoding), cached.status, cached.content_type, headers)
+
+
+# Path -> (method, handler), the /proxy/* paths are aliases kept for older clients
+PROXY_ROUTES = {}
+for name, method, handler in (
+        ('get-user-tasks', 'POST', proxy_get_user_tasks),
+        ('create', 'POST', proxy_create_annotation),
+        ('append', 'POST', proxy_append_annotation),
+        ('get-bounding-boxes', 'GET', proxy_get_bounding_boxes)):
+    PROXY_ROUTES[f'/api/proxy/{name}'] = (method, handler)
+    PROXY_ROUTES[f'/proxy/{name}'] = (method, handler)
+
+
+async def proxy_stats(scope, receive):
+    # Upstream calls made and requests that shared another request's call
+    return ProxyResponse.json(proxy_flights.stats())
+
+
+PROXY_ROUTES['/api/proxy/stats'] = ('GET', proxy_stats)
+
+
+async def handle_proxy(scope, receive, handler):
+    name = handler.__name__
+    # Each request runs in its own task, so this only tags its records
+    set_route(scope['path'])
+    try:
+        return await handler(scope, receive)
+    except UpstreamBusy as e:
+        logger.warning('Upstream busy in %s: %s', name, e)
+        return ProxyResponse.json({'error': str(e)}, 503)
+    except httpx.TimeoutException as e:
+        logger.warning('Upstream timeout in %s: %s', name, e)
+        return ProxyResponse.json({'error': 'Upstream API timed out'}, 504)
+    except Exception as e:
+        logger.exception('Error in %s: %s', name, e)
+        return ProxyResponse.json({'error': str(e)}, 500)
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await upstream_client.aclose()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+
+    route = PROXY_ROUTES.get(scope.get('path')) if scope['type'] == 'http' else None
+    if route is None:
+        return await wsgi_app(scope, receive, send)
+
+    method, handler = route
+    start = time.perf_counter()
+    phases = metrics.start_request()
+    sent = {'status': 500, 'size': 0}
+
+    async def measured_send(message):
+        if message['type'] == 'http.response.start':
+            sent['status'] = message['status']
+        elif message['type'] == 'http.response.body':
+            sent['size'] += len(message.get('body', b''))
+        await send(message)
+
+    try:
+        if scope['method'] == 'OPTIONS':
+            # Preflight request
+            response = ProxyResponse.json({})
+        elif scope['method'] == method:
+            response = await handle_proxy(scope, receive, handler)
+        else:
+            response = ProxyResponse.json({'error': 'Method not allowed'}, 405)
+        await response.send(measured_send)
+    finally:
+        request_size = next((int(value) for name, value in scope['headers']
+                             if name == b'content-length' and value.isdigit()), 0)
+        metrics.record_request(scope['path'], scope['method'], str(sent['status']), time.perf_counter() - start,
+                               request_size, sent['size'], phases)
@@ -0,0 +1,264 @@
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from flask import g, jsonify, request
+
+import file_lock
+from storage import storage
+
+logger = logging.getLogger(__name__)
+
+# Seconds a token validation is trusted before asking the database again
+AUTH_CACHE_TTL = float(os.environ.get('AUTH_CACHE_TTL', 30))
+AUTH_CACHE_MAX_ENTRIES = int(os.environ.get('AUTH_CACHE_MAX_ENTRIES', 10000))
+# Optional file shared by all workers; evicted tokens are appended to it so
+# every worker drops them from its cache straight away. Without it, a token
+# evicted in one worker is still accepted by the others for up to the TTL
+AUTH_INVALIDATION_FILE = os.environ.get('AUTH_INVALIDATION_FILE')
+
+
+class AuthenticationError(Exception):
+    """
+    Raised when a token doesn't identify an existing user
+    """
+
+
+def _token_key(token):
+    # Tokens are kept hashed so raw credentials don't sit in memory or in
+    # the invalidation file
+    return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+
+def _evicted_at(line):
+    # Lines are "<token key> <unix time>"
+    parts = line.split()
+    return float(parts[1]) if len(parts) > 1 else 0.0
+
+
+class TokenCache:
+    """
+    Short-lived, bounded LRU cache of token validation results.
+
+    Failed validations are cached too: tokens are random, so one that isn't
+    valid now never becomes valid later.
+    """
+
+    def __init__(self, ttl=AUTH_CACHE_TTL, max_entries=AUTH_CACHE_MAX_ENTRIES,
+                 invalidation_file=AUTH_INVALIDATION_FILE):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.invalidation_file = invalidation_file
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        # Only evictions made after startup matter, the cache starts empty
+        self._invalidation_inode, self._invalidation_offset = (
+            self._invalidation_stat() if invalidation_file else (None, 0))
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _invalidation_stat(self):
+        try:
+            stat = os.stat(self.invalidation_file)
+        except FileNotFoundError:
+            return None, 0
+        return stat.st_ino, stat.st_size
+
+    def _sync_invalidations(self):
+        """
+        Drops tokens other workers appended to the invalidation file since
+        the last check. Called with the lock held.
+        """
+        if self._invalidation_stat() == (self._invalidation_inode, self._invalidation_offset):
+            return
+        try:
+            f = open(self.invalidation_file, 'rb')
+        except FileNotFoundError:
+            return
+        with f:
+            stat = os.fstat(f.fileno())
+            if stat.st_ino != self._invalidation_inode:
+                # Rotated by another worker, the new file has every eviction
+                # recent enough to matter
+                self._invalidation_inode, self._invalidation_offset = stat.st_ino, 0
+            elif stat.st_size < self._invalidation_offset:
+                # Truncated in place, we can't tell what was evicted
+                # meanwhile, so start over
+                self._entries.clear()
+                self._invalidation_offset = stat.st_size
+                return
+            f.seek(self._invalidation_offset)
+            tail = f.read()
+
+        end = tail.rfind(b'\n')
+        if end < 0:
+            return
+        for line in tail[:end].split(b'\n'):
+            if line.strip():
+                self._entries.pop(line.split()[0].decode('ascii', 'ignore'), None)
+        self._invalidation_offset += end + 1
+
+    def _rotate_invalidations(self):
+        """
+        Rewrites the invalidation file without the evictions older than the
+        TTL, once the oldest is twice that old. Validations cached before an
+        eviction expire within the TTL, so older evictions no longer matter.
+        Called with the file lock held.
+        """
+        now = time.time()
+        try:
+            with open(self.invalidation_file, 'rb') as f:
+                first = f.readline()
+                if not first or _evicted_at(first) > now - 2 * self.ttl:
+                    return
+                f.seek(0)
+                lines = f.read().split(b'\n')[:-1]
+        except FileNotFoundError:
+            return
+
+        recent = [line + b'\n' for line in lines if line.strip() and _evicted_at(line) >= now - self.ttl]
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.invalidation_file)),
+                                        suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.writelines(recent)
+            # Workers see a new inode and read the new file from the start
+            os.replace(tmp_path, self.invalidation_file)
+        except BaseException:
+            try:
+                os.unlink(tmp_path)
+            except FileNotFoundError:
+                pass
+            raise
+
+    def get(self, token):
+        """
+        Returns (found, result) where result is the cached identity dict, or
+        the AuthenticationError message for a cached failure
+        """
+        key = _token_key(token)
+        with self._lock:
+            if self.invalidation_file:
+                self._sync_invalidations()
+            entry = self._entries.get(key)
+            if entry is not None and time.monotonic() - entry[0] <= self.ttl:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return True, entry[1]
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return False, None
+
+    def set(self, token, result):
+        key = _token_key(token)
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.monotonic(), result)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def evict(self, token):
+        """
+        Forgets token in this worker and, if configured, in all the others
+        """
+        key = _token_key(token)
+        with self._lock:
+            self._entries.pop(key, None)
+            self.evictions += 1
+        if self.invalidation_file:
+            # Locked so an append can't land in a file that is being rotated
+            with file_lock.locked(self.invalidation_file):
+                self._rotate_invalidations()
+                with open(self.invalidation_file, 'ab') as f:
+                    f.write(f'{key} {time.time():.0f}\n'.encode('ascii'))
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'size': len(self._entries),
+            }
+
+
+token_cache = TokenCache()
+
+
+def token_from_request():
+    """
+    Returns the bearer token from the Authorization header, or None
+    """
+    auth_header = request.headers.get('Authorization')
+    if not auth_header or not auth_header.startswith('Bearer '):
+        return None
+    return auth_header.split(' ')[1]
+
+
+def authenticate(token):
+    """
+    Returns {'user_id', 'contact_number'} for a valid token, raising
+    AuthenticationError otherwise. Results are served from token_cache when
+    possible, saving the token and user lookups.
+    """
+    found, result = token_cache.get(token)
+    if found:
+        if isinstance(result, str):
+            raise AuthenticationError(result)
+        return result
+
+    token_doc = storage.find_token(token)
+    if not token_doc:
+        token_cache.set(token, 'Invalid or expired token')
+        raise AuthenticationError('Invalid or expired token')
+
+    user_id = token_doc['user_id']
+
+    # Get user from database to ensure it still exists
+    user = storage.find_user(user_id)
+    if not user:
+        logger.warning('User not found in database: user_id=%s', user_id)
+        # Remove the invalid token
+        storage.delete_token(token)
+        token_cache.set(token, 'User not found')
+        raise AuthenticationError('User not found')
+
+    identity = {
+        'user_id': user_id,
+        'contact_number': token_doc['contact_number']
+    }
+    token_cache.set(token, identity)
+    return identity
+
+
+def auth_required(view):
+    """
+    Decorator for protected routes. Stores the identity in g.user, or
+    answers with the same auth_required payload as /api/user.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        token = token_from_request()
+        if token is None:
+            return jsonify({
+                'success': False,
+                'error': 'Not authenticated',
+                'auth_required': True
+            }), 200
+        try:
+            g.user = authenticate(token)
+        except AuthenticationError as e:
+            return jsonify({
+                'success': False,
+                'error': str(e),
+                'auth_required': True
+            }), 200
+        return view(*args, **kwargs)
+    return wrapper
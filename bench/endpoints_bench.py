@@ -0,0 +1,252 @@
+"""
+Benchmark for the annotation, label, element and proxy endpoints.
+
+Generates elements.json, labels.json and an annotation file with the given
+number of elements in a temporary directory, then sends requests to the
+Flask app through its test client. The proxy routes talk to the stub in
+stub_upstream.py, run in this process, and users and sessions are kept in
+memory, so no network or MongoDB is needed.
+
+Reports throughput, p50/p99 latency and peak RSS per endpoint and size.
+Peak RSS only grows, so sizes run smallest first. --save writes the results
+as a baseline, --compare reports changes against one and exits with status
+1 if anything got slower than --threshold allows.
+
+Usage:
+    python bench/endpoints_bench.py --elements 1000 10000 --requests 300
+    python bench/endpoints_bench.py --save bench/baseline.json
+    python bench/endpoints_bench.py --compare bench/baseline.json --threshold 0.25
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import stub_upstream  # noqa: E402
+
+TAGS = ('div', 'p', 'span', 'a', 'li', 'h2')
+
+
+def make_elements(count):
+    return [
+        {
+            'selector': f'{TAGS[n % len(TAGS)]}.item.i{n}',
+            'tag': TAGS[n % len(TAGS)],
+            'class': f'item i{n}',
+            'text': f'Element {n}',
+            'x': (n * 37) % 1280,
+            'y': n * 18,
+            'width': 40 + (n * 53) % 900,
+            'height': 12 + (n * 29) % 300,
+        }
+        for n in range(count)
+    ]
+
+
+def make_annotations(elements, label_rounds):
+    # Enough labels per annotation for every remove request to find one
+    return [
+        {
+            'selector': element['selector'],
+            'tag': element['tag'],
+            'class': element['class'],
+            'label': ['title', *(f'bench{k}' for k in range(label_rounds))],
+            'timestamp': '2024-01-01T00:00:00',
+            'color': '#2196F3',
+            'id': f'e{n}',
+        }
+        for n, element in enumerate(elements)
+    ]
+
+
+def make_labels(elements):
+    return [
+        {'selector': element['selector'], 'label': 'title', 'timestamp': '2024-01-01T00:00:00'}
+        for element in elements[::2]
+    ]
+
+
+def scenarios(size, batch):
+    """
+    (name, request(n)) pairs, where request returns (method, url, json) for
+    the nth request
+    """
+    annotation_file = f'bench-{size}.json'
+
+    def selectors(n):
+        start = (n * batch) % size
+        return [f'{TAGS[i % len(TAGS)]}.item.i{i}' for i in range(start, min(start + batch, size))]
+
+    return [
+        ('elements', lambda n: ('GET', '/api/elements?limit=100', None)),
+        ('elements-filtered', lambda n: ('GET', f'/api/elements?tag=p&sort=area_asc&limit=100&min_area={n % 50}',
+                                         None)),
+        ('append', lambda n: ('POST', '/api/append', {
+            'filename': annotation_file,
+            'data': [{'selector': selector, 'label': ['body']} for selector in selectors(n)],
+        })),
+        ('remove-annotation', lambda n: ('POST', f'/api/remove-annotation?file={annotation_file}', {
+            'selector': f'{TAGS[n % size % len(TAGS)]}.item.i{n % size}', 'label': f'bench{n // size}',
+        })),
+        ('get-labels', lambda n: ('GET', '/api/get-labels', None)),
+        ('save-labels', lambda n: ('POST', '/api/save-labels', [
+            {'selector': selector, 'label': 'body'} for selector in selectors(n)
+        ])),
+        ('proxy-get-user-tasks', lambda n: ('POST', '/api/proxy/get-user-tasks', {'contact_number': str(n)})),
+        ('proxy-append', lambda n: ('POST', '/api/proxy/append', {
+            'filename': 'page.json', 'data': [{'selector': 'div.item.i1', 'label': ['title']}],
+        })),
+        ('proxy-bounding-boxes-cached', lambda n: ('GET', '/api/proxy/get-bounding-boxes?json_name=cached.json',
+                                                   None)),
+        ('proxy-bounding-boxes-miss', lambda n: ('GET', f'/api/proxy/get-bounding-boxes?json_name=m{size}-{n}.json',
+                                                 None)),
+    ]
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, kilobytes elsewhere
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def percentile(ordered, fraction):
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def run_scenario(client, request, warmup, requests):
+    for n in range(warmup):
+        method, url, body = request(n)
+        client.open(url, method=method, json=body).close()
+
+    latencies = []
+    errors = 0
+    started = time.perf_counter()
+    for n in range(warmup, warmup + requests):
+        method, url, body = request(n)
+        start = time.perf_counter()
+        response = client.open(url, method=method, json=body)
+        response.get_data()
+        response.close()
+        latencies.append(time.perf_counter() - start)
+        if response.status_code >= 400:
+            errors += 1
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        'requests': requests,
+        'errors': errors,
+        'rps': round(requests / elapsed, 1),
+        'p50_ms': round(percentile(latencies, 0.5) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+        'peak_rss_mb': round(peak_rss_mb(), 1),
+    }
+
+
+def compare(results, baseline, threshold):
+    """
+    Prints the change of each result against baseline and returns the
+    names of the ones that regressed by more than threshold
+    """
+    regressions = []
+    print(f"\n{'vs baseline':<40} {'rps':>9} {'p50':>9} {'p99':>9}")
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            print(f'{name:<40} {"new":>9}')
+            continue
+        rps = result['rps'] / base['rps'] - 1
+        p50 = result['p50_ms'] / base['p50_ms'] - 1 if base['p50_ms'] else 0
+        p99 = result['p99_ms'] / base['p99_ms'] - 1 if base['p99_ms'] else 0
+        regressed = rps < -threshold or p50 > threshold
+        if regressed:
+            regressions.append(name)
+        print(f'{name:<40} {rps:>+9.1%} {p50:>+9.1%} {p99:>+9.1%}{"  REGRESSED" if regressed else ""}')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--elements', type=int, nargs='+', default=[1000, 10000],
+                        help='sizes of the generated elements, labels and annotation files')
+    parser.add_argument('--requests', type=int, default=300, help='measured requests per endpoint and size')
+    parser.add_argument('--warmup', type=int, default=20, help='unmeasured requests sent first')
+    parser.add_argument('--batch', type=int, default=10, help='annotations or labels per append and save')
+    parser.add_argument('--boxes', type=int, default=1000, help='bounding boxes the stub upstream returns')
+    parser.add_argument('--save', metavar='PATH', help='write the results as a baseline')
+    parser.add_argument('--compare', metavar='PATH', help='compare the results with a saved baseline')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='fraction throughput may drop or p50 may grow before --compare fails')
+    args = parser.parse_args()
+    # Relative to where the command was run, not the working directory below
+    save_path = os.path.abspath(args.save) if args.save else None
+    compare_path = os.path.abspath(args.compare) if args.compare else None
+
+    workdir = tempfile.mkdtemp(prefix='endpoints-bench-')
+    os.chdir(workdir)
+    # Read when main is imported
+    os.environ['API_URL'] = stub_upstream.start(args.boxes)
+    os.environ.setdefault('STORAGE_BACKEND', 'memory')
+    os.environ.setdefault('SESSION_BACKEND', 'memory')
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+
+    import codec  # noqa: E402
+    from main import app  # noqa: E402
+
+    client = app.test_client()
+    results = {}
+    print(f"{'endpoint':<40} {'rps':>9} {'p50 ms':>9} {'p99 ms':>9} {'errors':>7} {'rss MB':>8}")
+    for size in sorted(args.elements):
+        elements = make_elements(size)
+        label_rounds = -(-(args.warmup + args.requests) // size)
+        with open('elements.json', 'wb') as f:
+            f.write(codec.dumps(elements))
+        with open('labels.json', 'wb') as f:
+            f.write(codec.dumps(make_labels(elements)))
+        with open(f'bench-{size}.json', 'wb') as f:
+            f.write(codec.dumps(make_annotations(elements, label_rounds)))
+        del elements
+
+        for name, request in scenarios(size, args.batch):
+            result = run_scenario(client, request, args.warmup, args.requests)
+            key = f'{name}@{size}'
+            results[key] = result
+            print(f"{key:<40} {result['rps']:>9} {result['p50_ms']:>9} {result['p99_ms']:>9} "
+                  f"{result['errors']:>7} {result['peak_rss_mb']:>8}")
+
+    status = 0
+    if compare_path:
+        with open(compare_path) as f:
+            regressions = compare(results, json.load(f)['results'], args.threshold)
+        if regressions:
+            print(f'\n{len(regressions)} regressed by more than {args.threshold:.0%}: {", ".join(regressions)}')
+            status = 1
+
+    if save_path:
+        with open(save_path, 'w') as f:
+            json.dump({
+                'environment': {
+                    'python': platform.python_version(),
+                    'platform': platform.platform(),
+                    'json_backend': codec.backend(),
+                    'storage_backend': os.environ['STORAGE_BACKEND'],
+                    'requests': args.requests,
+                    'batch': args.batch,
+                    'boxes': args.boxes,
+                },
+                'results': results,
+            }, f, indent=2)
+            f.write('\n')
+        print(f'\nSaved baseline to {save_path}')
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
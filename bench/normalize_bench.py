@@ -0,0 +1,114 @@
+"""
+Benchmark for annotation normalization on large batches.
+
+Times normalize_annotations() on batches of generated annotations, with a
+cold and a warm selector cache, against the per-item loop /api/append used
+before (which split each selector up to twice and took a timestamp per
+annotation). Reports the cost per annotation in microseconds.
+
+Usage:
+    python bench/normalize_bench.py --size 10000 --repeat 5 --selectors 500
+"""
+import argparse
+import copy
+import datetime
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import normalize  # noqa: E402
+
+
+def make_batch(size, selectors):
+    """
+    Annotations as the frontend sends them: some complete, most missing the
+    tag, class or timestamp, with a single label or a list
+    """
+    batch = []
+    for n in range(size):
+        selector = f'div.card.c{n % selectors}.row{n % 7}'
+        annotation = {'selector': selector, 'label': 'title' if n % 2 else ['title', 'body']}
+        if n % 3 == 0:
+            annotation.update(tag='div', **{'class': f'card c{n % selectors}'},
+                              timestamp='2024-01-01T00:00:00', id=f'e{n}', color='#2196F3')
+        if n % 5 == 0:
+            annotation['labels'] = ['title']
+        batch.append(annotation)
+    return batch
+
+
+def per_item_loop(annotation_data):
+    # The loop /api/append ran before normalize.py, for comparison
+    annotations = []
+    for new_annotation in annotation_data:
+        selector = new_annotation.get("selector")
+        labels = new_annotation.get("label")
+        if not selector or not labels:
+            continue
+        if not new_annotation.get("timestamp"):
+            new_annotation["timestamp"] = datetime.datetime.now().isoformat()
+        if not new_annotation.get("color"):
+            new_annotation["color"] = "#F44336"
+        selector_parts = selector.split('.')
+        if not new_annotation.get("tag") or new_annotation.get("tag") == "":
+            new_annotation["tag"] = selector_parts[0] if selector_parts[0] else "div"
+        if not new_annotation.get("class") or new_annotation.get("class") == "":
+            class_parts = [part for part in selector.split('.') if part and part != selector_parts[0]]
+            if class_parts:
+                new_annotation["class"] = " ".join(class_parts)
+        if not new_annotation.get("id"):
+            new_annotation["id"] = ""
+        if not isinstance(labels, list):
+            new_annotation["label"] = [labels] if labels else []
+        if "labels" in new_annotation:
+            del new_annotation["labels"]
+        annotations.append(new_annotation)
+    return annotations
+
+
+def timed(fn, batches):
+    """
+    Returns the best time per annotation in microseconds over the batches
+    """
+    best = None
+    for batch in batches:
+        start = time.perf_counter()
+        fn(batch)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best / len(batches[0]) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--size', type=int, default=10000, help='annotations per batch')
+    parser.add_argument('--repeat', type=int, default=5, help='batches timed, the best one is reported')
+    parser.add_argument('--selectors', type=int, default=500, help='distinct selectors in a batch')
+    args = parser.parse_args()
+
+    template = make_batch(args.size, args.selectors)
+
+    def fresh():
+        return [copy.deepcopy(template) for _ in range(args.repeat)]
+
+    def cold(batch):
+        normalize._parsed_selectors.clear()
+        normalize.normalize_annotations(batch, color=normalize.DEFAULT_COLOR)
+
+    results = [
+        ('per-item loop', timed(per_item_loop, fresh())),
+        ('normalize, cold cache', timed(cold, fresh())),
+        ('normalize, warm cache',
+         timed(lambda batch: normalize.normalize_annotations(batch, color=normalize.DEFAULT_COLOR), fresh())),
+    ]
+
+    print(f'{args.size} annotations per batch, {args.selectors} distinct selectors, best of {args.repeat}')
+    for name, cost in results:
+        print(f'  {name:<24} {cost:8.3f} us/annotation')
+    print(f'  selector cache: {len(normalize._parsed_selectors)} of {normalize.SELECTOR_CACHE_SIZE} entries')
+
+
+if __name__ == '__main__':
+    main()
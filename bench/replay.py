@@ -0,0 +1,158 @@
+"""
+Replays captured traffic against a running instance of the app.
+
+Reads a JSON Lines capture written by capture.py (see CAPTURE_FILE) and
+sends each request at its original offset from the first one, from a pool
+of --concurrency threads. --speed compresses time, e.g. 10 replays an hour
+of traffic in six minutes, and 0 sends requests as fast as the pool allows.
+--scale sends each request that many times on average, so 2 doubles the
+load while keeping the mix.
+
+Reports throughput and p50/p99 latency per route, errors, responses whose
+status differs from the captured one, and how late requests were sent. A
+large lag means the pool, not the server, was the bottleneck.
+
+Run the app against the stub upstream API so proxy routes don't reach the
+real one:
+    python bench/stub_upstream.py --port 5055 &
+    API_URL=http://127.0.0.1:5055 STORAGE_BACKEND=sqlite gunicorn -w 4 app:app
+    python bench/replay.py traffic.jsonl --target http://127.0.0.1:8000 --concurrency 32 --speed 10
+"""
+import argparse
+import base64
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import stub_upstream  # noqa: E402
+
+_local = threading.local()
+
+
+def load_capture(path, limit=None):
+    """
+    Returns the captured requests in the order they were received
+    """
+    records = []
+    with open(path, 'rb') as f:
+        for line in f:
+            if line.strip():
+                records.append(json.loads(line))
+    records.sort(key=lambda record: record['time'])
+    return records[:limit] if limit else records
+
+
+def schedule(records, speed, scale):
+    """
+    Yields (seconds after the start, record) for each request to send
+    """
+    if not records:
+        return
+    first = records[0]['time']
+    owed = 0.0
+    for record in records:
+        offset = (record['time'] - first) / speed if speed > 0 else 0.0
+        owed += scale
+        copies = int(owed)
+        owed -= copies
+        for _ in range(copies):
+            yield offset, record
+
+
+def route(record):
+    return f"{record['method']} {record['path'].split('?', 1)[0]}"
+
+
+def send(target, record, due, timeout):
+    session = getattr(_local, 'session', None)
+    if session is None:
+        session = _local.session = requests.Session()
+
+    if 'body' in record:
+        body = record['body'].encode('utf-8')
+    elif 'body_base64' in record:
+        body = base64.b64decode(record['body_base64'])
+    else:
+        body = None
+
+    start = time.perf_counter()
+    lag = start - due
+    try:
+        response = session.request(record['method'], target + record['path'], data=body,
+                                   headers=record.get('headers'), timeout=timeout, allow_redirects=False)
+        response.content
+        status = response.status_code
+    except requests.RequestException:
+        status = None
+    return route(record), status, record.get('status'), time.perf_counter() - start, lag
+
+
+def percentile(ordered, fraction):
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] if ordered else 0.0
+
+
+def report(results, elapsed):
+    by_route = {}
+    for result in results:
+        by_route.setdefault(result[0], []).append(result)
+
+    print(f"{'route':<45} {'count':>7} {'rps':>8} {'p50 ms':>8} {'p99 ms':>8} {'errors':>7} {'status!=':>8}")
+    for name, items in sorted(by_route.items(), key=lambda item: -len(item[1])) + [('total', results)]:
+        latencies = sorted(item[3] for item in items)
+        errors = sum(1 for item in items if item[1] is None or item[1] >= 500)
+        mismatched = sum(1 for item in items if item[2] is not None and item[1] != item[2])
+        print(f'{name:<45} {len(items):>7} {len(items) / elapsed:>8.1f} {percentile(latencies, 0.5) * 1000:>8.2f} '
+              f'{percentile(latencies, 0.99) * 1000:>8.2f} {errors:>7} {mismatched:>8}')
+
+    lags = sorted(item[4] for item in results)
+    print(f'\n{len(results)} requests in {elapsed:.2f}s, send lag p50 {percentile(lags, 0.5) * 1000:.1f} ms, '
+          f'p99 {percentile(lags, 0.99) * 1000:.1f} ms')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('capture', help='JSON Lines capture written with CAPTURE_FILE')
+    parser.add_argument('--target', default='http://127.0.0.1:8000', help='base URL of the running app')
+    parser.add_argument('--concurrency', type=int, default=16, help='requests in flight at most')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='time compression, 0 sends as fast as --concurrency allows')
+    parser.add_argument('--scale', type=float, default=1.0, help='copies of each request sent on average')
+    parser.add_argument('--limit', type=int, help='replay only the first LIMIT captured requests')
+    parser.add_argument('--timeout', type=float, default=30.0, help='seconds to wait for each response')
+    parser.add_argument('--stub-upstream', type=int, metavar='PORT',
+                        help='also serve the stub upstream API on PORT, start the app with API_URL pointing to it')
+    args = parser.parse_args()
+
+    if args.stub_upstream:
+        print(f'Stub upstream API on {stub_upstream.start(port=args.stub_upstream)}')
+
+    records = load_capture(args.capture, args.limit)
+    target = args.target.rstrip('/')
+    futures = []
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        started = time.perf_counter()
+        for offset, record in schedule(records, args.speed, args.scale):
+            due = started + offset
+            delay = due - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            futures.append(pool.submit(send, target, record, due, args.timeout))
+        results = [future.result() for future in futures]
+    elapsed = time.perf_counter() - started
+
+    if not results:
+        print('The capture has no requests')
+        return 1
+    report(results, elapsed)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
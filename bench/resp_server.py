@@ -0,0 +1,125 @@
+"""
+Minimal in-memory server speaking the Redis protocol.
+
+Implements the commands the redis session backend uses (PING, AUTH,
+SELECT, GET, SET with EX/PX, DEL, EXPIRE, TTL, DBSIZE, FLUSHDB) so it can
+be tried and benchmarked without installing Redis.
+
+Usage:
+    python bench/resp_server.py --port 6379
+    SESSION_BACKEND=redis SESSION_REDIS_URL=redis://localhost:6379/0 gunicorn app:app
+"""
+import argparse
+import socketserver
+import threading
+import time
+
+_lock = threading.Lock()
+_data = {}
+
+
+def _get(key):
+    item = _data.get(key)
+    if item is not None and item[1] is not None and item[1] <= time.time():
+        del _data[key]
+        return None
+    return item
+
+
+def _set(args):
+    key, value, expires_at = args[0], args[1], None
+    options = [arg.upper() for arg in args[2:]]
+    for position, option in enumerate(options):
+        if option == b'EX':
+            expires_at = time.time() + int(args[2 + position + 1])
+        elif option == b'PX':
+            expires_at = time.time() + int(args[2 + position + 1]) / 1000
+    _data[key] = (value, expires_at)
+    return b'+OK'
+
+
+def execute(command, args):
+    with _lock:
+        if command == b'PING':
+            return b'+PONG'
+        if command in (b'AUTH', b'SELECT'):
+            return b'+OK'
+        if command == b'GET':
+            item = _get(args[0])
+            return item[0] if item is not None else None
+        if command == b'SET':
+            return _set(args)
+        if command == b'DEL':
+            return sum(1 for key in args if _data.pop(key, None) is not None)
+        if command == b'EXPIRE':
+            item = _get(args[0])
+            if item is None:
+                return 0
+            _data[args[0]] = (item[0], time.time() + int(args[1]))
+            return 1
+        if command == b'TTL':
+            item = _get(args[0])
+            if item is None:
+                return -2
+            return -1 if item[1] is None else int(item[1] - time.time())
+        if command == b'DBSIZE':
+            return len(_data)
+        if command == b'FLUSHDB':
+            _data.clear()
+            return b'+OK'
+    return b'-ERR unknown command ' + command
+
+
+def encode(reply):
+    if reply is None:
+        return b'$-1\r\n'
+    if isinstance(reply, int):
+        return b':%d\r\n' % reply
+    if reply[:1] in (b'+', b'-'):
+        return reply + b'\r\n'
+    return b'$%d\r\n%s\r\n' % (len(reply), reply)
+
+
+class Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            if not line.startswith(b'*'):
+                # Inline command, e.g. from telnet
+                parts = line.split()
+            else:
+                parts = []
+                for _ in range(int(line[1:])):
+                    length = int(self.rfile.readline()[1:])
+                    parts.append(self.rfile.read(length + 2)[:-2])
+            if not parts:
+                continue
+            reply = execute(parts[0].upper(), parts[1:])
+            # Values stored by clients could start with + or -, send them as
+            # bulk strings
+            if isinstance(reply, bytes) and parts[0].upper() == b'GET':
+                self.wfile.write(b'$%d\r\n%s\r\n' % (len(reply), reply))
+            else:
+                self.wfile.write(encode(reply))
+
+
+class Server(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=6379)
+    args = parser.parse_args()
+
+    with Server((args.host, args.port), Handler) as server:
+        print(f'Listening on {args.host}:{server.server_address[1]}')
+        server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
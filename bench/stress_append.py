@@ -0,0 +1,95 @@
+"""
+Multi-process stress test for concurrent annotation writes.
+
+Several processes, each with several threads, append uniquely keyed
+annotations to the same file through their own AnnotationStore, the way
+gunicorn workers do. Afterwards the file is read back through a fresh store
+and every write must be present. Exits with status 1 if any update was lost.
+
+Usage:
+    python bench/stress_append.py --processes 4 --threads 8 --writes 100 --mode journal
+"""
+import argparse
+import multiprocessing
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import annotation_store  # noqa: E402
+
+
+def _worker(path, mode, process_id, threads, writes, batch, compact_every):
+    annotation_store.COMPACT_MAX_ENTRIES = compact_every
+    store = annotation_store.AnnotationStore(mode)
+
+    def write_many(thread_id):
+        for start in range(0, writes, batch):
+            annotations = [
+                {
+                    'selector': f'div.p{process_id}.t{thread_id}.n{n}',
+                    'label': ['stress'],
+                }
+                for n in range(start, min(start + batch, writes))
+            ]
+            store.upsert(path, annotations)
+
+    workers = [threading.Thread(target=write_many, args=(t,)) for t in range(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--processes', type=int, default=4)
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--writes', type=int, default=50, help='annotations written by each thread')
+    parser.add_argument('--batch', type=int, default=1, help='annotations per upsert call')
+    parser.add_argument('--mode', choices=['rewrite', 'journal'], default='journal')
+    parser.add_argument('--compact-every', type=int, default=25,
+                        help='journal entries between compactions, small values exercise compaction races')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='annotation-stress-')
+    path = os.path.join(directory, 'stress.json')
+
+    started = time.perf_counter()
+    processes = [
+        multiprocessing.Process(
+            target=_worker,
+            args=(path, args.mode, p, args.threads, args.writes, args.batch, args.compact_every),
+        )
+        for p in range(args.processes)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    elapsed = time.perf_counter() - started
+
+    if any(process.exitcode != 0 for process in processes):
+        print('A worker process failed')
+        return 1
+
+    expected = {
+        f'div.p{p}.t{t}.n{n}'
+        for p in range(args.processes)
+        for t in range(args.threads)
+        for n in range(args.writes)
+    }
+    stored = annotation_store.AnnotationStore(args.mode).read(path) or []
+    found = {annotation['selector'] for annotation in stored}
+    lost = expected - found
+
+    print(f'{len(expected)} writes in {elapsed:.2f}s ({len(expected) / elapsed:.0f}/s), '
+          f'{len(found)} stored, {len(lost)} lost, mode={args.mode}')
+    return 1 if lost or len(stored) != len(expected) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,67 @@
+"""
+Stub of the upstream annotation API the proxy routes call.
+
+Answers /get-user-tasks, /create, /append and /get/<name> with fixed JSON,
+so the proxy routes can be benchmarked and load tested offline.
+
+Usage:
+    python bench/stub_upstream.py --port 5055 --boxes 1000
+    API_URL=http://127.0.0.1:5055 gunicorn app:app
+"""
+import argparse
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class StubUpstream(BaseHTTPRequestHandler):
+    """
+    Answers the upstream API calls the proxy routes make, with a bounding
+    box list of boxes entries
+    """
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately, don't wait for an ACK between
+    disable_nagle_algorithm = True
+    boxes = b'[]'
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, body):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self._send(self.boxes)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        if self.path == '/get-user-tasks':
+            self._send(json.dumps({'tasks': [{'id': n, 'filename': f'page{n}.json'} for n in range(20)]}).encode())
+        else:
+            self._send(b'{"status": "success"}')
+
+
+def start(boxes=1000, host='127.0.0.1', port=0):
+    """
+    Serves the stub from a background thread and returns its URL
+    """
+    StubUpstream.boxes = json.dumps({'boxes': [
+        {'selector': f'div.item.i{n}', 'x': n, 'y': n, 'width': 10, 'height': 10} for n in range(boxes)
+    ]}).encode()
+    server = ThreadingHTTPServer((host, port), StubUpstream)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f'http://{host}:{server.server_address[1]}'
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Stub upstream API for the proxy routes')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5055)
+    parser.add_argument('--boxes', type=int, default=1000, help='bounding boxes returned by /get/<name>')
+    args = parser.parse_args()
+    print(f'Stub upstream API on {start(args.boxes, args.host, args.port)}')
+    threading.Event().wait()
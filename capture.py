@@ -0,0 +1,110 @@
+import base64
+import io
+import logging
+import os
+import threading
+import time
+
+import codec
+
+logger = logging.getLogger(__name__)
+
+# Append every request to this JSON Lines file so bench/replay.py can replay
+# the traffic later. Unset (the default) captures nothing
+CAPTURE_FILE = os.environ.get('CAPTURE_FILE')
+# Request bodies larger than this many bytes are captured without the body
+CAPTURE_MAX_BODY = int(os.environ.get('CAPTURE_MAX_BODY', 1024 * 1024))
+# Request headers kept in the capture. Authorization and cookies are left
+# out unless added here, captures shouldn't hold credentials
+CAPTURE_HEADERS = os.environ.get(
+    'CAPTURE_HEADERS', 'Content-Type,Accept,Accept-Encoding,If-None-Match,If-Modified-Since'
+)
+
+
+class CaptureMiddleware:
+    """
+    WSGI middleware appending one JSON line per request to path: start time,
+    method, path with query string, the kept headers, the body, and the
+    response status and duration. Each line is one append-mode write, so
+    workers can share the file.
+    """
+
+    def __init__(self, wsgi_app, path, max_body=CAPTURE_MAX_BODY, headers=CAPTURE_HEADERS):
+        self.wsgi_app = wsgi_app
+        self.path = path
+        self.max_body = max_body
+        self.headers = [name.strip() for name in headers.split(',') if name.strip()]
+        self._fd = None
+        self._fd_pid = None
+        self._fd_lock = threading.Lock()
+
+    def _ensure_fd(self):
+        # Opened lazily in each worker
+        if self._fd_pid == os.getpid():
+            return self._fd
+        with self._fd_lock:
+            if self._fd_pid != os.getpid():
+                self._fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+                self._fd_pid = os.getpid()
+        return self._fd
+
+    def _read_body(self, environ):
+        try:
+            length = int(environ.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            return None
+        if length <= 0 or length > self.max_body:
+            return None
+        body = environ['wsgi.input'].read(length)
+        # Let the app read the body again
+        environ['wsgi.input'] = io.BytesIO(body)
+        return body
+
+    def _request_headers(self, environ):
+        headers = {}
+        for name in self.headers:
+            key = name.upper().replace('-', '_')
+            value = environ.get(key if key in ('CONTENT_TYPE', 'CONTENT_LENGTH') else f'HTTP_{key}')
+            if value:
+                headers[name] = value
+        return headers
+
+    def __call__(self, environ, start_response):
+        started = time.time()
+        start = time.perf_counter()
+        body = self._read_body(environ)
+        query = environ.get('QUERY_STRING')
+        record = {
+            'time': round(started, 6),
+            'method': environ.get('REQUEST_METHOD', 'GET'),
+            'path': environ.get('PATH_INFO', '/') + (f'?{query}' if query else ''),
+            'headers': self._request_headers(environ),
+        }
+        if body is not None:
+            try:
+                record['body'] = body.decode('utf-8')
+            except UnicodeDecodeError:
+                record['body_base64'] = base64.b64encode(body).decode('ascii')
+
+        def capturing_start_response(status, headers, exc_info=None):
+            record['status'] = int(status.split(' ', 1)[0])
+            return start_response(status, headers, exc_info)
+
+        try:
+            return self.wsgi_app(environ, capturing_start_response)
+        finally:
+            # Time to the response, streamed bodies are still being sent
+            record['duration_ms'] = round((time.perf_counter() - start) * 1000, 3)
+            try:
+                os.write(self._ensure_fd(), codec.dumps(record) + b'\n')
+            except OSError as e:
+                # Losing a capture line shouldn't fail the request
+                logger.warning('Could not write to capture file %s: %s', self.path, e)
+
+
+def init_app(app):
+    """
+    Captures app's requests to CAPTURE_FILE when it is set
+    """
+    if CAPTURE_FILE:
+        app.wsgi_app = CaptureMiddleware(app.wsgi_app, CAPTURE_FILE)
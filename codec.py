@@ -0,0 +1,75 @@
+import json
+import os
+
+try:
+    import orjson
+except ImportError:
+    # The stdlib encoder is used instead, just slower
+    orjson = None
+
+import metrics
+
+# "auto" uses orjson when it is installed, "stdlib" always uses json
+JSON_BACKEND = os.environ.get('JSON_BACKEND', 'auto')
+# Indent JSON files written to disk, they are compact by default
+JSON_PRETTY_FILES = os.environ.get('JSON_PRETTY_FILES', 'false').lower() == 'true'
+
+_use_orjson = orjson is not None and JSON_BACKEND != 'stdlib'
+
+
+def backend():
+    """
+    Returns the name of the JSON backend in use
+    """
+    return 'orjson' if _use_orjson else 'stdlib'
+
+
+def dumps(data, pretty=False, sort_keys=False):
+    """
+    Encodes data as UTF-8 JSON bytes, compact unless pretty is set
+    """
+    with metrics.timed('json_encode'):
+        return _dumps(data, pretty, sort_keys)
+
+
+def _dumps(data, pretty, sort_keys):
+    if _use_orjson:
+        option = orjson.OPT_NON_STR_KEYS
+        if pretty:
+            option |= orjson.OPT_INDENT_2
+        if sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        try:
+            return orjson.dumps(data, option=option)
+        except TypeError:
+            # e.g. integers wider than 64 bits, which json handles
+            pass
+    if pretty:
+        return json.dumps(data, indent=2, sort_keys=sort_keys, ensure_ascii=False).encode('utf-8')
+    return json.dumps(data, sort_keys=sort_keys, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+
+def loads(data):
+    """
+    Decodes JSON from bytes or str, raising ValueError if it's invalid
+    """
+    if _use_orjson:
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            # Let json decide and report the error, it accepts a few things
+            # orjson doesn't such as NaN
+            pass
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        data = bytes(data).decode('utf-8')
+    return json.loads(data)
+
+
+def load_file(path):
+    """
+    Reads and decodes the JSON file at path
+    """
+    with metrics.timed('file_read'):
+        with open(path, 'rb') as f:
+            return loads(f.read())
+
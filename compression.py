@@ -0,0 +1,162 @@
+import gzip
+import hashlib
+import os
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    # Responses are gzipped instead, browsers accept both
+    brotli = None
+
+from response_cache import ResponseCache, CachedResponse, CacheTee
+
+# Bodies smaller than this are sent as they are
+COMPRESSION_MIN_SIZE = int(os.environ.get('COMPRESSION_MIN_SIZE', 1024))
+COMPRESSION_GZIP_LEVEL = int(os.environ.get('COMPRESSION_GZIP_LEVEL', 6))
+COMPRESSION_BROTLI_QUALITY = int(os.environ.get('COMPRESSION_BROTLI_QUALITY', 5))
+# Encoded bodies are kept by ETag so unchanged documents are compressed once
+ENCODED_CACHE_TTL = float(os.environ.get('ENCODED_CACHE_TTL', 600))
+ENCODED_CACHE_MAX_ENTRIES = int(os.environ.get('ENCODED_CACHE_MAX_ENTRIES', 256))
+ENCODED_CACHE_MAX_BYTES = int(os.environ.get('ENCODED_CACHE_MAX_BYTES', 32 * 1024 * 1024))
+
+COMPRESSIBLE_MIMETYPES = ('application/json', 'application/x-ndjson', 'application/javascript')
+
+encoded_cache = ResponseCache(
+    ttl=ENCODED_CACHE_TTL,
+    max_entries=ENCODED_CACHE_MAX_ENTRIES,
+    max_bytes=ENCODED_CACHE_MAX_BYTES,
+)
+
+
+def available_encodings():
+    return ('br', 'gzip') if brotli is not None else ('gzip',)
+
+
+def choose_encoding(accept_encodings):
+    """
+    Returns the content coding to use for a request's Accept-Encoding, or
+    None to send the body as it is
+    """
+    best = accept_encodings.best_match(available_encodings())
+    if best is None or accept_encodings[best] == 0:
+        return None
+    return best
+
+
+def compress(body, encoding):
+    if encoding == 'br':
+        return brotli.compress(body, quality=COMPRESSION_BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=COMPRESSION_GZIP_LEVEL)
+
+
+def encoded_body(etag, body, encoding):
+    """
+    Returns body compressed with encoding, reusing the cached copy for etag
+    """
+    key = f'{etag}:{encoding}'
+    cached = encoded_cache.get(key)
+    if cached is None:
+        cached = CachedResponse(compress(body, encoding), etag=etag)
+        encoded_cache.set(key, cached)
+    return cached.body
+
+
+def compress_stream(chunks, encoding):
+    """
+    Compresses an iterable of chunks as it is consumed
+    """
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=COMPRESSION_BROTLI_QUALITY)
+        compress_chunk, finish = compressor.process, compressor.finish
+    else:
+        # wbits=31 writes a gzip header and trailer
+        compressor = zlib.compressobj(COMPRESSION_GZIP_LEVEL, zlib.DEFLATED, 31)
+        compress_chunk, finish = compressor.compress, compressor.flush
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode('utf-8')
+        data = compress_chunk(chunk)
+        if data:
+            yield data
+    yield finish()
+
+
+def _teed(chunks, tee):
+    for chunk in chunks:
+        tee.add(chunk)
+        yield chunk
+    tee.finish()
+
+
+def _close_on_close(response):
+    """
+    Makes closing response also close its current body, before the body is
+    replaced. Werkzeug only closes the body it ends up sending.
+    """
+    if hasattr(response.response, 'close'):
+        response.call_on_close(response.response.close)
+
+
+def representation_etag(etag, encoding):
+    # Each encoding of a document is a different representation, so it gets
+    # its own strong validator
+    return f'{etag}-{encoding}' if encoding else etag
+
+
+def compress_response(request, response):
+    """
+    Adds a strong ETag to large JSON responses, answers matching
+    If-None-Match headers with 304 and compresses the body for clients that
+    accept gzip or brotli.
+
+    Routes can set an ETag derived from the file they serve, otherwise it is
+    a hash of the body. Streamed responses are only validated when the route
+    set an ETag, and are compressed as they are sent.
+    """
+    if (request.method != 'GET' or response.status_code != 200 or response.direct_passthrough
+            or 'Content-Encoding' in response.headers or response.mimetype not in COMPRESSIBLE_MIMETYPES):
+        return response
+
+    etag, _ = response.get_etag()
+    if not response.is_streamed:
+        body = response.get_data()
+        if etag is None:
+            etag = hashlib.sha1(body).hexdigest()
+        if len(body) < COMPRESSION_MIN_SIZE:
+            encoding = None
+        else:
+            encoding = choose_encoding(request.accept_encodings)
+    else:
+        encoding = choose_encoding(request.accept_encodings)
+
+    response.vary.add('Accept-Encoding')
+    if etag is not None:
+        response.set_etag(representation_etag(etag, encoding))
+        if request.if_none_match.contains(representation_etag(etag, encoding)):
+            # The client has this representation, skip building the body
+            response.status_code = 304
+            _close_on_close(response)
+            response.response = []
+            response.headers.pop('Content-Length', None)
+            return response
+    if encoding is None:
+        return response
+
+    if not response.is_streamed:
+        response.set_data(encoded_body(etag, body, encoding))
+    else:
+        key = f'{etag}:{encoding}' if etag is not None else None
+        cached = encoded_cache.get(key) if key is not None else None
+        _close_on_close(response)
+        if cached is not None:
+            response.set_data(cached.body)
+        else:
+            chunks = compress_stream(response.response, encoding)
+            if key is not None:
+                # Keep the encoded body for the next request if it's small enough
+                chunks = _teed(chunks, CacheTee(encoded_cache, key, encoded_cache.generation(key)))
+            response.response = chunks
+            response.headers.pop('Content-Length', None)
+    response.headers['Content-Encoding'] = encoding
+    return response
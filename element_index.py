@@ -0,0 +1,129 @@
+import os
+import threading
+from bisect import bisect_left, bisect_right
+
+try:
+    import numpy as np
+except ImportError:
+    # Sorting falls back to the stdlib, which is fine for smaller pages
+    np = None
+
+import codec
+
+ELEMENTS_FILE = 'elements.json'
+# Area-sorted copy written by older versions, used when elements.json is gone
+LEGACY_SORTED_ELEMENTS_FILE = 'sorted_elements.json'
+
+
+def _stable_order(areas, descending):
+    """
+    Returns the indexes that sort areas, keeping equal areas in document
+    order like sorted() does
+    """
+    if np is not None:
+        values = np.asarray(areas)
+        return np.argsort(-values if descending else values, kind='stable').tolist()
+    return sorted(range(len(areas)), key=areas.__getitem__, reverse=descending)
+
+
+class ElementSnapshot:
+    """
+    Immutable view of one version of the elements file with every order
+    /api/elements can serve precomputed
+    """
+
+    def __init__(self, elements, signature=None):
+        # Multiplied in Python so each area keeps its element's types, numpy
+        # would make every area a float when any size is
+        areas = [element.get('width', 0) * element.get('height', 0) for element in elements]
+
+        for element, area in zip(elements, areas):
+            element['area'] = area
+
+        self.document = elements
+        # (path, mtime_ns, size) of the file this snapshot was read from
+        self.signature = signature
+        self.by_selector = {element.get('selector'): element for element in elements}
+
+        desc = _stable_order(areas, descending=True)
+        asc = _stable_order(areas, descending=False)
+        self.area_desc = [elements[i] for i in desc]
+        self.area_asc = [elements[i] for i in asc]
+        # Sorted keys for bisecting area ranges in either order
+        self._asc_areas = [areas[i] for i in asc]
+        self._desc_negated_areas = [-areas[i] for i in desc]
+
+    def __len__(self):
+        return len(self.document)
+
+    def ordered(self, sort):
+        if sort == 'area_asc':
+            return self.area_asc
+        if sort == 'document':
+            return self.document
+        return self.area_desc
+
+    def area_range(self, sort, min_area=None, max_area=None):
+        """
+        Returns the elements in sort order whose area is within the bounds,
+        using a binary search for the area orders
+        """
+        if sort == 'area_asc':
+            start = 0 if min_area is None else bisect_left(self._asc_areas, min_area)
+            end = len(self._asc_areas) if max_area is None else bisect_right(self._asc_areas, max_area)
+            return self.area_asc[start:end]
+        if sort == 'area_desc':
+            negated = self._desc_negated_areas
+            start = 0 if max_area is None else bisect_left(negated, -max_area)
+            end = len(negated) if min_area is None else bisect_right(negated, -min_area)
+            return self.area_desc[start:end]
+        return [
+            element for element in self.document
+            if (min_area is None or element['area'] >= min_area)
+            and (max_area is None or element['area'] <= max_area)
+        ]
+
+
+class ElementIndex:
+    """
+    Keeps the parsed and sorted elements file in memory, rebuilding it only
+    when the file's mtime or size changes
+    """
+
+    def __init__(self, directory='.'):
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._signature = None
+        self._snapshot = None
+
+    def _source(self):
+        for name in (ELEMENTS_FILE, LEGACY_SORTED_ELEMENTS_FILE):
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            return path, (path, stat.st_mtime_ns, stat.st_size)
+        return None, None
+
+    def snapshot(self):
+        """
+        Returns the current ElementSnapshot, or None if there is no elements
+        file
+        """
+        path, signature = self._source()
+        if signature is not None and signature == self._signature:
+            return self._snapshot
+
+        with self._lock:
+            if signature != self._signature:
+                if path is None:
+                    snapshot = None
+                else:
+                    snapshot = ElementSnapshot(codec.load_file(path), signature)
+                self._snapshot, self._signature = snapshot, signature
+            return self._snapshot
+
+
+# Shared index of the elements file in the working directory
+element_index = ElementIndex()
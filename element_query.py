@@ -0,0 +1,157 @@
+import base64
+import hashlib
+import json
+
+import codec
+
+# Sort orders accepted by /api/elements, the first one is the default
+SORT_ORDERS = ('area_desc', 'area_asc', 'document')
+# Elements serialized per chunk of a streamed response
+STREAM_CHUNK_SIZE = 500
+
+
+class QueryError(ValueError):
+    """
+    Raised for invalid /api/elements query parameters
+    """
+
+
+class StaleCursorError(QueryError):
+    """
+    Raised for a cursor issued before elements.json last changed
+    """
+
+
+def _version(snapshot):
+    # Short hash of the elements file a cursor's offset refers to
+    key = json.dumps(list(snapshot.signature or ()))
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()[:12]
+
+
+def _float_arg(args, name):
+    value = args.get(name)
+    if value is None or value == '':
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        raise QueryError(f'{name} must be a number')
+
+
+class ElementQuery:
+    """
+    Filters, sort order and page requested from /api/elements
+    """
+
+    def __init__(self, args):
+        self.tag = (args.get('tag') or '').lower() or None
+        self.class_name = args.get('class') or None
+        self.min_area = _float_arg(args, 'min_area')
+        self.max_area = _float_arg(args, 'max_area')
+
+        self.sort = args.get('sort') or SORT_ORDERS[0]
+        if self.sort not in SORT_ORDERS:
+            raise QueryError(f"sort must be one of: {', '.join(SORT_ORDERS)}")
+
+        self.limit = None
+        if args.get('limit'):
+            try:
+                self.limit = int(args.get('limit'))
+            except ValueError:
+                raise QueryError('limit must be an integer')
+            if self.limit < 1:
+                raise QueryError('limit must be positive')
+
+        self.offset = 0
+        # Version of the elements file the cursor was issued for
+        self.version = None
+        if args.get('cursor'):
+            self.offset, self.version = self._decode_cursor(args.get('cursor'))
+
+    def fingerprint(self):
+        """
+        Identifies the filters and order, so a cursor can't be reused with a
+        different query
+        """
+        key = json.dumps([self.tag, self.class_name, self.min_area, self.max_area, self.sort])
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()[:12]
+
+    def etag(self, snapshot, variant=''):
+        """
+        Returns a strong validator for this page of snapshot, which changes
+        whenever the elements file does
+        """
+        key = json.dumps([list(snapshot.signature or ()), self.fingerprint(), self.offset, self.limit, variant])
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+    def _decode_cursor(self, cursor):
+        try:
+            padded = cursor + '=' * (-len(cursor) % 4)
+            state = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+            offset = int(state['o'])
+            fingerprint = state['q']
+            version = state['v']
+        except (ValueError, KeyError, TypeError):
+            raise QueryError('Invalid cursor')
+        if fingerprint != self.fingerprint() or offset < 0:
+            raise QueryError('Cursor does not match this query')
+        return offset, version
+
+    def encode_cursor(self, offset, snapshot):
+        state = json.dumps({'o': offset, 'q': self.fingerprint(), 'v': _version(snapshot)}, separators=(',', ':'))
+        return base64.urlsafe_b64encode(state.encode('utf-8')).decode('ascii').rstrip('=')
+
+    def matches(self, element):
+        """
+        Checks the tag and class filters, area bounds are applied by the
+        snapshot
+        """
+        if self.tag is not None and (element.get('tag') or '').lower() != self.tag:
+            return False
+        if self.class_name is not None and self.class_name not in (element.get('class') or '').split():
+            return False
+        return True
+
+    def run(self, snapshot):
+        """
+        Applies the query to an ElementSnapshot. Returns (page, total,
+        next_cursor) where next_cursor is None on the last page.
+
+        Raises StaleCursorError if the elements changed since the cursor was
+        issued, its offset would skip or repeat elements.
+        """
+        if self.version is not None and self.version != _version(snapshot):
+            raise StaleCursorError('Cursor is stale, the elements changed since it was issued')
+
+        if self.min_area is not None or self.max_area is not None:
+            elements = snapshot.area_range(self.sort, self.min_area, self.max_area)
+        else:
+            elements = snapshot.ordered(self.sort)
+
+        if self.tag is not None or self.class_name is not None:
+            elements = [element for element in elements if self.matches(element)]
+
+        total = len(elements)
+        end = total if self.limit is None else min(self.offset + self.limit, total)
+        page = elements[self.offset:end]
+        next_cursor = self.encode_cursor(end, snapshot) if end < total else None
+        return page, total, next_cursor
+
+
+def stream_json_array(items):
+    """
+    Yields items as a JSON array, a chunk of elements at a time
+    """
+    yield b'['
+    for start in range(0, len(items), STREAM_CHUNK_SIZE):
+        chunk = b','.join(codec.dumps(item) for item in items[start:start + STREAM_CHUNK_SIZE])
+        yield chunk if start == 0 else b',' + chunk
+    yield b']'
+
+
+def stream_ndjson(items):
+    """
+    Yields items as newline-delimited JSON, a chunk of elements at a time
+    """
+    for start in range(0, len(items), STREAM_CHUNK_SIZE):
+        yield b''.join(codec.dumps(item) + b'\n' for item in items[start:start + STREAM_CHUNK_SIZE])
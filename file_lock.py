@@ -0,0 +1,98 @@
+import os
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows, fall back to in-process locking only
+    fcntl = None
+
+LOCK_SUFFIX = '.lock'
+
+
+class FileLock:
+    """
+    Lock for a single data file, held across threads of this process and,
+    where fcntl is available, across worker processes.
+
+    The advisory lock is taken on a separate <file>.lock file because data
+    files are replaced by rename, which would orphan a lock held on them.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._mutex = threading.Lock()
+        self._fd = None
+        # Callers holding or waiting for the lock, guarded by _registry_lock
+        self._users = 0
+
+    def acquire(self, shared=False):
+        self._mutex.acquire()
+        if fcntl is None:
+            return
+        try:
+            # Opened per acquire so idle locks don't hold a descriptor, and
+            # so a descriptor inherited over fork never shares its lock
+            self._fd = os.open(self.path + LOCK_SUFFIX, os.O_RDWR | os.O_CREAT, 0o644)
+            fcntl.flock(self._fd, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        except BaseException:
+            self._close()
+            self._mutex.release()
+            raise
+
+    def _close(self):
+        if self._fd is not None:
+            # Closing the descriptor also drops the flock
+            os.close(self._fd)
+            self._fd = None
+
+    def release(self):
+        try:
+            self._close()
+        finally:
+            self._mutex.release()
+
+
+_registry_lock = threading.Lock()
+_locks = {}
+
+
+def _checkout(path):
+    """
+    Returns the FileLock shared by every caller locking path in this process.
+    Locks are dropped from the registry once nobody holds or waits for them,
+    so it only grows with the files in use.
+    """
+    path = os.path.abspath(path)
+    with _registry_lock:
+        lock = _locks.get(path)
+        if lock is None:
+            lock = _locks[path] = FileLock(path)
+        lock._users += 1
+        return lock
+
+
+def _checkin(lock):
+    with _registry_lock:
+        lock._users -= 1
+        if not lock._users:
+            _locks.pop(lock.path, None)
+
+
+@contextmanager
+def locked(path, shared=False):
+    """
+    Holds the lock for path for the duration of the with block. Shared locks
+    only exclude writers in other processes; within a process access to a
+    file is always serialized.
+    """
+    lock = _checkout(path)
+    try:
+        lock.acquire(shared=shared)
+        try:
+            yield
+        finally:
+            lock.release()
+    finally:
+        _checkin(lock)
@@ -0,0 +1,51 @@
+# Read by gunicorn from the working directory, so `gunicorn app:app` in the
+# Procfile and render.yaml picks it up. Workers and bind address still come
+# from WEB_CONCURRENCY and PORT as gunicorn's defaults.
+import gc
+import os
+import time
+
+from dotenv import load_dotenv
+
+# Before the app is imported, so every module's settings see .env
+if os.path.exists('.env'):
+    load_dotenv()
+
+# Build the app once in the master and fork workers from it, see warmup.py
+preload_app = os.environ.get('GUNICORN_PRELOAD', 'true').lower() == 'true'
+
+
+def on_starting(server):
+    import metrics
+
+    # Counters of the previous run's workers would be added to this run's
+    metrics.clear_worker_files()
+
+
+def when_ready(server):
+    if not preload_app:
+        return
+    import warmup
+    from main import get_app
+
+    warmup.preload(get_app())
+    # Keep the garbage collector from writing to objects the workers share
+    # with the master, which would copy their memory pages
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    import metrics
+
+    worker.boot_started = time.perf_counter()
+    # Otherwise what the master recorded is counted once per worker
+    metrics.reset()
+
+
+def post_worker_init(worker):
+    import warmup
+    from main import get_app
+
+    if not preload_app:
+        warmup.preload(get_app())
+    warmup.warm_worker(worker.boot_started)
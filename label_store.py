@@ -0,0 +1,173 @@
+import atexit
+import datetime
+import logging
+import os
+import threading
+
+import codec
+import file_lock
+from annotation_store import atomic_write_json
+from element_index import element_index
+
+logger = logging.getLogger(__name__)
+
+LABELS_FILE = 'labels.json'
+DETAILED_LABELS_FILE = 'detailed_labels.json'
+# Seconds to wait after a save before rewriting detailed_labels.json, so a
+# burst of saves produces one write
+DETAILED_LABELS_DEBOUNCE = float(os.environ.get('DETAILED_LABELS_DEBOUNCE', 5))
+
+# Fields a label adds on top of its element's data
+LABEL_FIELDS = ('selector', 'label', 'timestamp')
+
+
+class LabelStore:
+    """
+    Labels keyed by selector, persisted once to labels.json.
+
+    Labels for known elements are stored compactly as selector, label and
+    timestamp, and merged with the element's data from the element index
+    when read. Labels for unknown elements keep the data they were sent with.
+    detailed_labels.json, the merged view older clients read, is rewritten
+    on a debounce instead of on every save.
+    """
+
+    def __init__(self, labels_file=LABELS_FILE, detailed_file=DETAILED_LABELS_FILE, elements=element_index,
+                 debounce=DETAILED_LABELS_DEBOUNCE):
+        self.labels_file = labels_file
+        self.detailed_file = detailed_file
+        self.elements = elements
+        self.debounce = debounce
+        self._labels = {}
+        self._signature = None
+        self._version = 0
+        self._merged = None
+        self._merged_key = None
+        self._timer = None
+        self._timer_lock = threading.Lock()
+        atexit.register(self.flush)
+
+    @staticmethod
+    def _stat(path):
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return (path, stat.st_mtime_ns, stat.st_size)
+
+    def _refresh(self):
+        """
+        Reloads labels if labels.json changed since it was read, e.g. by
+        another worker. Must be called with the labels lock held.
+        """
+        signature = self._stat(self.labels_file)
+        if signature is None:
+            # Deployments that only kept the detailed file
+            signature = self._stat(self.detailed_file)
+        if signature == self._signature:
+            return
+
+        labels = []
+        if signature is not None:
+            try:
+                labels = codec.load_file(signature[0])
+                logger.info('Loaded %d existing labels from %s', len(labels), os.path.basename(signature[0]))
+            except ValueError:
+                logger.error('%s exists but contains invalid JSON', os.path.basename(signature[0]))
+
+        self._labels = {label.get('selector'): label for label in labels}
+        self._signature = signature
+        self._version += 1
+
+    def _compact(self, label, elements_data):
+        # Element data is already in the element index, don't copy it
+        if label.get('selector') in elements_data:
+            return {field: label[field] for field in LABEL_FIELDS if field in label}
+        return label
+
+    def _merged_view(self):
+        snapshot = self.elements.snapshot()
+        key = (self._version, id(snapshot))
+        if self._merged_key != key:
+            elements_data = snapshot.by_selector if snapshot is not None else {}
+            merged = []
+            for selector, label in self._labels.items():
+                element = elements_data.get(selector)
+                merged.append({**element, **label} if element is not None else label)
+            self._merged, self._merged_key = merged, key
+        return self._merged
+
+    def labels(self):
+        """
+        Returns every label merged with its element's data
+        """
+        with file_lock.locked(self.labels_file, shared=True):
+            self._refresh()
+            return self._merged_view()
+
+    def save(self, new_labels):
+        """
+        Adds or updates labels by selector and persists them once.
+        Returns (total, updated, added).
+        """
+        snapshot = self.elements.snapshot()
+        elements_data = snapshot.by_selector if snapshot is not None else {}
+
+        # Hold the labels lock for the whole read-modify-write so concurrent
+        # saves from other threads or workers don't overwrite each other
+        with file_lock.locked(self.labels_file):
+            self._refresh()
+
+            updated_count = 0
+            added_count = 0
+            for new_label in new_labels:
+                selector = new_label.get('selector')
+                timestamp = new_label.get('timestamp', datetime.datetime.now().isoformat())
+
+                existing = self._labels.get(selector)
+                if existing is not None:
+                    # Update existing label
+                    self._labels[selector] = dict(existing, label=new_label.get('label'), timestamp=timestamp)
+                    updated_count += 1
+                elif selector in elements_data:
+                    # Element data is merged in when reading
+                    self._labels[selector] = {'selector': selector, 'label': new_label.get('label'),
+                                              'timestamp': timestamp}
+                    added_count += 1
+                else:
+                    # If no element data, just use the label data
+                    self._labels[selector] = new_label.copy()
+                    added_count += 1
+
+            atomic_write_json(self.labels_file, [self._compact(label, elements_data)
+                                                 for label in self._labels.values()])
+            self._signature = self._stat(self.labels_file)
+            self._version += 1
+
+        self._schedule_detailed_write()
+        return len(self._labels), updated_count, added_count
+
+    def _schedule_detailed_write(self):
+        with self._timer_lock:
+            if self._timer is not None:
+                return
+            self._timer = threading.Timer(self.debounce, self.flush)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def flush(self):
+        """
+        Writes detailed_labels.json now if a save is waiting for it
+        """
+        with self._timer_lock:
+            if self._timer is None:
+                return
+            self._timer.cancel()
+            self._timer = None
+        with file_lock.locked(self.labels_file):
+            self._refresh()
+            atomic_write_json(self.detailed_file, self._merged_view())
+
+
+# Shared store used by the Flask routes
+label_store = LabelStore()
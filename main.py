@@ -1,14 +1,30 @@
-import json
 import os
 import datetime
+import logging
 import hashlib
 import secrets
 import requests
-from flask import Flask, jsonify, request, send_from_directory, session
-from bson.objectid import ObjectId
+from flask import Blueprint, Flask, current_app, jsonify, request, send_from_directory, session
 from flask_cors import CORS
-from flask_session import Session
-from db import get_db
+import app_logging
+import capture
+import metrics
+import session_store
+from storage import storage
+from annotation_store import store as annotation_store
+from annotation_batch import apply_batch, BatchError
+from normalize import normalize_annotations, NormalizationError, DEFAULT_COLOR
+from upstream import client as upstream_client, UpstreamBusy
+from response_cache import bounding_box_cache, CachedResponse, CacheTee
+from element_index import element_index
+from compression import compress_response
+from label_store import label_store
+from element_query import ElementQuery, QueryError, StaleCursorError, stream_json_array, stream_ndjson
+from proxy_requests import (append_filename, bounding_box_filename, streamed_headers,
+                            streaming_requested, upstream_body, log_upstream_body, log_upstream_response,
+                            PROXY_STREAM_CHUNK_SIZE)
+from single_flight import proxy_flights
+from auth import authenticate, AuthenticationError, token_cache, token_from_request
 from urllib.parse import urlparse
 from dotenv import load_dotenv
 
@@ -16,38 +32,16 @@ from dotenv import load_dotenv
 if os.path.exists('.env'):
     load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 # Get API URL from environment variable or use default
 API_URL = os.environ.get('API_URL', 'http://localhost:5000')
 
-# Initialize Flask app
-app = Flask(__name__, static_folder='public')
-
-# Full CORS configuration for all origins, methods, and headers
-CORS(app,
-     resources={r"/*": {"origins": "*"}},
-     supports_credentials=True,
-     allow_headers=["Content-Type", "Authorization", "X-Requested-With", "Accept", "Origin", "Access-Control-Request-Method", "Access-Control-Request-Headers"],
-     methods=["GET", "POST", "PUT", "DELETE", "OPTIONS", "PATCH"],
-     expose_headers=["Content-Type", "Authorization"])
-
-# Configure session with settings that work for cross-origin requests
-app.secret_key = secrets.token_hex(16)  # Generate a random secret key
-app.config['SESSION_TYPE'] = 'filesystem'
-app.config['SESSION_COOKIE_HTTPONLY'] = True
-app.config['SESSION_COOKIE_SAMESITE'] = None  # None is required for cross-origin requests
-app.config['SESSION_COOKIE_SECURE'] = False  # Set to True in production with HTTPS
-app.config['SESSION_COOKIE_PATH'] = '/'
-app.config['SESSION_COOKIE_DOMAIN'] = None  # Allow the browser to set the cookie domain
-app.config['SESSION_PERMANENT'] = True  # Make session permanent
-app.config['SESSION_USE_SIGNER'] = True
-app.config['PERMANENT_SESSION_LIFETIME'] = datetime.timedelta(days=7)  # Session lasts for 7 days
-app.config['SESSION_FILE_DIR'] = os.path.join(os.getcwd(), 'flask_session')
-
-# Initialize Flask-Session
-Session(app)
+# Routes, registered on the app by create_app()
+api = Blueprint('api', __name__)
 
 # Add CORS headers to all responses
-@app.after_request
+@api.after_app_request
 def after_request(response):
     response.headers.add('Access-Control-Allow-Origin', '*')
     response.headers.add('Access-Control-Allow-Headers', 'Content-Type,Authorization,X-Requested-With,Accept,Origin,Access-Control-Request-Method,Access-Control-Request-Headers')
@@ -55,188 +49,118 @@ def after_request(response):
     response.headers.add('Access-Control-Allow-Credentials', 'true')
     return response
 
+# Compress large JSON responses and answer conditional GETs with 304
+@api.after_app_request
+def compress(response):
+    return compress_response(request, response)
+
 # Global OPTIONS route handler for CORS preflight requests
-@app.route('/', defaults={'path': ''}, methods=['OPTIONS'])
-@app.route('/<path:path>', methods=['OPTIONS'])
+@api.route('/', defaults={'path': ''}, methods=['OPTIONS'])
+@api.route('/<path:path>', methods=['OPTIONS'])
 def options_handler(path):
-    response = app.make_default_options_response()
+    response = current_app.make_default_options_response()
     response.headers.add('Access-Control-Allow-Origin', '*')
     response.headers.add('Access-Control-Allow-Headers', 'Content-Type,Authorization,X-Requested-With,Accept,Origin,Access-Control-Request-Method,Access-Control-Request-Headers')
     response.headers.add('Access-Control-Allow-Methods', 'GET,POST,PUT,DELETE,OPTIONS,PATCH')
     response.headers.add('Access-Control-Allow-Credentials', 'true')
     return response
 
-# Path for storing labels
-LABELS_FILE = 'labels.json'
-DETAILED_LABELS_FILE = 'detailed_labels.json'
-
-# Sort elements by area (smallest to largest)
-def sort_elements_by_area(elements, reverse=False):
-    # Add area to each element
-    for element in elements:
-        element["area"] = element["width"] * element["height"]
-
-    # Sort elements by area
-    return sorted(elements, key=lambda el: el["area"], reverse=reverse)
-
 # API Routes
-@app.route('/api/elements', methods=['GET'])
+@api.route('/api/elements', methods=['GET'])
 def get_elements():
     try:
-        # Check if sorted_elements.json exists, if not create it
-        if not os.path.exists('sorted_elements.json'):
-            if os.path.exists('elements.json'):
-                with open('elements.json', 'r') as f:
-                    elements = json.load(f)
-
-                # Sort elements by area (largest to smallest by default)
-                sorted_elements = sort_elements_by_area(elements, reverse=True)
-
-                with open('sorted_elements.json', 'w') as f:
-                    json.dump(sorted_elements, f, indent=2)
-            else:
-                return jsonify({'error': 'No elements found'}), 404
-
-        # Read sorted elements
-        with open('sorted_elements.json', 'r') as f:
-            elements = json.load(f)
-
-        return jsonify(elements)
+        # Filters, sort order and page requested by the client
+        query = ElementQuery(request.args)
+
+        # Parsed and sorted elements, rebuilt only when elements.json changes
+        snapshot = element_index.snapshot()
+        if snapshot is None:
+            return jsonify({'error': 'No elements found'}), 404
+
+        # Filter, sort and page on the server so clients only download
+        # what they show
+        page, total, next_cursor = query.run(snapshot)
+
+        # Stream the page instead of building one large response body
+        ndjson = request.args.get('format') == 'ndjson' or \
+            request.accept_mimetypes.best == 'application/x-ndjson'
+        if ndjson:
+            response = current_app.response_class(stream_ndjson(page), mimetype='application/x-ndjson')
+        else:
+            response = current_app.response_class(stream_json_array(page), mimetype='application/json')
+        # Lets clients revalidate without the page being rebuilt
+        response.set_etag(query.etag(snapshot, 'ndjson' if ndjson else 'json'))
+        response.headers['X-Total-Count'] = str(total)
+        if next_cursor:
+            response.headers['X-Next-Cursor'] = next_cursor
+        return response
+    except StaleCursorError as e:
+        # The client has to start again from the first page
+        return jsonify({'error': str(e)}), 410
+    except QueryError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
-@app.route('/api/get-labels', methods=['GET'])
+@api.route('/api/get-labels', methods=['GET'])
 def get_labels():
     try:
-        print('GET /api/get-labels - Request received')
-        # Prefer detailed labels file if it exists
-        if os.path.exists(DETAILED_LABELS_FILE):
-            try:
-                with open(DETAILED_LABELS_FILE, 'r') as f:
-                    labels = json.load(f)
-                print(f'Returning {len(labels)} labels from detailed_labels.json')
-                return jsonify(labels)
-            except json.JSONDecodeError:
-                # If file is empty or invalid JSON
-                print('Error: detailed_labels.json exists but contains invalid JSON')
-                pass
-
-        # Fall back to original labels file
-        if os.path.exists(LABELS_FILE):
-            with open(LABELS_FILE, 'r') as f:
-                labels = json.load(f)
-            print(f'Returning {len(labels)} labels from labels.json')
-            return jsonify(labels)
-
-        # Return empty array if no files exist
-        print('No label files found, returning empty array')
-        return jsonify([])
+        # Served from memory, merged with element data from the element index
+        labels = label_store.labels()
+        logger.debug('Returning %d labels', len(labels))
+        return jsonify(labels)
     except Exception as e:
-        print(f'Error in get_labels: {str(e)}')
+        logger.exception('Error in get_labels: %s', e)
         return jsonify({'error': str(e)}), 500
 
-@app.route('/api/save-labels', methods=['POST'])
+@api.route('/api/save-labels', methods=['POST'])
 def save_labels():
     try:
         labels = request.json
-        print(f'POST /api/save-labels - Received {len(labels)} labels')
-
-        # Load sorted_elements.json to get complete element data
-        elements_data = {}
-        if os.path.exists('sorted_elements.json'):
-            try:
-                with open('sorted_elements.json', 'r') as f:
-                    elements = json.load(f)
-                    # Create a map of selectors to element data
-                    for element in elements:
-                        elements_data[element.get('selector')] = element
-                print(f'Loaded {len(elements_data)} elements from sorted_elements.json')
-            except json.JSONDecodeError:
-                print('Error: sorted_elements.json exists but contains invalid JSON')
-
-        # Save to labels file
-        # If file exists, read it first and append/update
-        existing_labels = []
-        if os.path.exists(LABELS_FILE):
-            try:
-                with open(LABELS_FILE, 'r') as f:
-                    existing_labels = json.load(f)
-                print(f'Loaded {len(existing_labels)} existing labels from labels.json')
-            except json.JSONDecodeError:
-                print('Error: labels.json exists but contains invalid JSON')
-                existing_labels = []
-
-        # Create a map of selectors to existing labels for faster lookup
-        selector_to_label = {}
-        for label in existing_labels:
-            selector_to_label[label.get('selector')] = label
-
-        # Process each new label
-        updated_count = 0
-        added_count = 0
-        for new_label in labels:
-            selector = new_label.get('selector')
-
-            # Create a complete label object with all element data
-            complete_label = {}
-
-            # If we have element data for this selector, use it as a base
-            if selector in elements_data:
-                # Start with all element data
-                complete_label = elements_data[selector].copy()
-                # Add the label property
-                complete_label['label'] = new_label.get('label')
-                # Add timestamp
-                complete_label['timestamp'] = new_label.get('timestamp', datetime.datetime.now().isoformat())
-            else:
-                # If no element data, just use the label data
-                complete_label = new_label.copy()
-
-            # Check if this element is already labeled
-            if selector in selector_to_label:
-                # Update existing label
-                selector_to_label[selector]['label'] = complete_label['label']
-                selector_to_label[selector]['timestamp'] = complete_label['timestamp']
-                updated_count += 1
-            else:
-                # Add new label
-                existing_labels.append(complete_label)
-                selector_to_label[selector] = complete_label
-                added_count += 1
-
-        print(f'Updated {updated_count} labels, added {added_count} new labels')
-
-        # Save updated labels
-        with open(LABELS_FILE, 'w') as f:
-            json.dump(existing_labels, f, indent=2)
-
-        # Also save to detailed_labels.json for backward compatibility
-        with open(DETAILED_LABELS_FILE, 'w') as f:
-            json.dump(existing_labels, f, indent=2)
-
-        print(f'Saved {len(existing_labels)} total labels to disk')
+        logger.debug('Received %d labels', len(labels))
+
+        # Persist to labels.json once, detailed_labels.json follows on a debounce
+        total, updated_count, added_count = label_store.save(labels)
+
+        logger.info('Updated %d labels, added %d new labels, %d in total', updated_count, added_count, total)
         return jsonify({
             'success': True,
             'message': 'Labels saved successfully',
-            'count': len(existing_labels),
+            'count': total,
             'updated': updated_count,
             'added': added_count
         })
     except Exception as e:
-        print(f'Error in save_labels: {str(e)}')
+        logger.exception('Error in save_labels: %s', e)
         return jsonify({'error': str(e)}), 500
 
 # Serve static files
-@app.route('/<path:path>')
+@api.route('/<path:path>')
 def serve_static(path):
     return send_from_directory('public', path)
 
-@app.route('/')
+@api.route('/')
 def index():
-    return send_from_directory('public', 'index.html')
+    if os.path.exists(os.path.join(current_app.static_folder, 'index.html')):
+        return send_from_directory('public', 'index.html')
+    # Without a frontend build, answer with the status app.py used to serve
+    return jsonify({
+        "message": "API is running",
+        "status": "ok",
+        "version": "1.0.0",
+        "endpoints": [
+            "/login",
+            "/logout",
+            "/user",
+            "/proxy/get-user-tasks",
+            "/proxy/create",
+            "/proxy/append",
+            "/proxy/get-bounding-boxes"
+        ]
+    })
 
 # Non-prefixed route handlers that redirect to the API routes
-@app.route('/login', methods=['POST', 'OPTIONS', 'GET'])
+@api.route('/login', methods=['POST', 'OPTIONS', 'GET'])
 def login_redirect():
     if request.method == 'OPTIONS':
         # Handle preflight request
@@ -253,7 +177,7 @@ def login_redirect():
     # Forward the request to the API login route
     return login()
 
-@app.route('/logout', methods=['POST', 'OPTIONS', 'GET'])
+@api.route('/logout', methods=['POST', 'OPTIONS', 'GET'])
 def logout_redirect():
     if request.method == 'OPTIONS':
         # Handle preflight request
@@ -270,7 +194,7 @@ def logout_redirect():
     # Forward the request to the API logout route
     return logout()
 
-@app.route('/user', methods=['GET', 'OPTIONS'])
+@api.route('/user', methods=['GET', 'OPTIONS'])
 def user_redirect():
     if request.method == 'OPTIONS':
         # Handle preflight request
@@ -283,7 +207,7 @@ def user_redirect():
     # Forward the request to the API user route
     return get_user()
 
-@app.route('/proxy/get-user-tasks', methods=['POST', 'OPTIONS'])
+@api.route('/proxy/get-user-tasks', methods=['POST', 'OPTIONS'])
 def proxy_tasks_redirect():
     if request.method == 'OPTIONS':
         # Handle preflight request
@@ -296,7 +220,7 @@ def proxy_tasks_redirect():
     # Forward the request to the API proxy route
     return proxy_get_user_tasks()
 
-@app.route('/proxy/create', methods=['POST', 'OPTIONS'])
+@api.route('/proxy/create', methods=['POST', 'OPTIONS'])
 def proxy_create_redirect():
     if request.method == 'OPTIONS':
         # Handle preflight request
@@ -309,7 +233,7 @@ def proxy_create_redirect():
     # Forward the request to the API route
     return proxy_create_annotation()
 
-@app.route('/proxy/get-bounding-boxes', methods=['GET', 'OPTIONS'])
+@api.route('/proxy/get-bounding-boxes', methods=['GET', 'OPTIONS'])
 def proxy_get_bounding_boxes_redirect():
     if request.method == 'OPTIONS':
         # Handle preflight request
@@ -322,7 +246,7 @@ def proxy_get_bounding_boxes_redirect():
     # Forward the request to the API route
     return proxy_get_bounding_boxes()
 
-@app.route('/proxy/append', methods=['POST', 'OPTIONS'])
+@api.route('/proxy/append', methods=['POST', 'OPTIONS'])
 def proxy_append_redirect():
     if request.method == 'OPTIONS':
         # Handle preflight request
@@ -335,7 +259,7 @@ def proxy_append_redirect():
     # Forward the request to the API route
     return proxy_append_annotation()
 
-@app.route("/api/save-annotation", methods=["POST", "GET"])
+@api.route("/api/save-annotation", methods=["POST", "GET"])
 def save_json():
     filename = request.args.get("file")
     if not filename or not filename.endswith(".json"):
@@ -346,12 +270,8 @@ def save_json():
     # GET method to retrieve the annotation data
     if request.method == "GET":
         try:
-            if os.path.exists(path):
-                with open(path, "r", encoding="utf-8") as f:
-                    data = json.load(f)
-                return jsonify(data)
-            else:
-                return jsonify([])
+            data = annotation_store.read(path)
+            return jsonify(data if data is not None else [])
         except Exception as e:
             return jsonify({"error": str(e)}), 500
 
@@ -359,13 +279,12 @@ def save_json():
     data = request.get_json()
 
     try:
-        with open(path, "w", encoding="utf-8") as f:
-            json.dump(data, f, indent=2)
+        annotation_store.replace(path, data)
         return jsonify({"status": "success"})
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
-@app.route("/api/append", methods=["POST"])
+@api.route("/api/append", methods=["POST"])
 def append_annotation():
     try:
         data = request.get_json()
@@ -384,74 +303,20 @@ def append_annotation():
 
         path = os.path.join(filename)
 
-        # Read the current annotations
-        if os.path.exists(path):
-            with open(path, "r", encoding="utf-8") as f:
-                annotations = json.load(f)
-        else:
-            annotations = []
-
-        # Process each annotation
-        for new_annotation in annotation_data:
-            selector = new_annotation.get("selector")
-            labels = new_annotation.get("label")
-
-            if not selector or not labels:
-                continue
-
-            # Add timestamp if not present
-            if not new_annotation.get("timestamp"):
-                new_annotation["timestamp"] = datetime.datetime.now().isoformat()
-
-            # Add color if not present
-            if not new_annotation.get("color"):
-                new_annotation["color"] = "#F44336"  # Use the standard red color
-
-            # Ensure tag and class are present and not empty
-            if not new_annotation.get("tag") or new_annotation.get("tag") == "":
-                # Try to extract tag from selector
-                selector_parts = selector.split('.')
-                if len(selector_parts) > 0 and selector_parts[0]:
-                    new_annotation["tag"] = selector_parts[0]
-                else:
-                    new_annotation["tag"] = "div"  # Default tag
-
-            if not new_annotation.get("class") or new_annotation.get("class") == "":
-                # Try to extract class from selector
-                class_parts = [part for part in selector.split('.') if part and part != selector_parts[0]]
-                if class_parts:
-                    new_annotation["class"] = " ".join(class_parts)
-
-            # Ensure id is present
-            if not new_annotation.get("id"):
-                new_annotation["id"] = ""
-
-            # Handle labels format - only store in label property
-            if not isinstance(labels, list):
-                new_annotation["label"] = [labels] if labels else []  # Convert to array if not already
-            else:
-                new_annotation["label"] = labels  # Keep as array
-
-            # Remove labels property if it exists
-            if "labels" in new_annotation:
-                del new_annotation["labels"]
-
-            # Remove the existing annotation with the same selector
-            annotations = [a for a in annotations if a.get("selector") != selector]
-
-            # Add the new annotation
-            annotations.append(new_annotation)
-            print(f"Added/updated annotation for selector: {selector}")
-
-        # Save the updated annotations
-        with open(path, "w", encoding="utf-8") as f:
-            json.dump(annotations, f, indent=2)
+        # Fill in missing properties, skipping annotations without a
+        # selector or label
+        annotations = normalize_annotations(annotation_data, color=DEFAULT_COLOR)
+
+        # Replace existing annotations by selector and save the file once
+        annotation_store.upsert(path, annotations)
+        # One line per request rather than per selector
+        logger.info('Added/updated %d annotations in %s', len(annotations), filename, extra=app_logging.SAMPLED)
 
         return jsonify({"status": "success", "message": f"Updated annotations for {len(annotation_data)} elements"})
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
-@app.route("/api/remove-annotation", methods=["POST"])
+@api.route("/api/remove-annotation", methods=["POST"])
 def remove_annotation():
     filename = request.args.get("file")
     if not filename or not filename.endswith(".json"):
@@ -464,51 +329,75 @@ def remove_annotation():
 
     if not selector or not label_to_remove:
         return jsonify({"error": "Selector and label are required"}), 400
+    if not isinstance(selector, str):
+        return jsonify({"error": "Selector must be a string"}), 400
 
     path = os.path.join(filename)
 
     try:
-        # Read the current annotations
-        if os.path.exists(path):
-            with open(path, "r", encoding="utf-8") as f:
-                annotations = json.load(f)
-        else:
-            return jsonify({"error": "Annotation file not found"}), 404
-
-        # Find the annotation with the matching selector
-        found = False
-        for i, annotation in enumerate(annotations):
-            if annotation.get("selector") == selector:
-                found = True
-                # If there's a labels array
-                if "labels" in annotation:
-                    # If there's only one label and it matches, remove the entire entry
-                    if len(annotation["labels"]) == 1 and annotation["labels"][0] == label_to_remove:
-                        annotations.pop(i)
-                    # Otherwise, remove just the specific label
-                    elif label_to_remove in annotation["labels"]:
-                        annotation["labels"].remove(label_to_remove)
-                        # Update the primary label if needed
-                        if annotation.get("label") == label_to_remove and annotation["labels"]:
-                            annotation["label"] = annotation["labels"][-1]
-                # If there's only a single label property
-                elif annotation.get("label") == label_to_remove:
-                    annotations.pop(i)
-                break
-
-        if not found:
+        # Remove the label from the annotation with the matching selector
+        if not annotation_store.remove_label(path, selector, label_to_remove):
             return jsonify({"error": "Annotation not found"}), 404
 
-        # Save the updated annotations
-        with open(path, "w", encoding="utf-8") as f:
-            json.dump(annotations, f, indent=2)
-
         return jsonify({"status": "success"})
+    except FileNotFoundError:
+        return jsonify({"error": "Annotation file not found"}), 404
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@api.route("/api/batch", methods=["POST"])
+def batch_annotations():
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({"error": "Invalid batch request"}), 400
+
+    try:
+        # Each touched file is loaded and persisted once for the whole batch
+        results = apply_batch(annotation_store, data.get("operations"))
+    except BatchError as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+    failed = sum(1 for result in results if result["status"] != "success")
+    return jsonify({
+        "status": "success" if not failed else "partial",
+        "succeeded": len(results) - failed,
+        "failed": failed,
+        "results": results
+    })
+
+def upstream_response(response):
+    """
+    Returns the upstream API's response for the client, see PROXY_PASSTHROUGH
+    """
+    body, status, content_type = upstream_body(response.status_code, response.content,
+                                               response.headers.get('Content-Type'))
+    return current_app.response_class(body, status=status, content_type=content_type)
+
+def stream_upstream(response, tee=None):
+    """
+    Returns a response that pipes the body of a streamed upstream response
+    to the client chunk by chunk, optionally copying it into tee
+    """
+    def generate():
+        for chunk in response.iter_content(chunk_size=PROXY_STREAM_CHUNK_SIZE):
+            if tee is not None:
+                tee.add(chunk)
+            yield chunk
+        if tee is not None:
+            tee.finish()
+
+    result = current_app.response_class(generate(), status=response.status_code,
+                                        headers=streamed_headers(response.headers))
+    # Closed by the WSGI server even when the body is never iterated, e.g.
+    # for a HEAD request, a 304 or a client that went away, which releases
+    # the upstream connection and its in-flight slot
+    result.call_on_close(response.close)
+    return result
+
 # Proxy route for user tasks
-@app.route('/api/proxy/get-user-tasks', methods=['POST'])
+@api.route('/api/proxy/get-user-tasks', methods=['POST'])
 def proxy_get_user_tasks():
     try:
         data = request.json
@@ -519,33 +408,45 @@ def proxy_get_user_tasks():
             return jsonify({'error': 'Contact number is required'}), 400
 
         # Forward the request to the actual API
-        response = requests.post(
-            f'{API_URL}/get-user-tasks',
-            json={'contact_number': contact_number},
-            headers={
-                'Content-Type': 'application/json',
-                'ngrok-skip-browser-warning': 'true'
-            }
-        )
+        # Fetching tasks doesn't change anything upstream, so it's safe to retry
+        def fetch_tasks(stream=False):
+            return upstream_client.post(
+                f'{API_URL}/get-user-tasks',
+                idempotent=True,
+                stream=stream,
+                json={'contact_number': contact_number},
+                headers={
+                    'Content-Type': 'application/json',
+                    'ngrok-skip-browser-warning': 'true'
+                }
+            )
+
+        if streaming_requested(request.args):
+            # A stream can't be shared with other requests
+            response = fetch_tasks(stream=True)
+            log_upstream_response(logger, 'Proxy API', response.status_code)
+            return stream_upstream(response)
+
+        # Identical concurrent requests share one call
+        response = proxy_flights.do(('get-user-tasks', contact_number), fetch_tasks)
 
         # Log the response for debugging
-        print(f'Proxy API response status: {response.status_code}')
-        print(f'Proxy API response content: {response.text}')
+        log_upstream_response(logger, 'Proxy API', response.status_code, response.content)
 
         # Return the response from the API
-        # Wrap the response.json() in jsonify() to ensure proper Flask response format
-        try:
-            response_data = response.json()
-            return jsonify(response_data), response.status_code
-        except ValueError:
-            # Handle case where response is not valid JSON
-            return jsonify({'error': 'Invalid JSON response from API', 'content': response.text}), 500
+        return upstream_response(response)
+    except UpstreamBusy as e:
+        logger.warning('Upstream busy in proxy_get_user_tasks: %s', e)
+        return jsonify({'error': str(e)}), 503
+    except requests.Timeout as e:
+        logger.warning('Upstream timeout in proxy_get_user_tasks: %s', e)
+        return jsonify({'error': 'Upstream API timed out'}), 504
     except Exception as e:
-        print(f'Error in proxy_get_user_tasks: {str(e)}')
+        logger.exception('Error in proxy_get_user_tasks: %s', e)
         return jsonify({'error': str(e)}), 500
 
 # Proxy route for create annotation
-@app.route('/api/proxy/create', methods=['POST'])
+@api.route('/api/proxy/create', methods=['POST'])
 def proxy_create_annotation():
     try:
         data = request.json
@@ -555,8 +456,10 @@ def proxy_create_annotation():
             return jsonify({'error': 'Filename is required'}), 400
 
         # Forward the request to the actual API
-        response = requests.post(
+        streaming = streaming_requested(request.args)
+        response = upstream_client.post(
             f'{API_URL}/create',
+            stream=streaming,
             json={'filename': filename},
             headers={
                 'Content-Type': 'application/json',
@@ -565,87 +468,45 @@ def proxy_create_annotation():
         )
 
         # Log the response for debugging
-        print(f'Create API response status: {response.status_code}')
-        print(f'Create API response content: {response.text}')
+        log_upstream_response(logger, 'Create API', response.status_code)
+        if streaming:
+            return stream_upstream(response)
+        log_upstream_body(logger, 'Create API', response.content)
 
         # Return the response from the API
-        # Wrap the response.json() in jsonify() to ensure proper Flask response format
-        try:
-            response_data = response.json()
-            return jsonify(response_data), response.status_code
-        except ValueError:
-            # Handle case where response is not valid JSON
-            return jsonify({'error': 'Invalid JSON response from API', 'content': response.text}), 500
+        return upstream_response(response)
+    except UpstreamBusy as e:
+        logger.warning('Upstream busy in proxy_create_annotation: %s', e)
+        return jsonify({'error': str(e)}), 503
+    except requests.Timeout as e:
+        logger.warning('Upstream timeout in proxy_create_annotation: %s', e)
+        return jsonify({'error': 'Upstream API timed out'}), 504
     except Exception as e:
-        print(f'Error in proxy_create_annotation: {str(e)}')
+        logger.exception('Error in proxy_create_annotation: %s', e)
         return jsonify({'error': str(e)}), 500
 
 # Proxy route for appending annotations
-@app.route('/api/proxy/append', methods=['POST'])
+@api.route('/api/proxy/append', methods=['POST'])
 def proxy_append_annotation():
     try:
         data = request.json
-        filename = data.get('filename')
-        parsed_url = urlparse(filename)
-        path = parsed_url.path
-        # Extract the filename
-        filename = os.path.basename(path)
-        # Remove .json extension if present
-        if filename.endswith('.json'):
-            filename = filename[:-5]
+        filename = append_filename(data.get('filename'))
         annotation_data = data.get('data')
 
         if not filename or not annotation_data:
             return jsonify({'error': 'Filename and data are required'}), 400
 
-        # The client now sends complete data objects with all properties
-        # Validate and ensure all required properties are present
-        for annotation in annotation_data:
-            selector = annotation.get("selector")
-            labels = annotation.get("label")
-
-            if not selector or not labels:
-                return jsonify({"error": "Selector and label are required in each annotation"}), 400
-
-            # Add timestamp if not present
-            if not annotation.get("timestamp"):
-                annotation["timestamp"] = datetime.datetime.now().isoformat()
-
-            # Add color if not present
-            # if not annotation.get("color"):
-            #     annotation["color"] = "#F44336"
-
-            # Ensure label is an array
-            if not isinstance(labels, list):
-                annotation["label"] = [labels] if labels else []
-
-            # Remove labels property if it exists
-            if "labels" in annotation:
-                del annotation["labels"]
-
-            # Ensure tag and class are present and not empty
-            if not annotation.get("tag") or annotation.get("tag") == "":
-                # Try to extract tag from selector
-                selector_parts = selector.split('.')
-                if len(selector_parts) > 0 and selector_parts[0]:
-                    annotation["tag"] = selector_parts[0]
-                else:
-                    annotation["tag"] = "div"  # Default tag
-
-            if not annotation.get("class") or annotation.get("class") == "":
-                # Try to extract class from selector
-                selector_parts = selector.split('.')
-                class_parts = [part for part in selector_parts if part and part != selector_parts[0]]
-                if class_parts:
-                    annotation["class"] = " ".join(class_parts)
-
-            # Ensure id is present
-            if not annotation.get("id"):
-                annotation["id"] = ""
+        # Validate and fill in missing properties of each annotation
+        try:
+            normalize_annotations(annotation_data, strict=True)
+        except NormalizationError as e:
+            return jsonify({"error": str(e)}), 400
 
         # Forward the request to the actual API
-        response = requests.post(
+        streaming = streaming_requested(request.args)
+        response = upstream_client.post(
             f'{API_URL}/append',
+            stream=streaming,
             json={
                 'filename': filename,
                 'data': annotation_data
@@ -656,24 +517,66 @@ def proxy_append_annotation():
             }
         )
 
+        # The page's bounding boxes changed, drop the cached copy
+        if response.ok:
+            bounding_box_cache.invalidate(filename)
+
         # Log the response for debugging
-        print(f'Proxy append API response status: {response.status_code}')
-        print(f'Proxy append API response content: {response.text}')
+        log_upstream_response(logger, 'Proxy append API', response.status_code)
+        if streaming:
+            return stream_upstream(response)
+        log_upstream_body(logger, 'Proxy append API', response.content)
 
         # Return the response from the API
-        # Wrap the response.json() in jsonify() to ensure proper Flask response format
-        try:
-            response_data = response.json()
-            return jsonify(response_data), response.status_code
-        except ValueError:
-            # Handle case where response is not valid JSON
-            return jsonify({'error': 'Invalid JSON response from API', 'content': response.text}), 500
+        return upstream_response(response)
+    except UpstreamBusy as e:
+        logger.warning('Upstream busy in proxy_append_annotation: %s', e)
+        return jsonify({'error': str(e)}), 503
+    except requests.Timeout as e:
+        logger.warning('Upstream timeout in proxy_append_annotation: %s', e)
+        return jsonify({'error': 'Upstream API timed out'}), 504
     except Exception as e:
-        print(f'Error in proxy_append_annotation: {str(e)}')
+        logger.exception('Error in proxy_append_annotation: %s', e)
         return jsonify({'error': str(e)}), 500
 
+def request_bounding_boxes(filename, stream=False):
+    logger.debug('Fetching bounding boxes for filename: %s', filename)
+
+    # Forward the request to the actual API
+    response = upstream_client.get(
+        f'{API_URL}/get/{filename}',
+        stream=stream,
+        headers={
+            'Accept': 'application/json',
+            'ngrok-skip-browser-warning': 'true'
+        }
+    )
+
+    # Log the response for debugging
+    log_upstream_response(logger, 'Get bounding boxes API', response.status_code)
+    return response
+
+def fetch_bounding_boxes(filename):
+    """
+    Fetches bounding boxes from the upstream API and caches a 200 response.
+    Returns (CachedResponse, None), or (None, (body, status, content_type))
+    for a response that shouldn't be cached.
+    """
+    generation = bounding_box_cache.generation(filename)
+    response = request_bounding_boxes(filename)
+    log_upstream_body(logger, 'Get bounding boxes API', response.content)
+
+    body, status, content_type = upstream_body(response.status_code, response.content,
+                                               response.headers.get('Content-Type'))
+    if status != 200:
+        return None, (body, status, content_type)
+
+    cached = CachedResponse(body, content_type=content_type)
+    bounding_box_cache.set(filename, cached, generation)
+    return cached, None
+
 # Proxy route for getting bounding boxes
-@app.route('/api/proxy/get-bounding-boxes', methods=['GET'])
+@api.route('/api/proxy/get-bounding-boxes', methods=['GET'])
 def proxy_get_bounding_boxes():
     try:
         # Get the json_name from the query parameters
@@ -683,40 +586,46 @@ def proxy_get_bounding_boxes():
             return jsonify({'error': 'json_name parameter is required'}), 400
 
         # Extract the filename from json_name (e.g., 'affindacom' from 'affindacom.json')
-        if json_name.endswith('.json'):
-            filename = json_name[:-5]  # Remove '.json' from the end
-        else:
-            filename = json_name
-
-        print(f'Fetching bounding boxes for filename: {filename}')
-
-        # Forward the request to the actual API
-        response = requests.get(
-            f'{API_URL}/get/{filename}',
-            headers={
-                'Accept': 'application/json',
-                'ngrok-skip-browser-warning': 'true'
-            }
-        )
-
-        # Log the response for debugging
-        print(f'Get bounding boxes API response status: {response.status_code}')
-        print(f'Get bounding boxes API response content: {response.text}')
-
-        # Return the response from the API
-        # Wrap the response.json() in jsonify() to ensure proper Flask response format
-        try:
-            response_data = response.json()
-            return jsonify(response_data), response.status_code
-        except ValueError:
-            # Handle case where response is not valid JSON
-            return jsonify({'error': 'Invalid JSON response from API', 'content': response.text}), 500
+        filename = bounding_box_filename(json_name)
+
+        # Serve from cache when possible, bounding boxes only change on append
+        cached = bounding_box_cache.get(filename)
+        if cached is None and streaming_requested(request.args):
+            # Streams can't be shared with other requests, the first one to
+            # complete fills the cache for the rest
+            generation = bounding_box_cache.generation(filename)
+            response = request_bounding_boxes(filename, stream=True)
+            tee = None
+            if response.status_code == 200:
+                tee = CacheTee(bounding_box_cache, filename, generation,
+                               response.headers.get('Content-Type') or 'application/json')
+            return stream_upstream(response, tee)
+        if cached is None:
+            # Identical concurrent requests share one upstream fetch
+            cached, error = proxy_flights.do(('get-bounding-boxes', filename),
+                                             lambda: fetch_bounding_boxes(filename))
+            if error is not None:
+                body, status, content_type = error
+                return current_app.response_class(body, status=status, content_type=content_type)
+
+        # Let clients revalidate with If-None-Match / If-Modified-Since
+        result = current_app.response_class(cached.body, status=cached.status, content_type=cached.content_type)
+        result.set_etag(cached.etag)
+        result.last_modified = cached.last_modified
+        result.cache_control.no_cache = True
+        return result.make_conditional(request)
+    except UpstreamBusy as e:
+        logger.warning('Upstream busy in proxy_get_bounding_boxes: %s', e)
+        return jsonify({'error': str(e)}), 503
+    except requests.Timeout as e:
+        logger.warning('Upstream timeout in proxy_get_bounding_boxes: %s', e)
+        return jsonify({'error': 'Upstream API timed out'}), 504
     except Exception as e:
-        print(f'Error in proxy_get_bounding_boxes: {str(e)}')
+        logger.exception('Error in proxy_get_bounding_boxes: %s', e)
         return jsonify({'error': str(e)}), 500
 
 # User Authentication Routes
-@app.route('/api/register', methods=['POST'])
+@api.route('/api/register', methods=['POST'])
 def register():
     try:
         data = request.json
@@ -728,76 +637,63 @@ def register():
             return jsonify({'error': 'Contact number and password are required'}), 400
 
         # Check if user already exists
-        db = get_db()
-        existing_user = db.users.find_one({'contactNumber': contact_number})
+        existing_user = storage.find_user_by_contact(contact_number)
         if existing_user:
             return jsonify({'error': 'User with this contact number already exists'}), 409
 
         # Hash the password
         hashed_password = hashlib.sha256(password.encode()).hexdigest()
 
-        # Create new user
-        new_user = {
-            'contactNumber': contact_number,
-            'password': hashed_password,
-            'createdAt': datetime.datetime.now()
-        }
-
         # Insert user into database
-        result = db.users.insert_one(new_user)
+        user_id = storage.create_user(contact_number, hashed_password)
 
         return jsonify({
             'success': True,
             'message': 'User registered successfully',
-            'userId': str(result.inserted_id)
+            'userId': user_id
         })
     except Exception as e:
-        print(f'Error in register: {str(e)}')
+        logger.exception('Error in register: %s', e)
         return jsonify({'error': str(e)}), 500
 
-@app.route('/api/login', methods=['POST'])
+@api.route('/api/login', methods=['POST'])
 def login():
     try:
         data = request.json
         contact_number = data.get('contactNumber')
         password = data.get('password')
 
-        print(f'Login attempt for contact number: {contact_number}')
+        logger.debug('Login attempt for contact number: %s', contact_number)
 
         # Validate input
         if not contact_number or not password:
-            print('Login failed: Missing contact number or password')
+            logger.info('Login failed: Missing contact number or password')
             return jsonify({'error': 'Contact number and password are required'}), 400
 
         # Find user
-        db = get_db()
-        user = db.users.find_one({'contactNumber': contact_number})
+        user = storage.find_user_by_contact(contact_number)
 
         if not user:
-            print(f'Login failed: User not found for contact number: {contact_number}')
+            logger.info('Login failed: User not found for contact number: %s', contact_number)
             return jsonify({'error': 'Invalid credentials'}), 401
 
         # Verify password
         hashed_password = hashlib.sha256(password.encode()).hexdigest()
         if user['password'] != hashed_password:
-            print(f'Login failed: Invalid password for contact number: {contact_number}')
+            logger.info('Login failed: Invalid password for contact number: %s', contact_number)
             return jsonify({'error': 'Invalid credentials'}), 401
 
         # Generate a simple auth token (in a real app, use JWT)
         auth_token = hashlib.sha256(f"{str(user['_id'])}-{secrets.token_hex(16)}".encode()).hexdigest()
 
         # Store the token in the database
-        db.auth_tokens.update_one(
-            {'user_id': str(user['_id'])},
-            {'$set': {
-                'token': auth_token,
-                'contact_number': user['contactNumber'],
-                'created_at': datetime.datetime.now()
-            }},
-            upsert=True
-        )
+        previous = storage.replace_token(str(user['_id']), user['contactNumber'], auth_token)
 
-        print(f'Auth token created for user: {contact_number}')
+        # The user's previous token was just replaced, stop trusting it
+        if previous:
+            token_cache.evict(previous)
+
+        logger.info('Auth token created for user: %s', contact_number)
 
         # Return the token to the client
         return jsonify({
@@ -809,28 +705,21 @@ def login():
             'auth_token': auth_token  # Send the token to the client
         })
     except Exception as e:
-        print(f'Error in login: {str(e)}')
+        logger.exception('Error in login: %s', e)
         return jsonify({'error': str(e)}), 500
 
-@app.route('/api/logout', methods=['POST'])
+@api.route('/api/logout', methods=['POST'])
 def logout():
     try:
         # Get auth token from Authorization header
-        auth_header = request.headers.get('Authorization')
-
-        if auth_header and auth_header.startswith('Bearer '):
-            # Extract the token
-            token = auth_header.split(' ')[1]
-            print(f'Logging out token: {token}')
+        token = token_from_request()
 
-            # Remove the token from the database
-            db = get_db()
-            result = db.auth_tokens.delete_one({'token': token})
+        if token:
+            # Remove the token from the database and every worker's cache
+            deleted = storage.delete_token(token)
+            token_cache.evict(token)
 
-            if result.deleted_count > 0:
-                print(f'Token removed successfully')
-            else:
-                print(f'Token not found in database')
+            logger.debug('Logged out, token %s', 'removed' if deleted else 'not found in database')
 
         # Clear session as well (for backward compatibility)
         session.clear()
@@ -840,61 +729,35 @@ def logout():
             'message': 'Logged out successfully'
         })
     except Exception as e:
-        print(f'Error in logout: {str(e)}')
+        logger.exception('Error in logout: %s', e)
         return jsonify({'error': str(e)}), 500
 
-@app.route('/api/user', methods=['GET'])
+@api.route('/api/user', methods=['GET'])
 def get_user():
     try:
-        # Log request information for debugging
-        print(f'Request method: {request.method}')
-        print(f'Request headers: {dict(request.headers)}')
-
         # Get auth token from Authorization header
-        auth_header = request.headers.get('Authorization')
+        token = token_from_request()
 
-        if not auth_header or not auth_header.startswith('Bearer '):
-            print('No Authorization header or invalid format')
+        if not token:
+            logger.debug('No Authorization header or invalid format', extra=app_logging.SAMPLED)
             return jsonify({
                 'success': False,
                 'error': 'Not authenticated',
                 'auth_required': True  # Special flag for frontend to redirect to login
             }), 200  # Return 200 instead of 401 to avoid CORS preflight issues
 
-        # Extract the token
-        token = auth_header.split(' ')[1]
-        print(f'Auth token received: {token}')
-
-        # Find the token in the database
-        db = get_db()
-        token_doc = db.auth_tokens.find_one({'token': token})
-
-        if not token_doc:
-            print('Invalid or expired token')
+        # Validate the token, usually from the cache without touching the database
+        try:
+            identity = authenticate(token)
+        except AuthenticationError as e:
+            logger.info('Authentication failed: %s', e, extra=app_logging.SAMPLED)
             return jsonify({
                 'success': False,
-                'error': 'Invalid or expired token',
+                'error': str(e),
                 'auth_required': True
             }), 200
 
-        # Get the user information
-        user_id = token_doc['user_id']
-        contact_number = token_doc['contact_number']
-
-        print(f'User authenticated via token: user_id={user_id}, contact_number={contact_number}')
-
-        # Get user from database to ensure it still exists
-        user = db.users.find_one({'_id': ObjectId(user_id)})
-
-        if not user:
-            print(f'User not found in database: user_id={user_id}')
-            # Remove the invalid token
-            db.auth_tokens.delete_one({'token': token})
-            return jsonify({
-                'success': False,
-                'error': 'User not found',
-                'auth_required': True
-            }), 200
+        contact_number = identity['contact_number']
 
         return jsonify({
             'success': True,
@@ -903,12 +766,89 @@ def get_user():
             }
         })
     except Exception as e:
-        print(f'Error in get_user: {str(e)}')
+        logger.exception('Error in get_user: %s', e)
         return jsonify({
             'success': False,
             'error': str(e)
         }), 500
 
+@api.route('/api/auth/stats', methods=['GET'])
+def auth_cache_stats():
+    # Token cache counters for this worker
+    return jsonify(token_cache.stats())
+
+@api.route('/api/proxy/stats', methods=['GET'])
+def proxy_stats():
+    # Upstream calls made and requests that shared another request's call
+    return jsonify(proxy_flights.stats())
+
+@api.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    # Every worker's metrics when METRICS_DIR is set, this one's otherwise
+    return current_app.response_class(metrics.render(metrics.collect()), content_type=metrics.CONTENT_TYPE)
+
+def create_app():
+    """
+    Builds the Flask app with its sessions, logging, metrics and routes
+    """
+    app = Flask(__name__, static_folder='public')
+
+    # Full CORS configuration for all origins, methods, and headers
+    CORS(app,
+         resources={r"/*": {"origins": "*"}},
+         supports_credentials=True,
+         allow_headers=["Content-Type", "Authorization", "X-Requested-With", "Accept", "Origin", "Access-Control-Request-Method", "Access-Control-Request-Headers"],
+         methods=["GET", "POST", "PUT", "DELETE", "OPTIONS", "PATCH"],
+         expose_headers=["Content-Type", "Authorization", "X-Total-Count", "X-Next-Cursor"])
+
+    # Configure session with settings that work for cross-origin requests
+    # The same key in every worker, so any of them accepts a session cookie
+    app.secret_key = session_store.load_secret_key()
+    app.config['SESSION_COOKIE_HTTPONLY'] = True
+    app.config['SESSION_COOKIE_SAMESITE'] = None  # None is required for cross-origin requests
+    app.config['SESSION_COOKIE_SECURE'] = False  # Set to True in production with HTTPS
+    app.config['SESSION_COOKIE_PATH'] = '/'
+    app.config['SESSION_COOKIE_DOMAIN'] = None  # Allow the browser to set the cookie domain
+    app.config['SESSION_PERMANENT'] = True  # Make session permanent
+    app.config['SESSION_USE_SIGNER'] = True
+    app.config['PERMANENT_SESSION_LIFETIME'] = datetime.timedelta(days=7)  # Session lasts for 7 days
+    # Only used with SESSION_BACKEND=filesystem
+    app.config['SESSION_TYPE'] = 'filesystem'
+    app.config['SESSION_FILE_DIR'] = os.path.join(os.getcwd(), 'flask_session')
+
+    # Server-side sessions shared by all workers, see session_store.py
+    session_store.init_app(app)
+
+    # Queued logging with per-route levels, see app_logging.py
+    app_logging.init_app(app)
+
+    # Request counts, latencies and phase timings, served at /metrics
+    metrics.init_app(app)
+
+    # Opt-in traffic capture for bench/replay.py, see capture.py
+    capture.init_app(app)
+
+    app.register_blueprint(api)
+    return app
+
+_app = None
+
+def get_app():
+    """
+    Returns this process's app, creating it on first use
+    """
+    global _app
+    if _app is None:
+        _app = create_app()
+    return _app
+
+def __getattr__(name):
+    # `from main import app` and `gunicorn main:app` build the app when they
+    # first ask for it rather than on import
+    if name == 'app':
+        return get_app()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
 if __name__ == "__main__":
     # Get port from environment variable (Render.com sets this automatically)
     port = int(os.environ.get('PORT', 5001))
@@ -917,4 +857,4 @@ if __name__ == "__main__":
     debug_mode = os.environ.get('FLASK_ENV', 'development') == 'development'
 
     # Run the Flask app
-    app.run(host='0.0.0.0', port=port, debug=debug_mode)
+    get_app().run(host='0.0.0.0', port=port, debug=debug_mode)
@@ -0,0 +1,429 @@
+import atexit
+import json
+import os
+import tempfile
+import threading
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+
+# Set to false to stop recording, /metrics then only reports what the other
+# workers wrote
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', 'true').lower() == 'true'
+# Directory shared by the workers of one server. Each worker writes its
+# metrics there and /metrics adds up all of them, whichever worker answers.
+# gunicorn.conf.py empties it when the server starts
+METRICS_DIR = os.environ.get('METRICS_DIR')
+# Seconds between writes of this worker's metrics to METRICS_DIR
+METRICS_FLUSH_INTERVAL = float(os.environ.get('METRICS_FLUSH_INTERVAL', 10))
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000)
+BOOT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# name -> (type, help, histogram buckets)
+METRICS = {
+    'http_requests_total': (
+        'counter', 'Requests handled, by route, method and status code', None),
+    'http_request_duration_seconds': (
+        'histogram', 'Time from receiving a request to sending the last byte of its response', LATENCY_BUCKETS),
+    'http_request_size_bytes': (
+        'histogram', 'Request body sizes', SIZE_BUCKETS),
+    'http_response_size_bytes': (
+        'histogram', 'Response body sizes', SIZE_BUCKETS),
+    'phase_duration_seconds': (
+        'histogram', 'Time one request spent in each phase: file_read, json_encode, mongo or upstream',
+        LATENCY_BUCKETS),
+    'phase_calls_total': (
+        'counter', 'Calls made in each phase', None),
+    'worker_boot_seconds': (
+        'histogram', 'Time from a worker starting to being ready for requests, see warmup.py', BOOT_BUCKETS),
+    'first_request_duration_seconds': (
+        'histogram', 'Latency of the first request each worker handled', LATENCY_BUCKETS),
+}
+
+# {phase: [seconds, calls]} for the request being served
+_phases = ContextVar('metrics_phases', default=None)
+
+
+class Registry:
+    """
+    Counters and histograms of one process, keyed by metric name and a
+    tuple of (label, value) pairs
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        # key -> [count per bucket and one for +Inf, sum]
+        self._histograms = {}
+
+    def inc(self, name, labels, value=1):
+        key = (name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, labels, value):
+        buckets = METRICS[name][2]
+        position = bisect_left(buckets, value)
+        key = (name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [[0] * (len(buckets) + 1), 0]
+            histogram[0][position] += 1
+            histogram[1] += value
+
+    def clear(self):
+        # Also replaces a lock that may have been held when the process forked
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+
+    def snapshot(self):
+        """
+        Returns the current values in a JSON-serializable form
+        """
+        with self._lock:
+            return {
+                'counters': [[name, labels, value] for (name, labels), value in self._counters.items()],
+                'histograms': [[name, labels, list(counts), total]
+                               for (name, labels), (counts, total) in self._histograms.items()],
+            }
+
+
+def merge(snapshots):
+    """
+    Adds up snapshots from several workers
+    """
+    counters, histograms = {}, {}
+    for snapshot in snapshots:
+        for name, labels, value in snapshot['counters']:
+            key = (name, tuple(map(tuple, labels)))
+            counters[key] = counters.get(key, 0) + value
+        for name, labels, counts, total in snapshot['histograms']:
+            key = (name, tuple(map(tuple, labels)))
+            merged = histograms.get(key)
+            if merged is None:
+                histograms[key] = [list(counts), total]
+            else:
+                merged[0] = [a + b for a, b in zip(merged[0], counts)]
+                merged[1] += total
+    return {
+        'counters': [[name, labels, value] for (name, labels), value in counters.items()],
+        'histograms': [[name, labels, counts, total] for (name, labels), (counts, total) in histograms.items()],
+    }
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(labels, extra=()):
+    pairs = [*labels, *extra]
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def render(snapshot):
+    """
+    Formats a snapshot in the Prometheus text exposition format
+    """
+    series = {}
+    for name, labels, value in snapshot['counters']:
+        series.setdefault(name, []).append((labels, value))
+    for name, labels, counts, total in snapshot['histograms']:
+        series.setdefault(name, []).append((labels, (counts, total)))
+
+    lines = []
+    for name, (kind, description, buckets) in METRICS.items():
+        if name not in series:
+            continue
+        lines.append(f'# HELP {name} {description}')
+        lines.append(f'# TYPE {name} {kind}')
+        for labels, value in sorted(series[name]):
+            if kind == 'counter':
+                lines.append(f'{name}{_labels(labels)} {value}')
+                continue
+            counts, total = value
+            cumulative = 0
+            for bound, count in zip(buckets, counts):
+                cumulative += count
+                lines.append(f'{name}_bucket{_labels(labels, [("le", bound)])} {cumulative}')
+            cumulative += counts[-1]
+            lines.append(f'{name}_bucket{_labels(labels, [("le", "+Inf")])} {cumulative}')
+            lines.append(f'{name}_sum{_labels(labels)} {total}')
+            lines.append(f'{name}_count{_labels(labels)} {cumulative}')
+    return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+_flusher_pid = None
+_flusher_lock = threading.Lock()
+_first_request_pid = None
+
+
+def reset():
+    """
+    Forgets what this process recorded. Call it in a forked worker so what
+    the parent recorded isn't counted once per worker.
+    """
+    registry.clear()
+
+
+def clear_worker_files():
+    """
+    Removes the files workers of an earlier run left in METRICS_DIR
+    """
+    if not METRICS_DIR or not os.path.isdir(METRICS_DIR):
+        return
+    for name in os.listdir(METRICS_DIR):
+        if name.startswith(('metrics-', '.metrics-')):
+            try:
+                os.unlink(os.path.join(METRICS_DIR, name))
+            except FileNotFoundError:
+                pass
+
+
+def _worker_file():
+    return os.path.join(METRICS_DIR, f'metrics-{os.getpid()}.json')
+
+
+def flush():
+    """
+    Writes this worker's metrics to METRICS_DIR
+    """
+    _ensure_flusher()
+    path = _worker_file()
+    fd, tmp_path = tempfile.mkstemp(prefix='.metrics-', suffix='.tmp', dir=METRICS_DIR)
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(registry.snapshot(), f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
+
+
+def _flush_loop():
+    while True:
+        time.sleep(METRICS_FLUSH_INTERVAL)
+        try:
+            flush()
+        except OSError:
+            # The directory may have been emptied by a restart, try again
+            # next time
+            pass
+
+
+def _ensure_flusher():
+    # Threads don't survive a fork, so each worker starts its own
+    global _flusher_pid
+    if _flusher_pid == os.getpid():
+        return
+    with _flusher_lock:
+        if _flusher_pid == os.getpid():
+            return
+        _flusher_pid = os.getpid()
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        threading.Thread(target=_flush_loop, name='metrics-flusher', daemon=True).start()
+        # Keep the final counts of a worker that exits
+        atexit.register(flush)
+
+
+def collect():
+    """
+    Returns the metrics of every worker writing to METRICS_DIR, or of this
+    process when it isn't set
+    """
+    if not METRICS_DIR:
+        return registry.snapshot()
+    flush()
+    own = os.path.basename(_worker_file())
+    snapshots = [registry.snapshot()]
+    for name in os.listdir(METRICS_DIR):
+        if name == own or not name.startswith('metrics-') or not name.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(METRICS_DIR, name)) as f:
+                snapshots.append(json.load(f))
+        except (OSError, ValueError):
+            # Removed or being replaced, it is counted on the next scrape
+            continue
+    return merge(snapshots)
+
+
+class timed:
+    """
+    Context manager adding the time spent in its block to phase for the
+    current request
+    """
+    __slots__ = ('phase', 'start')
+
+    def __init__(self, phase):
+        self.phase = phase
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        add_phase(self.phase, time.perf_counter() - self.start)
+
+
+def _current_route():
+    """
+    Returns the URL rule of the Flask request being handled, as app_logging
+    labels its records, or '-' outside of one
+    """
+    from flask import has_request_context, request
+
+    if has_request_context() and request.url_rule is not None:
+        return request.url_rule.rule
+    return '-'
+
+
+def add_phase(phase, seconds):
+    """
+    Adds seconds spent in phase to the current request, or records it on
+    its own outside of a request
+    """
+    if not METRICS_ENABLED:
+        return
+    phases = _phases.get()
+    if phases is None:
+        labels = (('route', _current_route()), ('phase', phase))
+        registry.observe('phase_duration_seconds', labels, seconds)
+        registry.inc('phase_calls_total', labels)
+        return
+    totals = phases.get(phase)
+    if totals is None:
+        phases[phase] = [seconds, 1]
+    else:
+        totals[0] += seconds
+        totals[1] += 1
+
+
+def start_request():
+    """
+    Starts collecting phase timings for the current request or task
+    """
+    phases = {}
+    _phases.set(phases)
+    return phases
+
+
+def record_request(route, method, status, seconds, request_size, response_size, phases):
+    global _first_request_pid
+    if not METRICS_ENABLED:
+        return
+    if METRICS_DIR:
+        _ensure_flusher()
+    if _first_request_pid != os.getpid():
+        _first_request_pid = os.getpid()
+        registry.observe('first_request_duration_seconds', (('route', route),), seconds)
+    registry.inc('http_requests_total', (('route', route), ('method', method), ('status', status)))
+    registry.observe('http_request_duration_seconds', (('route', route), ('method', method)), seconds)
+    registry.observe('http_request_size_bytes', (('route', route),), request_size)
+    registry.observe('http_response_size_bytes', (('route', route),), response_size)
+    for phase, (phase_seconds, calls) in phases.items():
+        labels = (('route', route), ('phase', phase))
+        registry.observe('phase_duration_seconds', labels, phase_seconds)
+        registry.inc('phase_calls_total', labels, calls)
+
+
+class _MeasuredBody:
+    """
+    Response iterable that counts the bytes sent and records the request
+    when the server closes it
+    """
+
+    def __init__(self, body, finish):
+        self._body = body
+        self._finish = finish
+        self._size = 0
+
+    def __iter__(self):
+        for chunk in self._body:
+            self._size += len(chunk)
+            yield chunk
+
+    def close(self):
+        try:
+            if hasattr(self._body, 'close'):
+                self._body.close()
+        finally:
+            self._finish(self._size)
+
+
+class MetricsMiddleware:
+    """
+    WSGI middleware recording the count, latency, sizes and phase timings
+    of each request. The route label is set by init_app's before_request.
+    """
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        if not METRICS_ENABLED:
+            return self.wsgi_app(environ, start_response)
+
+        start = time.perf_counter()
+        phases = start_request()
+        response = {}
+
+        def recording_start_response(status, headers, exc_info=None):
+            response['status'] = status.split(' ', 1)[0]
+            response['headers'] = headers
+            return start_response(status, headers, exc_info)
+
+        def finish(size):
+            _phases.set(None)
+            try:
+                request_size = int(environ.get('CONTENT_LENGTH') or 0)
+            except ValueError:
+                request_size = 0
+            record_request(environ.get('metrics.route', 'unmatched'), environ.get('REQUEST_METHOD', ''),
+                           response.get('status', '500'), time.perf_counter() - start, request_size, size, phases)
+
+        try:
+            body = self.wsgi_app(environ, recording_start_response)
+        except BaseException:
+            finish(0)
+            raise
+
+        file_wrapper = environ.get('wsgi.file_wrapper')
+        if file_wrapper is not None and isinstance(file_wrapper, type) and isinstance(body, file_wrapper):
+            # Keep the server's sendfile path, the size comes from the headers
+            length = next((value for name, value in response.get('headers', ())
+                           if name.lower() == 'content-length'), 0)
+            finish(int(length))
+            return body
+        return _MeasuredBody(body, finish)
+
+
+def init_app(app):
+    """
+    Records request metrics for app, and times the JSON encoding done by
+    jsonify
+    """
+    from flask import request
+
+    @app.before_request
+    def set_metrics_route():
+        request.environ['metrics.route'] = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+
+    class TimedJSONEncoder(app.json_encoder):
+        def encode(self, o):
+            with timed('json_encode'):
+                return super().encode(o)
+
+    app.json_encoder = TimedJSONEncoder
+    app.wsgi_app = MetricsMiddleware(app.wsgi_app)
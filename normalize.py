@@ -0,0 +1,92 @@
+import datetime
+import os
+
+# Color given to annotations saved through /api/append without one
+DEFAULT_COLOR = "#F44336"  # Use the standard red color
+# Parsed selectors kept in memory, annotators label the same elements over
+# and over
+SELECTOR_CACHE_SIZE = int(os.environ.get('SELECTOR_CACHE_SIZE', 4096))
+
+# selector -> (tag, class), emptied whenever it reaches SELECTOR_CACHE_SIZE.
+# A plain dict rather than functools.lru_cache, so a hit is one dict lookup
+# in the loop below instead of a function call.
+_parsed_selectors = {}
+
+
+class NormalizationError(ValueError):
+    """
+    Raised in strict mode for an annotation without a selector or label
+    """
+
+
+def parse_selector(selector):
+    """
+    Returns (tag, class) inferred from a selector such as 'div.title.main',
+    i.e. ('div', 'title main'). The tag defaults to 'div' and class is None
+    when the selector has no classes.
+    """
+    selector_parts = selector.split('.')
+    tag = selector_parts[0] or "div"
+    class_parts = [part for part in selector_parts if part and part != selector_parts[0]]
+    return tag, " ".join(class_parts) if class_parts else None
+
+
+def normalize_annotations(annotations, color=None, strict=False):
+    """
+    Fills in missing properties of each annotation in place, in one pass:
+    timestamp, color (when given), tag and class inferred from the selector,
+    id, label as a list, and no 'labels' property.
+
+    Returns the annotations that have a selector and label. Others are
+    skipped, or raise NormalizationError if strict is set.
+    """
+    # One timestamp for the whole batch, they were sent together
+    timestamp = datetime.datetime.now().isoformat()
+    normalized = []
+    append = normalized.append
+    parsed_selector = _parsed_selectors.get
+
+    for annotation in annotations:
+        get = annotation.get
+        selector = get("selector")
+        labels = get("label")
+
+        if not selector or not labels:
+            if strict:
+                raise NormalizationError("Selector and label are required in each annotation")
+            continue
+        if not isinstance(selector, str):
+            if strict:
+                raise NormalizationError("Selector must be a string")
+            continue
+
+        if not get("timestamp"):
+            annotation["timestamp"] = timestamp
+        if color is not None and not get("color"):
+            annotation["color"] = color
+
+        # Ensure tag and class are present and not empty
+        tag = get("tag")
+        class_name = get("class")
+        if not tag or not class_name:
+            parsed = parsed_selector(selector)
+            if parsed is None:
+                if len(_parsed_selectors) >= SELECTOR_CACHE_SIZE:
+                    _parsed_selectors.clear()
+                parsed = _parsed_selectors[selector] = parse_selector(selector)
+            if not tag:
+                annotation["tag"] = parsed[0]
+            if not class_name and parsed[1]:
+                annotation["class"] = parsed[1]
+
+        if not get("id"):
+            annotation["id"] = ""
+
+        # Only store labels in the label property, as an array
+        if not isinstance(labels, list):
+            annotation["label"] = [labels]
+        if "labels" in annotation:
+            del annotation["labels"]
+
+        append(annotation)
+    return normalized
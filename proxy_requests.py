@@ -0,0 +1,115 @@
+import logging
+import os
+from urllib.parse import urlparse
+
+import codec
+from app_logging import SAMPLED
+
+# Request and response handling shared by the Flask proxy routes and the
+# async proxy app
+
+# Forward upstream bodies as they are instead of decoding and re-encoding
+# them. Invalid JSON from the upstream API then reaches the client instead
+# of being reported as an error.
+PROXY_PASSTHROUGH = os.environ.get('PROXY_PASSTHROUGH', 'false').lower() == 'true'
+# Pipe upstream bodies to the client in chunks instead of buffering them.
+# Streamed bodies are never decoded, a request can ask for the checked,
+# buffered response with ?validate=true
+PROXY_STREAM = os.environ.get('PROXY_STREAM', 'false').lower() == 'true'
+PROXY_STREAM_CHUNK_SIZE = int(os.environ.get('PROXY_STREAM_CHUNK_SIZE', 64 * 1024))
+# Bytes of each upstream body written to the log, at DEBUG level
+PROXY_LOG_BODY_BYTES = int(os.environ.get('PROXY_LOG_BODY_BYTES', 1000))
+
+
+def append_filename(filename):
+    """
+    Returns the upstream name for an annotation file given as a URL or
+    path, e.g. 'affindacom' for 'https://host/files/affindacom.json'
+    """
+    path = urlparse(filename).path
+    # Extract the filename
+    filename = os.path.basename(path)
+    # Remove .json extension if present
+    if filename.endswith('.json'):
+        filename = filename[:-5]
+    return filename
+
+
+def bounding_box_filename(json_name):
+    """
+    Returns the upstream name for json_name, e.g. 'affindacom' for
+    'affindacom.json'
+    """
+    if json_name.endswith('.json'):
+        return json_name[:-5]  # Remove '.json' from the end
+    return json_name
+
+
+def encode_json(data):
+    """
+    Encodes a response body compact, sorted and newline-terminated like
+    jsonify
+    """
+    return codec.dumps(data, sort_keys=True) + b'\n'
+
+
+def upstream_body(status, content, content_type):
+    """
+    Returns (body, status, content_type) to send the client for an upstream
+    response, passed through or checked and re-encoded as JSON
+    """
+    if PROXY_PASSTHROUGH:
+        return content, status, content_type or 'application/json'
+    try:
+        data = codec.loads(content)
+    except ValueError:
+        # Handle case where response is not valid JSON
+        error = {'error': 'Invalid JSON response from API', 'content': content.decode('utf-8', 'replace')}
+        return encode_json(error), 500, 'application/json'
+    return encode_json(data), status, 'application/json'
+
+
+def streaming_requested(args):
+    """
+    Returns True if the response should be streamed, given the request's
+    query arguments
+    """
+    return PROXY_STREAM and str(args.get('validate', '')).lower() != 'true'
+
+
+def streamed_headers(headers):
+    """
+    Returns the upstream content headers to send with a streamed body. The
+    HTTP clients decode compressed bodies, so the length is only forwarded
+    for uncompressed ones.
+    """
+    forwarded = [('Content-Type', headers.get('Content-Type') or 'application/json')]
+    if headers.get('Content-Length') and not headers.get('Content-Encoding'):
+        forwarded.append(('Content-Length', headers.get('Content-Length')))
+    return forwarded
+
+
+def body_preview(content):
+    """
+    Returns the start of an upstream body for the log
+    """
+    if len(content) <= PROXY_LOG_BODY_BYTES:
+        return content.decode('utf-8', 'replace')
+    preview = content[:PROXY_LOG_BODY_BYTES].decode('utf-8', 'replace')
+    return f'{preview}... ({len(content) - PROXY_LOG_BODY_BYTES} more bytes)'
+
+
+def log_upstream_response(logger, name, status, content=None):
+    """
+    Logs a sample of upstream response statuses and, at DEBUG level, the
+    start of the body
+    """
+    logger.info('%s response status: %s', name, status, extra=SAMPLED)
+    if content is not None:
+        log_upstream_body(logger, name, content)
+
+
+def log_upstream_body(logger, name, content):
+    # Only decode the body when it will be logged
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug('%s response content: %s', name, body_preview(content))
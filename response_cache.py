@@ -0,0 +1,293 @@
+import hashlib
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+import codec
+
+# Bounding boxes only change when someone appends, which invalidates the
+# entry, so the TTL is just a safety net
+BOUNDING_BOX_CACHE_TTL = float(os.environ.get('BOUNDING_BOX_CACHE_TTL', 300))
+BOUNDING_BOX_CACHE_MAX_ENTRIES = int(os.environ.get('BOUNDING_BOX_CACHE_MAX_ENTRIES', 128))
+BOUNDING_BOX_CACHE_MAX_BYTES = int(os.environ.get('BOUNDING_BOX_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+# Directory shared by all workers, used as a second cache tier and to
+# propagate invalidations between workers. Set it empty to cache in memory
+# only, for a single worker
+BOUNDING_BOX_CACHE_DIR = os.environ.get('BOUNDING_BOX_CACHE_DIR', 'bounding_box_cache')
+# TTL without the shared directory. An append only invalidates the worker
+# that handled it, so others may serve stale boxes for this long
+BOUNDING_BOX_CACHE_LOCAL_TTL = float(os.environ.get('BOUNDING_BOX_CACHE_LOCAL_TTL', 5))
+
+
+class CachedResponse:
+    """
+    A cached response body with the validators sent to clients
+    """
+    __slots__ = ('body', 'status', 'content_type', 'etag', 'last_modified', 'stored_at', 'disk_stamp')
+
+    def __init__(self, body, status=200, content_type='application/json', etag=None, last_modified=None,
+                 stored_at=None):
+        self.body = body
+        self.status = status
+        self.content_type = content_type
+        # Strong validator derived from the body unless the caller has one
+        self.etag = etag or hashlib.sha1(body).hexdigest()
+        self.stored_at = stored_at if stored_at is not None else time.time()
+        self.last_modified = last_modified if last_modified is not None else self.stored_at
+        # mtime of the disk tier file this entry was written to or read from
+        self.disk_stamp = None
+
+    def header(self):
+        return {
+            'status': self.status,
+            'content_type': self.content_type,
+            'etag': self.etag,
+            'last_modified': self.last_modified,
+            'stored_at': self.stored_at,
+        }
+
+
+class ResponseCache:
+    """
+    TTL and size bounded LRU cache of response bodies, with an optional disk
+    tier shared between worker processes.
+
+    When the disk tier is enabled, a memory hit is only served while its disk
+    file is unchanged, so an invalidation in one worker is seen by all.
+    """
+
+    def __init__(self, ttl, max_entries, max_bytes, disk_dir=None):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._disk_writes = 0
+        # Bumped on invalidation so a fetch that started earlier can't
+        # store what it got
+        self._generations = {}
+        # The disk directory is created by the first write, so importing the
+        # module doesn't leave one wherever the process happens to start
+        self._disk_dir_created = False
+
+    def _expired(self, entry):
+        return time.time() - entry.stored_at > self.ttl
+
+    def _disk_path(self, key, suffix='.cache'):
+        return os.path.join(self.disk_dir, hashlib.sha256(key.encode('utf-8')).hexdigest() + suffix)
+
+    def _disk_stamp(self, key):
+        try:
+            return os.stat(self._disk_path(key)).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def _tombstone(self, key):
+        """
+        Returns the random token the last invalidation of key wrote, in any
+        worker, or None
+        """
+        try:
+            with open(self._disk_path(key, '.invalidated'), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def _read_disk(self, key):
+        path = self._disk_path(key)
+        try:
+            with open(path, 'rb') as f:
+                stamp = os.fstat(f.fileno()).st_mtime_ns
+                header = codec.loads(f.readline())
+                body = f.read()
+        except (FileNotFoundError, ValueError):
+            return None
+        entry = CachedResponse(body, **header)
+        entry.disk_stamp = stamp
+        if self._expired(entry):
+            self._remove_disk(key)
+            return None
+        return entry
+
+    def _ensure_disk_dir(self):
+        if not self._disk_dir_created:
+            os.makedirs(self.disk_dir, exist_ok=True)
+            self._disk_dir_created = True
+
+    def _write_disk(self, key, entry):
+        path = self._disk_path(key)
+        self._ensure_disk_dir()
+        fd, tmp_path = tempfile.mkstemp(dir=self.disk_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(codec.dumps(entry.header()) + b'\n')
+                f.write(entry.body)
+            os.replace(tmp_path, path)
+        except BaseException:
+            try:
+                os.unlink(tmp_path)
+            except FileNotFoundError:
+                pass
+            raise
+        entry.disk_stamp = self._disk_stamp(key)
+
+        self._disk_writes += 1
+        if self._disk_writes % 32 == 0:
+            self._prune_disk()
+
+    def _prune_disk(self):
+        """
+        Deletes expired disk entries and the oldest ones beyond max_entries
+        """
+        files = []
+        tombstones = []
+        try:
+            names = os.listdir(self.disk_dir)
+        except FileNotFoundError:
+            return
+        for name in names:
+            if name.endswith('.cache') or name.endswith('.invalidated'):
+                try:
+                    mtime = os.stat(os.path.join(self.disk_dir, name)).st_mtime
+                except FileNotFoundError:
+                    continue
+                (files if name.endswith('.cache') else tombstones).append((mtime, name))
+        files.sort(reverse=True)
+        cutoff = time.time() - self.ttl
+        # Tombstones only need to outlive fetches in flight, which take far
+        # less than the TTL
+        stale = [(mtime, name) for position, (mtime, name) in enumerate(files)
+                 if position >= self.max_entries or mtime < cutoff]
+        for mtime, name in stale + [item for item in tombstones if item[0] < cutoff]:
+            try:
+                os.unlink(os.path.join(self.disk_dir, name))
+            except FileNotFoundError:
+                pass
+
+    def _remove_disk(self, key):
+        try:
+            os.unlink(self._disk_path(key))
+        except FileNotFoundError:
+            pass
+
+    def _pop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= len(entry.body)
+
+    def _store(self, key, entry):
+        self._pop(key)
+        self._entries[key] = entry
+        self._bytes += len(entry.body)
+        # Evict least recently used entries until both bounds hold
+        while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+            _, evicted = self._entries.popitem(last=False)
+            self._bytes -= len(evicted.body)
+
+    def get(self, key):
+        """
+        Returns the fresh CachedResponse for key, or None
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                stale = self._expired(entry)
+                if not stale and self.disk_dir and self._disk_stamp(key) != entry.disk_stamp:
+                    # Invalidated or refreshed by another worker
+                    stale = True
+                if not stale:
+                    self._entries.move_to_end(key)
+                    return entry
+                self._pop(key)
+
+            if not self.disk_dir:
+                return None
+            entry = self._read_disk(key)
+            if entry is not None:
+                self._store(key, entry)
+            return entry
+
+    def generation(self, key):
+        """
+        Returns a token to pass to set() for a value fetched after this call
+        """
+        with self._lock:
+            return self._generation(key)
+
+    def _generation(self, key):
+        generation = self._generations.get(key, 0)
+        if self.disk_dir:
+            # Invalidations by other workers leave a tombstone
+            return generation, self._tombstone(key)
+        return generation
+
+    def set(self, key, entry, generation=None):
+        """
+        Caches entry under key unless it's larger than the whole cache or key
+        was invalidated since generation was taken
+        """
+        if len(entry.body) > self.max_bytes:
+            return
+        with self._lock:
+            if generation is not None and generation != self._generation(key):
+                return
+            if self.disk_dir:
+                self._write_disk(key, entry)
+            self._store(key, entry)
+
+    def invalidate(self, key):
+        """
+        Drops key from every tier
+        """
+        with self._lock:
+            self._generations[key] = self._generations.get(key, 0) + 1
+            self._pop(key)
+            if self.disk_dir:
+                self._remove_disk(key)
+                self._ensure_disk_dir()
+                with open(self._disk_path(key, '.invalidated'), 'wb') as f:
+                    f.write(os.urandom(16))
+
+
+class CacheTee:
+    """
+    Collects the chunks of a streamed response and caches the body once the
+    stream completes, giving up as soon as it's too large for the cache
+    """
+
+    def __init__(self, cache, key, generation, content_type='application/json'):
+        self.cache = cache
+        self.key = key
+        self.generation = generation
+        self.content_type = content_type
+        self._chunks = []
+        self._size = 0
+
+    def add(self, chunk):
+        if self._chunks is None:
+            return
+        self._size += len(chunk)
+        if self._size > self.cache.max_bytes:
+            self._chunks = None
+        else:
+            self._chunks.append(chunk)
+
+    def finish(self):
+        if self._chunks is not None:
+            entry = CachedResponse(b''.join(self._chunks), content_type=self.content_type)
+            self.cache.set(self.key, entry, self.generation)
+            self._chunks = None
+
+
+# Cache of /api/proxy/get-bounding-boxes responses keyed by filename
+bounding_box_cache = ResponseCache(
+    ttl=BOUNDING_BOX_CACHE_TTL if BOUNDING_BOX_CACHE_DIR else min(BOUNDING_BOX_CACHE_TTL,
+                                                                  BOUNDING_BOX_CACHE_LOCAL_TTL),
+    max_entries=BOUNDING_BOX_CACHE_MAX_ENTRIES,
+    max_bytes=BOUNDING_BOX_CACHE_MAX_BYTES,
+    disk_dir=BOUNDING_BOX_CACHE_DIR or None,
+)
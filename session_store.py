@@ -0,0 +1,354 @@
+import logging
+import os
+import secrets
+import socket
+import sqlite3
+import tempfile
+import threading
+import time
+from urllib.parse import urlparse, unquote
+
+from flask.json.tag import TaggedJSONSerializer
+from flask_session.sessions import ServerSideSession, SessionInterface
+from itsdangerous import BadSignature, want_bytes
+
+logger = logging.getLogger(__name__)
+
+# "sqlite", "redis", "memory" or "filesystem" for the original Flask-Session
+# directory. sqlite and redis are shared by every worker, memory is per process
+SESSION_BACKEND = os.environ.get('SESSION_BACKEND', 'sqlite')
+SESSION_SQLITE_PATH = os.environ.get('SESSION_SQLITE_PATH', 'sessions.sqlite3')
+SESSION_REDIS_URL = os.environ.get('SESSION_REDIS_URL', 'redis://localhost:6379/0')
+SESSION_KEY_PREFIX = os.environ.get('SESSION_KEY_PREFIX', 'session:')
+# Seconds between sweeps of expired sessions
+SESSION_SWEEP_INTERVAL = float(os.environ.get('SESSION_SWEEP_INTERVAL', 300))
+# Where the generated secret key is kept when SECRET_KEY isn't set
+SECRET_KEY_FILE = os.environ.get('SECRET_KEY_FILE', '.secret_key')
+
+
+def load_secret_key(path=SECRET_KEY_FILE):
+    """
+    Returns SECRET_KEY from the environment, or the key stored in path,
+    generating it on first use. Every worker started from the same directory
+    gets the same key, so cookies signed by one are accepted by all.
+    """
+    key = os.environ.get('SECRET_KEY')
+    if key:
+        return key
+
+    if not os.path.exists(path):
+        directory = os.path.dirname(path) or '.'
+        fd, tmp_path = tempfile.mkstemp(prefix='.secret_key.', dir=directory)
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(secrets.token_hex(32))
+            # Linking fails if another worker created the file first, in
+            # which case its key is used
+            os.link(tmp_path, path)
+        except FileExistsError:
+            pass
+        finally:
+            os.unlink(tmp_path)
+
+    with open(path, 'r') as f:
+        return f.read().strip()
+
+
+class MemorySessionBackend:
+    """
+    Sessions in a dict. Only shared by the threads of one process, so each
+    gunicorn worker has its own sessions.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._items = {}
+
+    def get(self, sid):
+        with self._lock:
+            item = self._items.get(sid)
+        if item is None or item[0] <= time.time():
+            return None
+        return item[1]
+
+    def set(self, sid, data, ttl):
+        with self._lock:
+            self._items[sid] = (time.time() + ttl, data)
+
+    def delete(self, sid):
+        with self._lock:
+            self._items.pop(sid, None)
+
+    def sweep(self):
+        now = time.time()
+        with self._lock:
+            expired = [sid for sid, (expires_at, _) in self._items.items() if expires_at <= now]
+            for sid in expired:
+                del self._items[sid]
+        return len(expired)
+
+
+class SQLiteSessionBackend:
+    """
+    Sessions in a SQLite database in WAL mode, so readers in every worker
+    don't block each other or the writer
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        conn = self._connection()
+        conn.execute('CREATE TABLE IF NOT EXISTS sessions '
+                     '(sid TEXT PRIMARY KEY, data BLOB NOT NULL, expires_at REAL NOT NULL)')
+        conn.execute('CREATE INDEX IF NOT EXISTS sessions_expires_at ON sessions (expires_at)')
+
+    def _connection(self):
+        # One connection per thread, connections can't be shared across a fork
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def get(self, sid):
+        row = self._connection().execute(
+            'SELECT data FROM sessions WHERE sid = ? AND expires_at > ?', (sid, time.time())
+        ).fetchone()
+        return row[0] if row is not None else None
+
+    def set(self, sid, data, ttl):
+        self._connection().execute(
+            'INSERT INTO sessions (sid, data, expires_at) VALUES (?, ?, ?) '
+            'ON CONFLICT(sid) DO UPDATE SET data = excluded.data, expires_at = excluded.expires_at',
+            (sid, data, time.time() + ttl)
+        )
+
+    def delete(self, sid):
+        self._connection().execute('DELETE FROM sessions WHERE sid = ?', (sid,))
+
+    def sweep(self):
+        return self._connection().execute('DELETE FROM sessions WHERE expires_at <= ?', (time.time(),)).rowcount
+
+
+class RedisError(Exception):
+    """
+    An error reply from the Redis server
+    """
+
+
+class RedisConnection:
+    """
+    Minimal Redis protocol (RESP) client, enough for the session backend
+    """
+
+    def __init__(self, url, timeout=5):
+        parsed = urlparse(url)
+        self.host = parsed.hostname or 'localhost'
+        self.port = parsed.port or 6379
+        self.password = unquote(parsed.password) if parsed.password else None
+        self.db = int(parsed.path.lstrip('/') or 0)
+        self.timeout = timeout
+        self._sock = None
+        self._reader = None
+
+    def _connect(self):
+        self._sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._reader = self._sock.makefile('rb')
+        if self.password:
+            self._send('AUTH', self.password)
+        if self.db:
+            self._send('SELECT', self.db)
+
+    def close(self):
+        if self._sock is not None:
+            self._reader.close()
+            self._sock.close()
+            self._sock = self._reader = None
+
+    def _read_reply(self):
+        line = self._reader.readline()
+        if not line:
+            raise ConnectionError('Redis closed the connection')
+        kind, payload = line[:1], line[1:-2]
+        if kind == b'+':
+            return payload.decode('utf-8')
+        if kind == b'-':
+            raise RedisError(payload.decode('utf-8'))
+        if kind == b':':
+            return int(payload)
+        if kind == b'$':
+            length = int(payload)
+            if length < 0:
+                return None
+            data = self._reader.read(length + 2)
+            return data[:-2]
+        if kind == b'*':
+            length = int(payload)
+            return None if length < 0 else [self._read_reply() for _ in range(length)]
+        raise RedisError(f'Unexpected reply: {line!r}')
+
+    def _send(self, *args):
+        parts = [f'*{len(args)}\r\n'.encode('ascii')]
+        for arg in args:
+            arg = want_bytes(str(arg) if isinstance(arg, int) else arg)
+            parts.append(f'${len(arg)}\r\n'.encode('ascii') + arg + b'\r\n')
+        self._sock.sendall(b''.join(parts))
+        return self._read_reply()
+
+    def execute(self, *args):
+        """
+        Sends a command and returns its reply, reconnecting once if the
+        connection was dropped
+        """
+        for attempt in range(2):
+            try:
+                if self._sock is None:
+                    self._connect()
+                return self._send(*args)
+            except (OSError, ConnectionError):
+                self.close()
+                if attempt:
+                    raise
+
+
+class RedisSessionBackend:
+    """
+    Sessions in Redis or any server speaking its protocol. Redis expires the
+    keys itself, so there is nothing to sweep.
+    """
+
+    def __init__(self, url, key_prefix=SESSION_KEY_PREFIX):
+        self.url = url
+        self.key_prefix = key_prefix
+        self._local = threading.local()
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = RedisConnection(self.url)
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def get(self, sid):
+        return self._connection().execute('GET', self.key_prefix + sid)
+
+    def set(self, sid, data, ttl):
+        self._connection().execute('SET', self.key_prefix + sid, data, 'EX', max(int(ttl), 1))
+
+    def delete(self, sid):
+        self._connection().execute('DEL', self.key_prefix + sid)
+
+    def sweep(self):
+        return 0
+
+
+def create_backend(name=SESSION_BACKEND):
+    if name == 'sqlite':
+        return SQLiteSessionBackend(SESSION_SQLITE_PATH)
+    if name == 'redis':
+        return RedisSessionBackend(SESSION_REDIS_URL)
+    if name == 'memory':
+        return MemorySessionBackend()
+    raise ValueError(f'Unknown session backend: {name}')
+
+
+class StoredSessionInterface(SessionInterface):
+    """
+    Server-side sessions kept in one of the backends above, with the session
+    id in a (optionally signed) cookie like Flask-Session. Session data is
+    stored with Flask's tagged JSON serializer.
+    """
+    serializer = TaggedJSONSerializer()
+    session_class = ServerSideSession
+
+    def __init__(self, backend, use_signer=False, permanent=True, sweep_interval=SESSION_SWEEP_INTERVAL):
+        self.backend = backend
+        self.use_signer = use_signer
+        self.permanent = permanent
+        self.sweep_interval = sweep_interval
+        self._sweeper_pid = None
+
+    def _ensure_sweeper(self):
+        # Threads don't survive a fork, so each worker starts its own
+        if self._sweeper_pid == os.getpid():
+            return
+        self._sweeper_pid = os.getpid()
+        thread = threading.Thread(target=self._sweep_loop, name='session-sweeper', daemon=True)
+        thread.start()
+
+    def _sweep_loop(self):
+        while True:
+            time.sleep(self.sweep_interval)
+            try:
+                self.backend.sweep()
+            except Exception as e:
+                logger.exception('Error sweeping expired sessions: %s', e)
+
+    def open_session(self, app, request):
+        self._ensure_sweeper()
+        sid = request.cookies.get(app.session_cookie_name)
+        if not sid:
+            return self.session_class(sid=self._generate_sid(), permanent=self.permanent)
+        if self.use_signer:
+            signer = self._get_signer(app)
+            if signer is None:
+                return None
+            try:
+                sid = signer.unsign(sid).decode()
+            except BadSignature:
+                return self.session_class(sid=self._generate_sid(), permanent=self.permanent)
+
+        try:
+            data = self.backend.get(sid)
+            if data is not None:
+                return self.session_class(self.serializer.loads(want_bytes(data).decode('utf-8')), sid=sid)
+        except Exception as e:
+            # An unreadable session is treated as a new one
+            logger.warning('Error loading session: %s', e)
+        return self.session_class(sid=sid, permanent=self.permanent)
+
+    def save_session(self, app, session, response):
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        # New sessions only hold the permanent flag, don't store one for
+        # every anonymous request
+        if all(key == '_permanent' for key in session):
+            if session.modified:
+                self.backend.delete(session.sid)
+                response.delete_cookie(app.session_cookie_name, domain=domain, path=path)
+            return
+
+        # Unchanged sessions are only written again to extend their lifetime
+        if not session.modified and not self.should_set_cookie(app, session):
+            return
+
+        ttl = app.permanent_session_lifetime.total_seconds()
+        self.backend.set(session.sid, self.serializer.dumps(dict(session)).encode('utf-8'), ttl)
+        if self.use_signer:
+            session_id = self._get_signer(app).sign(want_bytes(session.sid)).decode('utf-8')
+        else:
+            session_id = session.sid
+        response.set_cookie(app.session_cookie_name, session_id,
+                            expires=self.get_expiration_time(app, session),
+                            httponly=self.get_cookie_httponly(app),
+                            domain=domain, path=path,
+                            secure=self.get_cookie_secure(app),
+                            samesite=self.get_cookie_samesite(app))
+
+
+def init_app(app, backend=SESSION_BACKEND):
+    """
+    Installs the session interface for backend on app
+    """
+    if backend == 'filesystem':
+        from flask_session import Session
+        Session(app)
+        return
+    app.session_interface = StoredSessionInterface(
+        create_backend(backend),
+        use_signer=app.config.get('SESSION_USE_SIGNER', False),
+        permanent=app.config.get('SESSION_PERMANENT', True),
+    )
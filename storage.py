@@ -0,0 +1,249 @@
+import datetime
+import os
+import sqlite3
+import threading
+import time
+
+from bson.objectid import ObjectId
+
+from db import get_db, AUTH_TOKEN_TTL_SECONDS
+
+# "mongo" uses MONGO_URI. "memory" and "sqlite" stand in for MongoDB so the
+# app can be run and benchmarked without a network; memory is per process,
+# so use it with a single worker
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'mongo')
+STORAGE_SQLITE_PATH = os.environ.get('STORAGE_SQLITE_PATH', 'storage.sqlite3')
+
+
+def _token_expired(created_at):
+    # MongoDB's TTL index deletes these, the stand-ins just ignore them
+    return AUTH_TOKEN_TTL_SECONDS > 0 and time.time() - created_at > AUTH_TOKEN_TTL_SECONDS
+
+
+class MongoStorage:
+    """
+    Users, auth tokens and annotations in MongoDB, through db.get_db()
+    """
+
+    def find_user_by_contact(self, contact_number):
+        return get_db().users.find_one({'contactNumber': contact_number})
+
+    def find_user(self, user_id):
+        return get_db().users.find_one({'_id': ObjectId(user_id)})
+
+    def create_user(self, contact_number, password_hash):
+        """
+        Stores a new user and returns its id
+        """
+        result = get_db().users.insert_one({
+            'contactNumber': contact_number,
+            'password': password_hash,
+            'createdAt': datetime.datetime.now()
+        })
+        return str(result.inserted_id)
+
+    def find_token(self, token):
+        return get_db().auth_tokens.find_one({'token': token})
+
+    def replace_token(self, user_id, contact_number, token):
+        """
+        Makes token the user's only token and returns the one it replaced,
+        if any
+        """
+        previous = get_db().auth_tokens.find_one_and_update(
+            {'user_id': user_id},
+            {'$set': {
+                'token': token,
+                'contact_number': contact_number,
+                # MongoDB TTL indexes compare against UTC
+                'created_at': datetime.datetime.utcnow()
+            }},
+            upsert=True
+        )
+        return previous.get('token') if previous else None
+
+    def delete_token(self, token):
+        """
+        Deletes token, returning False if it didn't exist
+        """
+        return get_db().auth_tokens.delete_one({'token': token}).deleted_count > 0
+
+    def annotation_store(self):
+        from annotation_mongo import MongoAnnotationStore
+        return MongoAnnotationStore()
+
+
+class MemoryStorage:
+    """
+    Users, auth tokens and annotations in this process only
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._users = {}
+        self._users_by_contact = {}
+        self._tokens = {}
+        self._tokens_by_user = {}
+
+    def find_user_by_contact(self, contact_number):
+        with self._lock:
+            user_id = self._users_by_contact.get(contact_number)
+            return dict(self._users[user_id]) if user_id is not None else None
+
+    def find_user(self, user_id):
+        with self._lock:
+            user = self._users.get(user_id)
+            return dict(user) if user is not None else None
+
+    def create_user(self, contact_number, password_hash):
+        user_id = str(ObjectId())
+        with self._lock:
+            self._users[user_id] = {
+                '_id': user_id,
+                'contactNumber': contact_number,
+                'password': password_hash,
+                'createdAt': datetime.datetime.now()
+            }
+            self._users_by_contact[contact_number] = user_id
+        return user_id
+
+    def find_token(self, token):
+        with self._lock:
+            token_doc = self._tokens.get(token)
+        if token_doc is None or _token_expired(token_doc['created_at']):
+            return None
+        return dict(token_doc)
+
+    def replace_token(self, user_id, contact_number, token):
+        with self._lock:
+            previous = self._tokens_by_user.get(user_id)
+            if previous is not None:
+                self._tokens.pop(previous, None)
+            self._tokens[token] = {
+                'token': token,
+                'user_id': user_id,
+                'contact_number': contact_number,
+                'created_at': time.time()
+            }
+            self._tokens_by_user[user_id] = token
+        return previous
+
+    def delete_token(self, token):
+        with self._lock:
+            token_doc = self._tokens.pop(token, None)
+            if token_doc is None:
+                return False
+            self._tokens_by_user.pop(token_doc['user_id'], None)
+            return True
+
+    def annotation_store(self):
+        from annotation_store import MemoryAnnotationStore
+        return MemoryAnnotationStore()
+
+
+class SQLiteStorage:
+    """
+    Users, auth tokens and annotations in a SQLite database in WAL mode,
+    shared by every worker on the machine
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        conn = self.connection()
+        conn.execute('CREATE TABLE IF NOT EXISTS users (id TEXT PRIMARY KEY, contact_number TEXT NOT NULL UNIQUE, '
+                     'password TEXT NOT NULL, created_at TEXT NOT NULL)')
+        conn.execute('CREATE TABLE IF NOT EXISTS auth_tokens (token TEXT PRIMARY KEY, user_id TEXT NOT NULL UNIQUE, '
+                     'contact_number TEXT NOT NULL, created_at REAL NOT NULL)')
+
+    def connection(self):
+        """
+        Returns this thread's connection, connections can't be shared across
+        a fork
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    @staticmethod
+    def _user(row):
+        if row is None:
+            return None
+        return {
+            '_id': row[0],
+            'contactNumber': row[1],
+            'password': row[2],
+            'createdAt': datetime.datetime.fromisoformat(row[3])
+        }
+
+    def find_user_by_contact(self, contact_number):
+        return self._user(self.connection().execute(
+            'SELECT id, contact_number, password, created_at FROM users WHERE contact_number = ?', (contact_number,)
+        ).fetchone())
+
+    def find_user(self, user_id):
+        return self._user(self.connection().execute(
+            'SELECT id, contact_number, password, created_at FROM users WHERE id = ?', (user_id,)
+        ).fetchone())
+
+    def create_user(self, contact_number, password_hash):
+        user_id = str(ObjectId())
+        self.connection().execute(
+            'INSERT INTO users (id, contact_number, password, created_at) VALUES (?, ?, ?, ?)',
+            (user_id, contact_number, password_hash, datetime.datetime.now().isoformat())
+        )
+        return user_id
+
+    def find_token(self, token):
+        row = self.connection().execute(
+            'SELECT token, user_id, contact_number, created_at FROM auth_tokens WHERE token = ?', (token,)
+        ).fetchone()
+        if row is None or _token_expired(row[3]):
+            return None
+        return {'token': row[0], 'user_id': row[1], 'contact_number': row[2], 'created_at': row[3]}
+
+    def replace_token(self, user_id, contact_number, token):
+        conn = self.connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute('SELECT token FROM auth_tokens WHERE user_id = ?', (user_id,)).fetchone()
+            conn.execute(
+                'INSERT INTO auth_tokens (token, user_id, contact_number, created_at) VALUES (?, ?, ?, ?) '
+                'ON CONFLICT(user_id) DO UPDATE SET token = excluded.token, '
+                'contact_number = excluded.contact_number, created_at = excluded.created_at',
+                (token, user_id, contact_number, time.time())
+            )
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        return row[0] if row is not None else None
+
+    def delete_token(self, token):
+        return self.connection().execute('DELETE FROM auth_tokens WHERE token = ?', (token,)).rowcount > 0
+
+    def annotation_store(self):
+        from annotation_sqlite import SQLiteAnnotationStore
+        return SQLiteAnnotationStore(self.connection)
+
+
+def create_storage(backend=None):
+    """
+    Returns the storage for backend, STORAGE_BACKEND by default
+    """
+    backend = backend or STORAGE_BACKEND
+    if backend == 'mongo':
+        return MongoStorage()
+    if backend == 'memory':
+        return MemoryStorage()
+    if backend == 'sqlite':
+        return SQLiteStorage(STORAGE_SQLITE_PATH)
+    raise ValueError(f'Unknown storage backend: {backend}')
+
+
+# Shared storage used by the Flask routes
+storage = create_storage()
@@ -0,0 +1,95 @@
+import sqlite3
+
+import pytest
+
+from annotation_sqlite import SQLiteAnnotationStore
+from annotation_store import AnnotationStore, MemoryAnnotationStore
+
+
+def mongo_store():
+    mongomock = pytest.importorskip('mongomock')
+    from annotation_mongo import MongoAnnotationStore
+    return MongoAnnotationStore(mongomock.MongoClient().db)
+
+
+def sqlite_store(tmp_path):
+    conn = sqlite3.connect(str(tmp_path / 'annotations.sqlite3'), isolation_level=None)
+    return SQLiteAnnotationStore(lambda: conn)
+
+
+@pytest.fixture(params=['file', 'memory', 'sqlite', 'mongo'])
+def store(request, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    if request.param == 'file':
+        return AnnotationStore('journal')
+    if request.param == 'memory':
+        return MemoryAnnotationStore()
+    if request.param == 'sqlite':
+        return sqlite_store(tmp_path)
+    return mongo_store()
+
+
+def run(store, tmp_path, steps):
+    """
+    Applies steps to store and to a file store in another directory, then
+    checks both return the same results and end up with the same document
+    """
+    results = [step(store, 'page.json') for step in steps]
+    reference, path = AnnotationStore('rewrite'), str(tmp_path / 'reference.json')
+    expected = [step(reference, path) for step in steps]
+    assert results == expected
+    assert store.read('page.json') == reference.read(path)
+    return results
+
+
+def test_remove_label_matches_the_file_store(store, tmp_path):
+    annotations = [
+        {'selector': 'p.dup', 'label': 'x', 'labels': ['x', 'y', 'x']},
+        {'selector': 'p.empty', 'label': 'x', 'labels': []},
+        {'selector': 'p.single', 'label': 'x', 'labels': ['x']},
+        {'selector': 'p.plain', 'label': 'x'},
+        {'selector': 'p.list', 'label': ['x']},
+    ]
+    results = run(store, tmp_path, [
+        lambda s, path: s.replace(path, annotations),
+        lambda s, path: s.remove_label(path, 'p.dup', 'x'),
+        lambda s, path: s.remove_label(path, 'p.empty', 'z'),
+        lambda s, path: s.remove_label(path, 'p.single', 'x'),
+        lambda s, path: s.remove_label(path, 'p.plain', 'x'),
+        lambda s, path: s.remove_label(path, 'p.list', 'x'),
+        lambda s, path: s.remove_label(path, 'p.missing', 'x'),
+    ])
+
+    assert results[1:] == [True, True, True, True, True, False]
+    assert store.read('page.json') == [
+        {'selector': 'p.dup', 'label': 'x', 'labels': ['y', 'x']},
+        {'selector': 'p.empty', 'label': 'x', 'labels': []},
+        {'selector': 'p.list', 'label': ['x']},
+    ]
+
+
+def test_upsert_after_reset_moves_to_the_end(store, tmp_path):
+    def reset_then_upsert(index, exists):
+        index.reset([{'selector': 'p.a', 'label': ['x']}, {'selector': 'p.b', 'label': ['y']}])
+        index.upsert({'selector': 'p.a', 'label': ['z']})
+
+    run(store, tmp_path, [
+        lambda s, path: s.upsert(path, [{'selector': 'p.c', 'label': ['x']}]),
+        lambda s, path: s.apply(path, reset_then_upsert),
+    ])
+
+    assert store.read('page.json') == [{'selector': 'p.b', 'label': ['y']}, {'selector': 'p.a', 'label': ['z']}]
+
+
+def test_mongo_removal_loses_to_a_concurrent_upsert():
+    store = mongo_store()
+    store.upsert('page.json', [{'selector': 'p.a', 'label': 'x', 'labels': ['x', 'y']}])
+
+    def remove_after_concurrent_upsert(index, exists):
+        assert index.remove_label('p.a', 'x')
+        # Another instance replaces the annotation before this one writes
+        store.upsert('page.json', [{'selector': 'p.a', 'label': 'z', 'labels': ['x', 'z']}])
+
+    store.apply('page.json', remove_after_concurrent_upsert)
+
+    assert store.read('page.json') == [{'selector': 'p.a', 'label': 'z', 'labels': ['x', 'z']}]
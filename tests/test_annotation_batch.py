@@ -0,0 +1,148 @@
+import json
+import os
+
+import pytest
+
+from annotation_batch import BatchError, apply_batch
+from annotation_index import AnnotationIndex
+from annotation_store import AnnotationStore, MemoryAnnotationStore, _PendingWrite
+
+
+@pytest.fixture
+def store():
+    return MemoryAnnotationStore()
+
+
+def test_append_infers_tag_and_class(store):
+    # The second item has a tag but no class, which used to raise
+    # UnboundLocalError while inferring the class
+    results = apply_batch(store, [{"op": "append", "file": "page.json", "data": [
+        {"selector": "div.a.b1", "label": "x"},
+        {"selector": "div.a", "label": ["y"], "tag": "div"},
+    ]}])
+
+    assert results == [{"op": "append", "status": "success", "count": 2}]
+    annotations = {annotation["selector"]: annotation for annotation in store.read("page.json")}
+    assert annotations["div.a.b1"]["tag"] == "div"
+    assert annotations["div.a.b1"]["class"] == "a b1"
+    assert annotations["div.a.b1"]["label"] == ["x"]
+    assert annotations["div.a"]["class"] == "a"
+
+
+def test_operations_on_a_file_run_in_order(store):
+    results = apply_batch(store, [
+        {"op": "replace", "file": "page.json", "data": [{"selector": "p.a", "label": "x", "labels": ["y", "x"]},
+                                                        {"selector": "p.b", "label": "z"}]},
+        {"op": "remove", "file": "page.json", "selector": "p.a", "label": "x"},
+        {"op": "remove", "file": "page.json", "selector": "p.b", "label": "z"},
+        {"op": "remove", "file": "page.json", "selector": "p.b", "label": "z"},
+    ])
+
+    assert [result["status"] for result in results] == ["success", "success", "success", "error"]
+    assert results[3]["code"] == 404
+    assert store.read("page.json") == [{"selector": "p.a", "label": "y", "labels": ["y"]}]
+
+
+def test_invalid_operations_fail_alone(store):
+    results = apply_batch(store, [
+        {"op": "rename", "file": "page.json"},
+        {"op": "append", "file": "page.txt", "data": [{"selector": "p"}]},
+        {"op": "replace", "file": "https://example.com/files/page.json", "data": []},
+    ])
+
+    assert results[0]["status"] == "error" and results[0]["code"] == 400
+    assert results[1]["status"] == "error" and results[1]["error"] == "Invalid file name"
+    assert results[2] == {"op": "replace", "status": "success"}
+    assert store.read("page.json") == []
+
+
+def test_remove_from_missing_file_creates_nothing(store):
+    results = apply_batch(store, [{"op": "remove", "file": "page.json", "selector": "p", "label": "x"}])
+
+    assert results[0]["code"] == 404
+    assert store.read("page.json") is None
+
+
+def test_batch_must_be_a_list(store):
+    with pytest.raises(BatchError):
+        apply_batch(store, {"op": "append"})
+
+
+def test_invalid_selector_fails_only_its_operation(tmp_path, monkeypatch):
+    # Batch files live in the working directory
+    monkeypatch.chdir(tmp_path)
+    store = AnnotationStore()
+    path = "page.json"
+    results = apply_batch(store, [
+        {"op": "append", "file": path, "data": [{"selector": "p.a", "label": "x"}]},
+        {"op": "remove", "file": path, "selector": ["p.a"], "label": "x"},
+        {"op": "append", "file": path, "data": [{"selector": ["p.b"], "label": "y"},
+                                                {"selector": "p.c", "label": "z"}]},
+    ])
+
+    assert results[0]["status"] == "success"
+    assert results[1] == {"op": "remove", "status": "error", "error": "Selector must be a string", "code": 400}
+    assert results[2] == {"op": "append", "status": "success", "count": 1}
+    with open(path, "rb") as f:
+        assert [annotation["selector"] for annotation in json.load(f)] == ["p.a", "p.c"]
+
+
+def test_operation_failing_part_way_persists_nothing_for_its_file(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    store = AnnotationStore()
+    path = "page.json"
+    store.upsert(path, [{"selector": "p.a", "label": ["x"]}])
+
+    upsert = AnnotationIndex.upsert
+
+    def failing_upsert(index, annotation):
+        if annotation["selector"] == "p.broken":
+            raise TypeError("broken annotation")
+        upsert(index, annotation)
+
+    monkeypatch.setattr(AnnotationIndex, "upsert", failing_upsert)
+    results = apply_batch(store, [
+        {"op": "append", "file": path, "data": [{"selector": "p.b", "label": "y"}]},
+        {"op": "append", "file": path, "data": [{"selector": "p.c", "label": "z"},
+                                                {"selector": "p.broken", "label": "z"}]},
+        {"op": "remove", "file": path, "selector": "p.a", "label": "x"},
+    ])
+
+    assert [result["code"] for result in results] == [500, 500, 500]
+    assert results[1]["error"] == "broken annotation"
+    assert results[0]["error"].startswith("Not applied")
+    # Neither the cached index nor the files kept the changes made before
+    # the failure
+    assert store.read(path) == [{"selector": "p.a", "label": ["x"]}]
+    with open(path, "rb") as f:
+        assert json.load(f) == [{"selector": "p.a", "label": ["x"]}]
+
+
+def test_failed_write_doesnt_affect_writes_committed_with_it(tmp_path):
+    store = AnnotationStore()
+    path = os.path.abspath(str(tmp_path / "page.json"))
+    store.upsert(path, [{"selector": "p.a", "label": ["x"]}])
+
+    def failing(index, exists):
+        index.upsert({"selector": "p.partial", "label": ["y"]})
+        raise RuntimeError("failed part way")
+
+    writes = [_PendingWrite(lambda index, exists: index.upsert({"selector": "p.b", "label": ["y"]})),
+              _PendingWrite(failing),
+              _PendingWrite(lambda index, exists: index.upsert({"selector": "p.c", "label": ["z"]}))]
+    store._run_batch(path, writes)
+
+    assert [write.error is None for write in writes] == [True, False, True]
+    assert [annotation["selector"] for annotation in AnnotationStore().read(path)] == ["p.a", "p.b", "p.c"]
+
+
+def test_memory_store_undoes_a_failed_mutation(store):
+    store.upsert("page.json", [{"selector": "p.a", "label": ["x"]}])
+
+    def failing(index, exists):
+        index.upsert({"selector": "p.partial", "label": ["y"]})
+        raise RuntimeError("failed part way")
+
+    with pytest.raises(RuntimeError):
+        store.apply("page.json", failing)
+    assert store.read("page.json") == [{"selector": "p.a", "label": ["x"]}]
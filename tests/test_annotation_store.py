@@ -0,0 +1,91 @@
+import multiprocessing
+import os
+import threading
+
+import pytest
+
+import annotation_store
+from annotation_store import AnnotationStore, JOURNAL_SUFFIX
+
+
+def selectors(store, path):
+    return sorted(annotation['selector'] for annotation in store.read(path))
+
+
+def _write_from_threads(path, mode, process_id, threads, writes):
+    # A separate store per process, like gunicorn workers
+    annotation_store.COMPACT_MAX_ENTRIES = 10
+    store = AnnotationStore(mode)
+
+    def write_many(thread_id):
+        for n in range(writes):
+            store.upsert(path, [{'selector': f'div.p{process_id}.t{thread_id}.n{n}', 'label': ['x']}])
+
+    workers = [threading.Thread(target=write_many, args=(t,)) for t in range(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+
+
+@pytest.mark.parametrize('mode', ['rewrite', 'journal'])
+def test_concurrent_writers_lose_no_updates(tmp_path, mode):
+    path = str(tmp_path / 'page.json')
+    context = multiprocessing.get_context('fork')
+    processes = [context.Process(target=_write_from_threads, args=(path, mode, p, 4, 25)) for p in range(3)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join(60)
+
+    assert [process.exitcode for process in processes] == [0, 0, 0]
+    expected = sorted(f'div.p{p}.t{t}.n{n}' for p in range(3) for t in range(4) for n in range(25))
+    assert selectors(AnnotationStore(mode), path) == expected
+
+
+def test_journal_is_replayed_by_other_stores(tmp_path):
+    path = str(tmp_path / 'page.json')
+    writer, reader = AnnotationStore('journal'), AnnotationStore('journal')
+    writer.upsert(path, [{'selector': 'p.a', 'label': ['x']}])
+    assert reader.read(path) == [{'selector': 'p.a', 'label': ['x']}]
+
+    writer.upsert(path, [{'selector': 'p.b', 'label': ['y']}])
+    writer.upsert(path, [{'selector': 'p.a', 'label': ['z']}])
+
+    assert os.path.getsize(path + JOURNAL_SUFFIX) > 0
+    # Only the new journal entries are replayed, and the update moves p.a last
+    assert reader.read(path) == [{'selector': 'p.b', 'label': ['y']}, {'selector': 'p.a', 'label': ['z']}]
+
+
+def test_compaction_folds_the_journal_into_the_snapshot(tmp_path):
+    path = str(tmp_path / 'page.json')
+    writer, reader = AnnotationStore('journal'), AnnotationStore('journal')
+    writer.upsert(path, [{'selector': 'p.a', 'label': ['x']}, {'selector': 'p.b', 'label': 'y'}])
+    assert writer.remove_label(path, 'p.b', 'y')
+    before = reader.read(path)
+
+    writer.compact()
+
+    assert os.path.getsize(path + JOURNAL_SUFFIX) == 0
+    assert reader.read(path) == before == [{'selector': 'p.a', 'label': ['x']}]
+    assert AnnotationStore('journal').read(path) == before
+
+
+def test_interrupted_journal_write_is_ignored_and_truncated(tmp_path):
+    path = str(tmp_path / 'page.json')
+    writer = AnnotationStore('journal')
+    writer.upsert(path, [{'selector': 'p.a', 'label': ['x']}])
+    with open(path + JOURNAL_SUFFIX, 'ab') as f:
+        f.write(b'{"op": "put", "key": "p.broken"')
+
+    assert selectors(AnnotationStore('journal'), path) == ['p.a']
+
+    writer.upsert(path, [{'selector': 'p.b', 'label': ['y']}])
+    assert selectors(AnnotationStore('journal'), path) == ['p.a', 'p.b']
+
+
+def test_reading_a_missing_file_creates_nothing(tmp_path):
+    store = AnnotationStore('journal')
+
+    assert store.read(str(tmp_path / 'missing.json')) is None
+    assert os.listdir(tmp_path) == []
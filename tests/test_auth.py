@@ -0,0 +1,38 @@
+from auth import TokenCache
+
+IDENTITY = {'user_id': '1', 'contact_number': '555'}
+
+
+def workers(tmp_path):
+    path = str(tmp_path / 'evicted')
+    return TokenCache(ttl=30, invalidation_file=path), TokenCache(ttl=30, invalidation_file=path)
+
+
+def test_eviction_reaches_other_workers(tmp_path):
+    first, second = workers(tmp_path)
+    second.set('token', IDENTITY)
+
+    first.evict('token')
+
+    assert second.get('token') == (False, None)
+
+
+def test_invalidation_file_drops_old_evictions(tmp_path, monkeypatch):
+    first, second = workers(tmp_path)
+    clock = [1000.0]
+    monkeypatch.setattr('auth.time.time', lambda: clock[0])
+    for n in range(100):
+        first.evict(f'old-{n}')
+    assert second.get('old-0') == (False, None)
+
+    clock[0] += 61
+    second.set('token', IDENTITY)
+    first.evict('token')
+
+    with open(first.invalidation_file, 'rb') as f:
+        assert len(f.read().splitlines()) == 1
+    # The rotated file is read from the start
+    assert second.get('token') == (False, None)
+    second.set('other', IDENTITY)
+    first.evict('other')
+    assert second.get('other') == (False, None)
@@ -0,0 +1,29 @@
+from pymongo.errors import OperationFailure
+
+import db
+
+
+def test_failed_index_creation_is_retried_after_the_interval(monkeypatch):
+    calls = []
+
+    def ensure_indexes(database):
+        calls.append(database)
+        raise OperationFailure('not authorized')
+
+    clock = [1000.0]
+    monkeypatch.setattr(db, 'ensure_indexes', ensure_indexes)
+    monkeypatch.setattr(db.time, 'monotonic', lambda: clock[0])
+    monkeypatch.setattr(db, 'client', object())
+    monkeypatch.setattr(db, 'db', object())
+    monkeypatch.setattr(db, '_client_pid', db.os.getpid())
+    monkeypatch.setattr(db, '_indexes_ensured', False)
+    monkeypatch.setattr(db, '_indexes_failed_at', None)
+
+    db.get_db()
+    db.get_db()
+    assert len(calls) == 1
+
+    clock[0] += db.MONGO_INDEX_RETRY_INTERVAL
+    db.get_db()
+    assert len(calls) == 2
+
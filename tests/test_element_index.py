@@ -0,0 +1,22 @@
+from element_index import ElementSnapshot
+
+
+def test_areas_keep_their_element_types():
+    snapshot = ElementSnapshot([
+        {'selector': 'a', 'width': 30, 'height': 40},
+        {'selector': 'b', 'width': 2.5, 'height': 4},
+        {'selector': 'c', 'width': 10, 'height': 10},
+    ])
+
+    areas = {element['selector']: element['area'] for element in snapshot.document}
+    assert areas == {'a': 1200, 'b': 10.0, 'c': 100}
+    assert type(areas['a']) is int and type(areas['b']) is float
+    assert [element['selector'] for element in snapshot.area_desc] == ['a', 'c', 'b']
+
+
+def test_equal_areas_keep_document_order():
+    snapshot = ElementSnapshot([{'selector': str(n), 'width': n % 2, 'height': 1} for n in range(6)])
+
+    assert [element['selector'] for element in snapshot.area_asc] == ['0', '2', '4', '1', '3', '5']
+    assert [element['selector'] for element in snapshot.area_desc] == ['1', '3', '5', '0', '2', '4']
+    assert [element['selector'] for element in snapshot.area_range('area_asc', min_area=1)] == ['1', '3', '5']
@@ -0,0 +1,68 @@
+import pytest
+
+from element_index import ElementSnapshot
+from element_query import ElementQuery, QueryError, StaleCursorError
+
+
+@pytest.fixture
+def snapshot():
+    return ElementSnapshot([
+        {'selector': f'e{n}', 'tag': 'div' if n % 2 else 'span', 'class': f'item c{n % 3}',
+         'width': n, 'height': 10}
+        for n in range(1, 11)
+    ], signature=('elements.json', 1, 100))
+
+
+def pages(snapshot, args):
+    """
+    Follows the cursors from the first page, returning the selectors of each
+    page
+    """
+    result = []
+    cursor = None
+    while True:
+        page, total, cursor = ElementQuery(dict(args, cursor=cursor) if cursor else args).run(snapshot)
+        result.append([element['selector'] for element in page])
+        if cursor is None:
+            return result, total
+
+
+def test_cursors_walk_every_element_once(snapshot):
+    result, total = pages(snapshot, {'limit': '4'})
+
+    assert total == 10
+    assert result == [['e10', 'e9', 'e8', 'e7'], ['e6', 'e5', 'e4', 'e3'], ['e2', 'e1']]
+
+
+def test_cursors_apply_filters_and_area_bounds(snapshot):
+    result, total = pages(snapshot, {'limit': '2', 'sort': 'area_asc', 'tag': 'DIV', 'min_area': '20'})
+
+    assert total == 4
+    assert result == [['e3', 'e5'], ['e7', 'e9']]
+
+
+def test_cursor_from_another_query_is_rejected(snapshot):
+    _, _, cursor = ElementQuery({'limit': '2'}).run(snapshot)
+
+    with pytest.raises(QueryError, match='does not match'):
+        ElementQuery({'limit': '2', 'sort': 'area_asc', 'cursor': cursor})
+    with pytest.raises(QueryError, match='Invalid cursor'):
+        ElementQuery({'cursor': 'not-a-cursor'})
+
+
+def test_without_a_limit_everything_is_one_page(snapshot):
+    page, total, cursor = ElementQuery({'sort': 'document', 'class': 'c0'}).run(snapshot)
+
+    assert [element['selector'] for element in page] == ['e3', 'e6', 'e9']
+    assert total == 3 and cursor is None
+
+
+def test_cursor_from_an_older_elements_file_is_stale(snapshot):
+    _, _, cursor = ElementQuery({'limit': '4'}).run(snapshot)
+    changed = ElementSnapshot(snapshot.ordered('document')[1:], signature=('elements.json', 2, 90))
+
+    with pytest.raises(StaleCursorError):
+        ElementQuery({'limit': '4', 'cursor': cursor}).run(changed)
+    # The cursor still works against the file it was issued for
+    page, _, _ = ElementQuery({'limit': '4', 'cursor': cursor}).run(snapshot)
+    assert [element['selector'] for element in page] == ['e6', 'e5', 'e4', 'e3']
@@ -0,0 +1,41 @@
+import pytest
+from flask import Flask
+
+import metrics
+
+
+@pytest.fixture(autouse=True)
+def registry():
+    metrics.registry.clear()
+    yield metrics.registry
+    metrics.registry.clear()
+
+
+def phase_routes(registry):
+    return {dict(labels)['route'] for name, labels, _ in registry.snapshot()['counters']
+            if name == 'phase_calls_total'}
+
+
+def test_phase_outside_the_middleware_is_labeled_with_the_url_rule(registry):
+    app = Flask(__name__)
+    app.add_url_rule('/api/files/<name>', 'file', lambda name: name)
+
+    with app.test_request_context('/api/files/page.json'):
+        metrics.add_phase('file_read', 0.01)
+    metrics.add_phase('file_read', 0.01)
+
+    assert phase_routes(registry) == {'/api/files/<name>', '-'}
+
+
+def test_phases_of_a_request_are_recorded_under_its_route(registry):
+    app = Flask(__name__)
+
+    @app.route('/api/files/<name>')
+    def read_file(name):
+        with metrics.timed('file_read'):
+            return name
+
+    metrics.init_app(app)
+    app.test_client().get('/api/files/page.json').close()
+
+    assert phase_routes(registry) == {'/api/files/<name>'}
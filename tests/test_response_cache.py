@@ -0,0 +1,49 @@
+from response_cache import CachedResponse, ResponseCache
+
+
+def workers(tmp_path):
+    # Two caches sharing a directory behave like two gunicorn workers
+    return (ResponseCache(300, 16, 1 << 20, disk_dir=str(tmp_path)),
+            ResponseCache(300, 16, 1 << 20, disk_dir=str(tmp_path)))
+
+
+def test_invalidation_reaches_other_workers(tmp_path):
+    first, second = workers(tmp_path)
+    first.set('page.json', CachedResponse(b'old'))
+    assert second.get('page.json').body == b'old'
+
+    second.invalidate('page.json')
+
+    assert first.get('page.json') is None
+
+
+def test_fetch_started_before_another_workers_invalidation_is_not_stored(tmp_path):
+    first, second = workers(tmp_path)
+    generation = first.generation('page.json')
+
+    second.invalidate('page.json')
+    first.set('page.json', CachedResponse(b'fetched before the append'), generation)
+
+    assert first.get('page.json') is None
+    assert second.get('page.json') is None
+
+
+def test_memory_only_cache_expires(monkeypatch):
+    cache = ResponseCache(5, 16, 1 << 20)
+    cache.set('page.json', CachedResponse(b'boxes', stored_at=100.0))
+    monkeypatch.setattr('response_cache.time.time', lambda: 104.0)
+    assert cache.get('page.json').body == b'boxes'
+    monkeypatch.setattr('response_cache.time.time', lambda: 106.0)
+    assert cache.get('page.json') is None
+
+
+def test_disk_directory_is_created_by_the_first_write(tmp_path):
+    disk_dir = tmp_path / 'cache'
+    cache = ResponseCache(300, 16, 1 << 20, disk_dir=str(disk_dir))
+    assert cache.get('page.json') is None
+    assert not disk_dir.exists()
+
+    cache.invalidate('page.json')
+    cache.set('page.json', CachedResponse(b'boxes'))
+
+    assert ResponseCache(300, 16, 1 << 20, disk_dir=str(disk_dir)).get('page.json').body == b'boxes'
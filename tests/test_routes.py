@@ -0,0 +1,9 @@
+import main
+
+
+def test_root_reports_status_without_a_frontend_build():
+    response = main.create_app().test_client().get('/')
+
+    assert response.status_code == 200
+    assert response.json['status'] == 'ok'
+    assert '/proxy/get-bounding-boxes' in response.json['endpoints']
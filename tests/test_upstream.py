@@ -0,0 +1,63 @@
+import pytest
+from flask import Flask, request
+
+import main
+import stub_upstream
+from compression import compress_response, representation_etag
+from upstream import UpstreamBusy, UpstreamClient
+
+
+@pytest.fixture(scope='module')
+def api_url():
+    return stub_upstream.start(boxes=10)
+
+
+def test_streamed_response_holds_its_slot_until_closed(api_url):
+    client = UpstreamClient(max_in_flight=1, queue_timeout=0.05, retries=0)
+    response = client.get(f'{api_url}/get/page.json', stream=True)
+
+    with pytest.raises(UpstreamBusy):
+        client.get(f'{api_url}/get/page.json')
+
+    response.close()
+    # Closing again must not release the slot twice
+    response.close()
+    assert client.get(f'{api_url}/get/page.json').status_code == 200
+    assert client.get(f'{api_url}/get/page.json').status_code == 200
+
+
+def test_buffered_response_releases_its_slot(api_url):
+    client = UpstreamClient(max_in_flight=1, queue_timeout=0.05, retries=0)
+    client.get(f'{api_url}/get/page.json')
+    assert client.get(f'{api_url}/get/page.json').status_code == 200
+
+
+def test_unsent_streamed_proxy_response_releases_its_slot(api_url):
+    client = UpstreamClient(max_in_flight=1, queue_timeout=0.05, retries=0)
+    app = main.create_app()
+    with app.test_request_context(method='HEAD'):
+        result = main.stream_upstream(client.get(f'{api_url}/get/page.json', stream=True))
+        # A HEAD request never iterates the body, the server only closes it
+        result.get_app_iter(request.environ).close()
+    assert client.get(f'{api_url}/get/page.json').status_code == 200
+
+
+def test_replaced_streamed_body_is_closed():
+    closed = []
+
+    def body():
+        try:
+            yield b'[]'
+        finally:
+            closed.append(True)
+
+    chunks = body()
+    next(chunks)
+    app = Flask(__name__)
+    with app.test_request_context(headers={'If-None-Match': f'"{representation_etag("v1", None)}"'}):
+        response = app.response_class(chunks, mimetype='application/json')
+        response.set_etag('v1')
+        response = compress_response(request, response)
+        assert response.status_code == 304
+        response.close()
+    assert closed == [True]
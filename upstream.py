@@ -0,0 +1,246 @@
+import asyncio
+import os
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import metrics
+
+# Timeouts in seconds for connecting to and reading from API_URL
+CONNECT_TIMEOUT = float(os.environ.get('UPSTREAM_CONNECT_TIMEOUT', 5))
+READ_TIMEOUT = float(os.environ.get('UPSTREAM_READ_TIMEOUT', 30))
+# Extra attempts for failed connections and, on idempotent calls, read
+# timeouts and gateway errors
+RETRIES = int(os.environ.get('UPSTREAM_RETRIES', 2))
+BACKOFF = float(os.environ.get('UPSTREAM_BACKOFF', 0.3))
+# Keep-alive connections kept open per worker
+POOL_SIZE = int(os.environ.get('UPSTREAM_POOL_SIZE', 10))
+# Upstream requests allowed in flight per worker, and how long a request
+# waits for a free slot before giving up
+MAX_IN_FLIGHT = int(os.environ.get('UPSTREAM_MAX_IN_FLIGHT', 32))
+QUEUE_TIMEOUT = float(os.environ.get('UPSTREAM_QUEUE_TIMEOUT', 10))
+
+IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'])
+RETRY_STATUSES = frozenset([502, 503, 504])
+
+DEFAULT_HEADERS = {
+    'ngrok-skip-browser-warning': 'true'
+}
+
+
+class UpstreamBusy(Exception):
+    """
+    Raised when no in-flight slot frees up within QUEUE_TIMEOUT
+    """
+
+
+def _release_on_close(response, method, release):
+    """
+    Makes response's close method, close or aclose, also call release once.
+    A streamed body is read after request() returns, so its in-flight slot
+    is held until the caller closes the response.
+    """
+    close = getattr(response, method)
+    released = threading.Lock()
+
+    def release_once():
+        if released.acquire(blocking=False):
+            release()
+
+    if asyncio.iscoroutinefunction(close):
+        async def close_and_release():
+            try:
+                await close()
+            finally:
+                release_once()
+    else:
+        def close_and_release():
+            try:
+                close()
+            finally:
+                release_once()
+    setattr(response, method, close_and_release)
+
+
+class UpstreamClient:
+    """
+    Shared HTTP client for calls to the upstream API.
+
+    Each worker process gets its own requests.Session with a keep-alive
+    connection pool, so repeated calls reuse the TCP/TLS connection instead
+    of handshaking every time.
+    """
+
+    def __init__(self, connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT, retries=RETRIES,
+                 backoff=BACKOFF, pool_size=POOL_SIZE, max_in_flight=MAX_IN_FLIGHT, queue_timeout=QUEUE_TIMEOUT):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.pool_size = pool_size
+        self.queue_timeout = queue_timeout
+        self._slots = threading.BoundedSemaphore(max_in_flight)
+        self._session_lock = threading.Lock()
+        self._session = None
+        self._session_pid = None
+
+    def session(self):
+        """
+        Returns this worker's session, creating it after a fork since pooled
+        sockets can't be shared between processes
+        """
+        if self._session is not None and self._session_pid == os.getpid():
+            return self._session
+        with self._session_lock:
+            if self._session is None or self._session_pid != os.getpid():
+                session = requests.Session()
+                session.headers.update(DEFAULT_HEADERS)
+                # Failed connections never reached the upstream, so they are
+                # safe to retry for every method
+                adapter = HTTPAdapter(
+                    pool_connections=1,
+                    pool_maxsize=self.pool_size,
+                    max_retries=Retry(total=None, connect=self.retries, read=0, status=0, other=0,
+                                      backoff_factor=self.backoff),
+                )
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                self._session = session
+                self._session_pid = os.getpid()
+        return self._session
+
+    def request(self, method, url, idempotent=None, **kwargs):
+        """
+        Sends a request upstream, retrying read timeouts and gateway errors
+        with exponential backoff when the call is idempotent. POSTs that only
+        read data can pass idempotent=True to opt in.
+        """
+        if idempotent is None:
+            idempotent = method.upper() in IDEMPOTENT_METHODS
+        kwargs.setdefault('timeout', (self.connect_timeout, self.read_timeout))
+        attempts = 1 + (self.retries if idempotent else 0)
+
+        # Includes waiting for a slot and the retries
+        with metrics.timed('upstream'):
+            if not self._slots.acquire(timeout=self.queue_timeout):
+                raise UpstreamBusy('Too many upstream requests in flight')
+            held = False
+            try:
+                for attempt in range(attempts):
+                    last_attempt = attempt + 1 == attempts
+                    try:
+                        response = self.session().request(method, url, **kwargs)
+                    except requests.exceptions.ReadTimeout:
+                        if last_attempt:
+                            raise
+                    else:
+                        if last_attempt or response.status_code not in RETRY_STATUSES:
+                            if kwargs.get('stream'):
+                                _release_on_close(response, 'close', self._slots.release)
+                                held = True
+                            return response
+                        response.close()
+                    time.sleep(self.backoff * (2 ** attempt))
+            finally:
+                if not held:
+                    self._slots.release()
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+
+class AsyncUpstreamClient:
+    """
+    asyncio counterpart of UpstreamClient for the ASGI proxy app, built on
+    httpx. Uses the same timeout, retry and in-flight settings; with an event
+    loop MAX_IN_FLIGHT can be set much higher than for sync workers.
+    """
+
+    def __init__(self, connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT, retries=RETRIES,
+                 backoff=BACKOFF, pool_size=POOL_SIZE, max_in_flight=MAX_IN_FLIGHT, queue_timeout=QUEUE_TIMEOUT):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.pool_size = pool_size
+        self.max_in_flight = max_in_flight
+        self.queue_timeout = queue_timeout
+        self._client = None
+        self._slots = None
+
+    def _ensure_client(self):
+        # httpx is only needed by the async serving path
+        import httpx
+
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                headers=DEFAULT_HEADERS,
+                timeout=httpx.Timeout(self.read_timeout, connect=self.connect_timeout),
+                limits=httpx.Limits(max_connections=self.max_in_flight,
+                                    max_keepalive_connections=self.pool_size),
+                # Only failed connections are retried by the transport
+                transport=httpx.AsyncHTTPTransport(retries=self.retries),
+            )
+            self._slots = asyncio.Semaphore(self.max_in_flight)
+        return self._client
+
+    async def request(self, method, url, idempotent=None, stream=False, **kwargs):
+        """
+        Sends a request upstream, retrying read timeouts and gateway errors
+        with exponential backoff when the call is idempotent. With stream=True
+        the body isn't read, the caller must read or aclose() the response.
+        """
+        import httpx
+
+        client = self._ensure_client()
+        if idempotent is None:
+            idempotent = method.upper() in IDEMPOTENT_METHODS
+        attempts = 1 + (self.retries if idempotent else 0)
+
+        # Streamed bodies are read after this returns, so aren't included
+        with metrics.timed('upstream'):
+            try:
+                await asyncio.wait_for(self._slots.acquire(), timeout=self.queue_timeout)
+            except asyncio.TimeoutError:
+                raise UpstreamBusy('Too many upstream requests in flight')
+            held = False
+            try:
+                for attempt in range(attempts):
+                    last_attempt = attempt + 1 == attempts
+                    try:
+                        response = await client.send(client.build_request(method, url, **kwargs), stream=stream)
+                    except httpx.ReadTimeout:
+                        if last_attempt:
+                            raise
+                    else:
+                        if last_attempt or response.status_code not in RETRY_STATUSES:
+                            if stream:
+                                _release_on_close(response, 'aclose', self._slots.release)
+                                held = True
+                            return response
+                        await response.aclose()
+                    await asyncio.sleep(self.backoff * (2 ** attempt))
+            finally:
+                if not held:
+                    self._slots.release()
+
+    async def get(self, url, **kwargs):
+        return await self.request('GET', url, **kwargs)
+
+    async def post(self, url, **kwargs):
+        return await self.request('POST', url, **kwargs)
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+# Shared client used by the proxy routes
+client = UpstreamClient()
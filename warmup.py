@@ -0,0 +1,75 @@
+import logging
+import os
+import threading
+import time
+
+import requests
+from pymongo.errors import PyMongoError
+
+import db
+import metrics
+from element_index import element_index
+from label_store import label_store
+from main import API_URL
+from storage import STORAGE_BACKEND
+from upstream import client as upstream_client
+
+logger = logging.getLogger(__name__)
+
+# Send a HEAD request to API_URL from each worker as it boots, so the first
+# proxied request finds a connection already open
+WARMUP_UPSTREAM = os.environ.get('WARMUP_UPSTREAM', 'true').lower() == 'true'
+# Seconds the warm-up request may take, kept well under gunicorn's timeout
+WARMUP_TIMEOUT = float(os.environ.get('WARMUP_TIMEOUT', 2))
+
+
+def preload(app):
+    """
+    Does the work every worker would otherwise repeat: compiles the URL map,
+    parses the element and label files and creates the MongoDB indexes. In
+    gunicorn's master with preload_app, workers are forked with all of it.
+    """
+    start = time.perf_counter()
+    app.url_map.update()
+    element_index.snapshot()
+    label_store.labels()
+    if STORAGE_BACKEND == 'mongo':
+        try:
+            db.get_db()
+        except PyMongoError as e:
+            logger.warning('Could not prepare MongoDB while preloading: %s', e)
+        finally:
+            # Workers open their own connections
+            db.disconnect()
+    logger.info('Preloaded app in %.3fs', time.perf_counter() - start)
+
+
+def _warm_upstream():
+    try:
+        upstream_client.session().head(API_URL, timeout=WARMUP_TIMEOUT)
+    except requests.RequestException as e:
+        logger.warning('Could not reach the upstream API while warming up: %s', e)
+
+
+def warm_worker(started):
+    """
+    Opens this worker's MongoDB connection before it accepts requests and
+    its upstream connection in the background, and records how long it took
+    to boot since started, a time.perf_counter() value
+    """
+    if STORAGE_BACKEND == 'mongo':
+        try:
+            db.get_db()
+        except PyMongoError as e:
+            logger.warning('Could not connect to MongoDB while warming up: %s', e)
+    if WARMUP_UPSTREAM:
+        # The worker doesn't heartbeat until this returns, so a slow upstream
+        # must not hold it up
+        threading.Thread(target=_warm_upstream, name='upstream-warmup', daemon=True).start()
+
+    seconds = time.perf_counter() - started
+    metrics.registry.observe('worker_boot_seconds', (), seconds)
+    if metrics.METRICS_DIR:
+        # Report the boot before the first periodic write
+        metrics.flush()
+    logger.info('Worker %d ready in %.3fs', os.getpid(), seconds)